@@ -0,0 +1,105 @@
+##
+# Micro-benchmark of hmap lookups.
+#
+# Compares the previous recursive, mutating hmap_probe/hmap_get (kept
+# here verbatim as the reference) with the iterative, read-only
+# hmap_lookup and CompiledPath of shunt.hmap, for hits and misses on
+# structured keys and pre-compiled paths.
+#
+# Usage: python benchmarks/bench_hmap_lookup.py [--depth D] [--number N]
+
+import argparse
+import pathlib
+import sys
+import timeit
+
+sys.path.insert( 0, pathlib.Path( __file__ ).resolve().parent.parent.as_posix() )
+import shunt.hmap as hmap
+
+##============================================================================
+
+##
+# The recursive, mutating probe and get as they were before
+# hmap_lookup / CompiledPath
+def legacy_hmap_probe( hmap_, path ):
+    path = hmap.structured_key_to_path( path ) if isinstance( path, str ) else path
+    if path is None or hmap_ is None or len(path) < 1:
+        return None, None
+    if len(path) == 1:
+        return hmap_, path[0]
+    next_element_type = dict
+    if isinstance( path[1], int ):
+        next_element_type = list
+    if isinstance( path[0], int ) and isinstance( hmap_, list ):
+        while len( hmap_ ) < path[0]:
+            hmap_.append( None )
+        if len(hmap_) == path[0]:
+            hmap_.append( next_element_type() )
+    else:
+        if path[0] not in hmap_:
+            hmap_[ path[0] ] = next_element_type()
+    return legacy_hmap_probe( hmap_[ path[0] ], path[1:] )
+
+def legacy_hmap_get( hmap_, path, default ):
+    node, key = legacy_hmap_probe( hmap_, path )
+    if node is None or ( isinstance(node,dict) and key not in node ) or ( isinstance( node, list ) and len(node) <= key):
+        return default
+    return node[ key ]
+
+##============================================================================
+
+##
+# Returns a nested hmap of the given depth (with a list at every
+# other level) and a structured key to its deepest leaf
+def synthetic_hmap( depth, fanout = 8 ):
+    keys = []
+    root = {}
+    node = root
+    for level in range( depth ):
+        if level % 2 == 1:
+            child = [ {} for _ in range( 4 ) ]
+            for i in range( fanout ):
+                node[ "sibling_{0}".format( i ) ] = i
+            node[ "level_{0}".format( level ) ] = child
+            keys.append( "level_{0}".format( level ) )
+            keys.append( "[3]" )
+            node = child[3]
+        else:
+            child = {}
+            node[ "level_{0}".format( level ) ] = child
+            keys.append( "level_{0}".format( level ) )
+            node = child
+    node[ "leaf" ] = "value"
+    keys.append( "leaf" )
+    return root, "/".join( keys )
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--depth', type=int, default=8 )
+    parser.add_argument( '--number', type=int, default=100000 )
+    args = parser.parse_args()
+
+    data, key = synthetic_hmap( args.depth )
+    miss_key = key.rsplit( '/', 1 )[0] + "/missing/deeper"
+    compiled = hmap.compile_path( key )
+    assert legacy_hmap_get( data, key, None ) == hmap.hmap_lookup( data, key, None ) == "value"
+
+    cases = [
+        ( "legacy hmap_get, hit", lambda: legacy_hmap_get( data, key, None ) ),
+        ( "hmap_lookup, hit (structured key)", lambda: hmap.hmap_lookup( data, key, None ) ),
+        ( "hmap_lookup, hit (CompiledPath)", lambda: hmap.hmap_lookup( data, compiled, None ) ),
+        ( "legacy hmap_get, miss (mutates!)", lambda: legacy_hmap_get( data, miss_key, None ) ),
+        ( "hmap_lookup, miss", lambda: hmap.hmap_lookup( data, miss_key, None ) ),
+    ]
+    print( "hmap depth {0} ({1} keys in path), {2} lookups per case".format(
+        args.depth, len( compiled ), args.number ) )
+    for name, fn in cases:
+        t = min( timeit.repeat( fn, number = args.number, repeat = 3 ) )
+        print( "  {0:<40} {1:8.3f} us/lookup".format( name, t / args.number * 1e6 ) )
+
+##============================================================================
+
+if __name__ == '__main__':
+    main()
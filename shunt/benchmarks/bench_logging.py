@@ -0,0 +1,91 @@
+##
+# Benchmark of the logging overhead per materialized view.
+#
+# Compares the previous CustomAdapter (indentation from
+# traceback.extract_stack(), kept here verbatim as the reference) with
+# the one in shunt.logutils, with INFO enabled (to a handler dropping
+# the records) and disabled. Every simulated view logs as many lines
+# as _materialize_view and its caller do, from some stack depth.
+#
+# Usage: python benchmarks/bench_logging.py [--views N] [--depth D]
+
+import argparse
+import logging
+import pathlib
+import sys
+import time
+import traceback
+
+sys.path.insert( 0, pathlib.Path( __file__ ).resolve().parent.parent.as_posix() )
+import shunt.logutils as logutils
+
+##
+# Log lines per materialized view (materialize, template paths,
+# rendered, materialized)
+LOG_CALLS_PER_VIEW = 4
+
+##============================================================================
+
+##
+# The adapter as it was before shunt.logutils counted frames
+class LegacyAdapter( logging.LoggerAdapter ):
+    @staticmethod
+    def indent():
+        indentation_level = len(traceback.extract_stack())
+        return indentation_level-4
+
+    def process(self, msg, kwargs):
+        return '{i}{m}'.format(i='..'*self.indent(), m=msg), kwargs
+
+##============================================================================
+
+##
+# A handler dropping every record (after it was fully formatted)
+class DropHandler( logging.Handler ):
+    def emit( self, record ):
+        self.format( record )
+
+##============================================================================
+
+##
+# Returns the seconds taken to "materialize" views views with the
+# given logger, logging from depth extra stack frames
+def time_views( log, views, depth ):
+    def _views( d ):
+        if d > 0:
+            return _views( d - 1 )
+        start = time.perf_counter()
+        for i in range( views ):
+            for _ in range( LOG_CALLS_PER_VIEW ):
+                log.info( "Materialize view '{0}'".format( i ) )
+        return time.perf_counter() - start
+    return _views( depth )
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--views', type=int, default=2000 )
+    parser.add_argument( '--depth', type=int, default=20 )
+    args = parser.parse_args()
+
+    base = logging.getLogger( "shunt.bench" )
+    base.propagate = False
+    base.addHandler( DropHandler() )
+
+    loggers = [ ( "traceback.extract_stack (old)", LegacyAdapter( base, {} ) ),
+                ( "logutils.CustomAdapter", logutils.getLogger( "shunt.bench" ) ) ]
+    print( "{0} views, {1} log calls per view, {2} extra stack frames".format(
+        args.views, LOG_CALLS_PER_VIEW, args.depth ) )
+    for level, label in ( ( logging.INFO, "INFO enabled" ),
+                          ( logging.WARNING, "INFO disabled" ) ):
+        base.setLevel( level )
+        print( "  {0}:".format( label ) )
+        for name, log in loggers:
+            t = time_views( log, args.views, args.depth )
+            print( "    {0:<35} {1:10.2f} us/view".format( name, t / args.views * 1e6 ) )
+
+##============================================================================
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+##
+# Benchmark of resolving resources against many template paths.
+#
+# Compares the previous resolve_path (an exists() probe of every
+# template path in turn, kept here verbatim as the reference) with
+# shunt.shunt.resolve_path going through the template path index, cold
+# (index built) and warm (index refreshed from directory mtimes, as at
+# the start of every run). Resources are spread evenly over the
+# template paths so later ones need more probes.
+#
+# Usage: python benchmarks/bench_resolve_path.py [--paths N] [--resources R]
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, pathlib.Path( __file__ ).resolve().parent.parent.as_posix() )
+import shunt.shunt as shunt_main
+import shunt.template_index as template_index
+
+##============================================================================
+
+##
+# resolve_path as it was before shunt.template_index
+def legacy_resolve_path( paths, relative_path ):
+    if relative_path is None:
+        return None
+    if paths is None:
+        return None
+    if pathlib.Path( relative_path ).is_absolute():
+        if pathlib.Path( relative_path ).exists():
+            return pathlib.Path( relative_path ).resolve().as_posix()
+        else:
+            return None
+    for p in paths:
+        if pathlib.Path( p ).joinpath( relative_path ).exists():
+            return pathlib.Path( p ).joinpath( relative_path ).resolve().as_posix()
+    return None
+
+##============================================================================
+
+##
+# Create template paths with resources spread over them.
+# Returns ( template paths, resource names )
+def make_tree( root, paths, resources ):
+    template_paths = []
+    names = []
+    for p in range( paths ):
+        folder = pathlib.Path( root ) / "part_{0}".format( p ) / "shunts"
+        ( folder / "sub" ).mkdir( parents = True )
+        template_paths.append( folder.as_posix() )
+    for r in range( resources ):
+        name = "sub/res_{0}.dat".format( r )
+        ( pathlib.Path( template_paths[ r % paths ] ) / name ).write_text( "x" )
+        names.append( name )
+    return template_paths, names
+
+##
+# Returns the seconds taken resolving every name with resolve
+def time_resolve( resolve, template_paths, names ):
+    start = time.perf_counter()
+    for name in names:
+        if resolve( template_paths, name ) is None:
+            raise RuntimeError( "'{0}' not found".format( name ) )
+    return time.perf_counter() - start
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--paths', type=int, default=20 )
+    parser.add_argument( '--resources', type=int, default=5000 )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        template_paths, names = make_tree( tmp, args.paths, args.resources )
+        for name in names[:50]:
+            if legacy_resolve_path( template_paths, name ) != shunt_main.resolve_path( template_paths, name ):
+                raise RuntimeError( "resolve_path disagrees with the legacy one on '{0}'".format( name ) )
+
+        legacy = time_resolve( legacy_resolve_path, template_paths, names )
+        template_index.invalidate()
+        template_index._SCANS.clear()
+        template_index._INDEXES.clear()
+        cold = time_resolve( shunt_main.resolve_path, template_paths, names )
+        template_index.invalidate()
+        warm = time_resolve( shunt_main.resolve_path, template_paths, names )
+
+    print( "{0} template paths, {1} resources".format( args.paths, args.resources ) )
+    for label, t in ( ( "exists() probing (old)", legacy ),
+                      ( "template index, cold", cold ),
+                      ( "template index, refreshed", warm ) ):
+        print( "  {0:<30} {1:10.3f} ms {2:8.2f} us/resource".format(
+            label, t * 1e3, t / len( names ) * 1e6 ) )
+
+##============================================================================
+
+if __name__ == '__main__':
+    main()
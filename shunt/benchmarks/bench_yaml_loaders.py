@@ -0,0 +1,96 @@
+##
+# Benchmark of the YAML loaders used for Shuntfiles and hmaps.
+#
+# Generates a synthetic Shuntfile with (by default) 10k keys and
+# compares the pure-python loaders, libyaml's CSafeLoader and the
+# pickled parse cache of shunt.yamlutils.
+#
+# Usage: python benchmarks/bench_yaml_loaders.py [--keys N] [--repeat R]
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert( 0, pathlib.Path( __file__ ).resolve().parent.parent.as_posix() )
+import shunt.yamlutils as yamlutils
+
+##============================================================================
+
+##
+# Returns the text of a synthetic Shuntfile with the given number of
+# leaf keys spread over nested sections
+def synthetic_shuntfile( keys ):
+    lines = [ "project:",
+              "  views:" ]
+    lines.extend( "    - view_{0}.tf".format( i ) for i in range( max( 1, keys // 100 ) ) )
+    lines.append( "  vars:" )
+    per_section = 50
+    for i in range( keys ):
+        if i % per_section == 0:
+            lines.append( "    section_{0}:".format( i // per_section ) )
+        lines.append( "      key_{0}: \"value {0} with some text\"".format( i ) )
+    return "\n".join( lines ) + "\n"
+
+##============================================================================
+
+##
+# Returns the best wall time of repeat calls to fn
+def best_time( fn, repeat ):
+    best = None
+    for _ in range( repeat ):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--keys', type=int, default=10000 )
+    parser.add_argument( '--repeat', type=int, default=5 )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory( prefix='shunt-bench-yaml-' ) as tmp:
+        path = pathlib.Path( tmp ) / "Shuntfile"
+        path.write_text( synthetic_shuntfile( args.keys ) )
+        cache_path = ( pathlib.Path( tmp ) / "cache" ).as_posix()
+
+        def _load_with( loader ):
+            with open( path.as_posix() ) as f:
+                return yaml.load( f, Loader = loader )
+
+        cases = [
+            ( "yaml.FullLoader (old default)", lambda: _load_with( yaml.FullLoader ) ),
+            ( "yaml.SafeLoader", lambda: _load_with( yaml.SafeLoader ) ),
+        ]
+        if hasattr( yaml, 'CSafeLoader' ):
+            cases.append( ( "yaml.CSafeLoader", lambda: _load_with( yaml.CSafeLoader ) ) )
+        cases.append( ( "yamlutils.load_yaml_file", lambda: yamlutils.load_yaml_file( path.as_posix() ) ) )
+        yamlutils.load_yaml_file( path.as_posix(), cache_path = cache_path )
+        cases.append( ( "yamlutils.load_yaml_file (warm parse cache)",
+                        lambda: yamlutils.load_yaml_file( path.as_posix(), cache_path = cache_path ) ) )
+
+        reference = _load_with( yaml.SafeLoader )
+        print( "Synthetic Shuntfile: {0} keys, {1} bytes, libyaml {2}".format(
+            args.keys,
+            path.stat().st_size,
+            "available" if hasattr( yaml, 'CSafeLoader' ) else "NOT available" ) )
+        baseline = None
+        for name, fn in cases:
+            assert fn() == reference, name
+            t = best_time( fn, args.repeat )
+            if baseline is None:
+                baseline = t
+            print( "  {0:<45} {1:10.2f} ms  {2:6.1f}x".format( name, t * 1000.0, baseline / t ) )
+
+##============================================================================
+
+if __name__ == '__main__':
+    main()
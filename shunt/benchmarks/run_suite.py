@@ -0,0 +1,303 @@
+##
+# The shunt benchmark suite.
+#
+# Generates a synthetic project (see synthetic_project.py) and times
+# the main entry points on it, each case in a fresh process so its
+# peak RSS is its own:
+#   find_template_paths    : project_paths.find_all_template_paths (cold and indexed)
+#   load_shuntfiles        : shuntfile.load_shuntfile for every Shuntfile
+#   hmap                   : shunt.hmap set/get over the root 'vars' hmap
+#   materialize_cold       : materialize_views into an empty directory
+#   materialize_incremental: an incremental materialize_views with nothing changed
+#
+# Results (best wall time, peak RSS, files/sec) are written as JSON.
+# Given a baseline JSON file, cases slower (or bigger) than the
+# baseline by more than the threshold are reported as regressions and
+# the exit status is 1.
+#
+# Everything runs offline: the git template paths are local bare
+# repositories and the fetch cache lives in the work directory.
+#
+# Usage:
+#   python benchmarks/run_suite.py run [--output results.json] [--baseline base.json] [shape options]
+#   python benchmarks/run_suite.py compare base.json results.json [--threshold 0.1]
+
+import argparse
+import json
+import logging
+import pathlib
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, pathlib.Path( __file__ ).resolve().parent.parent.as_posix() )
+import synthetic_project
+
+##
+# The benchmark cases, in the order they run
+CASES = ( 'find_template_paths',
+          'load_shuntfiles',
+          'hmap',
+          'materialize_cold',
+          'materialize_incremental' )
+
+##
+# Relative increase over the baseline reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+##
+# Metrics compared against the baseline (lower is better)
+COMPARED_METRICS = ( 'wall_time', 'peak_rss_kb' )
+
+##============================================================================
+
+##
+# Returns the peak resident set size of this process in KB
+def peak_rss_kb():
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+##
+# Returns the best wall time of repeat calls to fn, calling setup
+# (untimed) before each
+def best_time( fn, repeat, setup = None ):
+    best = None
+    for _ in range( repeat ):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+##============================================================================
+
+##
+# Run a single case on a generated project, in this process.
+# Returns the result dictionary of the case
+def run_case( case, info, repeat ):
+    import shunt.shunt as shunt_main
+    import shunt.project_paths as project_paths
+    import shunt.shuntfile as shuntfile
+    import shunt.hmap as hmap
+
+    logging.disable( logging.INFO )
+    root_shuntfile = info[ 'shuntfile' ]
+    work = pathlib.Path( info[ 'root' ] )
+    fetch_cache = ( work / "fetch-cache" ).as_posix()
+    files = None
+
+    def _materialize( incremental ):
+        shunt_main.materialize_views( root_shuntfile,
+                                      incremental = incremental,
+                                      fetch_cache_path = fetch_cache,
+                                      fetch_ttl = 10 ** 9 )
+
+    def _empty_output():
+        # remove the outputs (and manifests) ourselves so runs never
+        # need terraform
+        for path in work.glob( "**/" + project_paths.MATERIALIZE_FOLDER_NAME + "*" ):
+            if path.is_dir():
+                shutil.rmtree( path.as_posix() )
+            else:
+                path.unlink()
+
+    if case == 'find_template_paths':
+        def _cold():
+            project_paths.clear_template_path_cache()
+            for path in info[ 'shuntfiles' ]:
+                project_paths.find_all_template_paths( path )
+        def _drop_index():
+            for index in work.glob( "**/" + project_paths.INDEX_FOLDER_NAME ):
+                shutil.rmtree( index.as_posix() )
+        wall_time = best_time( _cold, repeat, setup = _drop_index )
+        _cold()
+        indexed = best_time( _cold, repeat )
+        files = len( info[ 'shuntfiles' ] )
+        extra = { 'indexed_wall_time' : indexed }
+
+    elif case == 'load_shuntfiles':
+        def _load():
+            shuntfile.clear_shuntfile_cache()
+            for path in info[ 'shuntfiles' ]:
+                shuntfile.load_shuntfile( path )
+        wall_time = best_time( _load, repeat )
+        files = len( info[ 'shuntfiles' ] )
+        extra = {}
+
+    elif case == 'hmap':
+        sf = shuntfile.load_shuntfile( root_shuntfile )
+        keys = [ "vars/{0}/{1}".format( section, key )
+                 for section, values in sf.hmap.get( 'vars', {} ).items()
+                 for key in values ]
+        def _hmap():
+            m = {}
+            for key in keys:
+                hmap.hmap_set( m, key, hmap.hmap_get( sf.hmap, key, None ) )
+            for key in keys:
+                hmap.hmap_get( m, key, None )
+        wall_time = best_time( _hmap, repeat )
+        extra = { 'keys' : len( keys ) }
+
+    elif case == 'materialize_cold':
+        _empty_output()
+        _materialize( False )  # warm the fetch cache, untimed
+        wall_time = best_time( lambda: _materialize( False ), repeat, setup = _empty_output )
+        files = info[ 'views' ] + info[ 'resource_files' ]
+        extra = {}
+
+    elif case == 'materialize_incremental':
+        _empty_output()
+        _materialize( True )
+        wall_time = best_time( lambda: _materialize( True ), repeat )
+        files = info[ 'views' ] + info[ 'resource_files' ]
+        extra = {}
+
+    else:
+        raise ValueError( "Unknown benchmark case '{0}'. Known cases are {1}".format( case, CASES ) )
+
+    result = {
+        'wall_time' : wall_time,
+        'peak_rss_kb' : peak_rss_kb(),
+    }
+    if files is not None:
+        result[ 'files' ] = files
+        result[ 'files_per_sec' ] = files / wall_time if wall_time > 0 else None
+    result.update( extra )
+    return result
+
+##============================================================================
+
+##
+# Run every case (each in its own process) on a freshly generated
+# project. Returns the results document
+def run_suite( shape, cases, repeat, work_dir = None ):
+    with tempfile.TemporaryDirectory( prefix = 'shunt-bench-', dir = work_dir ) as tmp:
+        info = synthetic_project.generate_project( pathlib.Path( tmp ) / "work", shape )
+        info_path = pathlib.Path( tmp ) / "project.json"
+        info_path.write_text( json.dumps( info ) )
+
+        results = {}
+        for case in cases:
+            out = subprocess.run( [ sys.executable, __file__, '_case', case,
+                                    info_path.as_posix(), '--repeat', str( repeat ) ],
+                                  stdout = subprocess.PIPE,
+                                  check = True )
+            results[ case ] = json.loads( out.stdout.decode( 'utf-8' ) )
+            print( "  {0:<25} {1:9.4f}s {2:9d} KB{3}".format(
+                case,
+                results[ case ][ 'wall_time' ],
+                results[ case ][ 'peak_rss_kb' ],
+                "" if results[ case ].get( 'files_per_sec' ) is None else
+                "  {0:10.1f} files/s".format( results[ case ][ 'files_per_sec' ] ) ),
+                   file = sys.stderr )
+
+    return {
+        'shape' : shape,
+        'repeat' : repeat,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'views' : info[ 'views' ],
+        'resource_files' : info[ 'resource_files' ],
+        'shuntfiles' : len( info[ 'shuntfiles' ] ),
+        'results' : results,
+    }
+
+##============================================================================
+
+##
+# Compare results against a baseline.
+# Returns the list of ( case, metric, baseline, current, change )
+# regressions, change being the relative increase
+def compare( baseline, current, threshold = DEFAULT_THRESHOLD ):
+    if baseline.get( 'shape' ) != current.get( 'shape' ):
+        print( "warning: baseline and current results are for different project shapes",
+               file = sys.stderr )
+    regressions = []
+    for case, result in sorted( current[ 'results' ].items() ):
+        base = baseline[ 'results' ].get( case )
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if not base.get( metric ) or result.get( metric ) is None:
+                continue
+            change = ( result[ metric ] - base[ metric ] ) / base[ metric ]
+            flag = "REGRESSION" if change > threshold else ""
+            print( "  {0:<25} {1:<12} {2:12.4f} -> {3:12.4f} {4:+7.1%} {5}".format(
+                case, metric, base[ metric ], result[ metric ], change, flag ) )
+            if change > threshold:
+                regressions.append( ( case, metric, base[ metric ], result[ metric ], change ) )
+    return regressions
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers( dest = 'command' )
+
+    run = commands.add_parser( 'run', help = "Generate a project and run the benchmarks" )
+    run.add_argument( '--output', default = None, help = "Write the results JSON here (default stdout)" )
+    run.add_argument( '--baseline', default = None, help = "Compare against this results JSON" )
+    run.add_argument( '--threshold', type = float, default = DEFAULT_THRESHOLD )
+    run.add_argument( '--repeat', type = int, default = 3 )
+    run.add_argument( '--cases', nargs = '+', choices = CASES, default = list( CASES ) )
+    run.add_argument( '--work-dir', default = None, help = "Where the project is generated (default the temp directory)" )
+    synthetic_project.add_shape_arguments( run )
+
+    cmp = commands.add_parser( 'compare', help = "Compare two results JSON files" )
+    cmp.add_argument( 'baseline' )
+    cmp.add_argument( 'current' )
+    cmp.add_argument( '--threshold', type = float, default = DEFAULT_THRESHOLD )
+
+    case = commands.add_parser( '_case' )
+    case.add_argument( 'case', choices = CASES )
+    case.add_argument( 'project_json' )
+    case.add_argument( '--repeat', type = int, default = 3 )
+
+    args = parser.parse_args()
+
+    if args.command == '_case':
+        with open( args.project_json ) as f:
+            info = json.load( f )
+        print( json.dumps( run_case( args.case, info, args.repeat ) ) )
+        return 0
+
+    if args.command == 'compare':
+        with open( args.baseline ) as f:
+            baseline = json.load( f )
+        with open( args.current ) as f:
+            current = json.load( f )
+        return 1 if compare( baseline, current, args.threshold ) else 0
+
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    document = run_suite( synthetic_project.shape_from_arguments( args ),
+                          args.cases,
+                          args.repeat,
+                          args.work_dir )
+    text = json.dumps( document, indent = 2 )
+    if args.output is None:
+        print( text )
+    else:
+        with open( args.output, 'w' ) as f:
+            f.write( text + "\n" )
+    if args.baseline is not None:
+        with open( args.baseline ) as f:
+            baseline = json.load( f )
+        return 1 if compare( baseline, document, args.threshold ) else 0
+    return 0
+
+##============================================================================
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,258 @@
+##
+# Generator of synthetic Shunt projects for benchmarking.
+#
+# A project is a tree of Shuntfiles (depth x fanout subprojects), each
+# with its own template folders, views, resources and a 'vars' hmap.
+# Views extend a chain of layouts and include a chain of partials, so
+# template inheritance and inclusion depth can be dialled in. Remote
+# git template paths are local bare repositories (file:// urls) so
+# everything runs offline.
+#
+# Everything is derived from the shape and a seed, so the same shape
+# always gives the same project.
+#
+# Usage: python benchmarks/synthetic_project.py OUT_DIR [--depth D] [--fanout F] ...
+
+import argparse
+import json
+import pathlib
+import random
+import shutil
+import subprocess
+
+##============================================================================
+
+##
+# The shape of a synthetic project and its defaults
+DEFAULT_SHAPE = {
+    'depth' : 2,                 # levels of subprojects below the root
+    'fanout' : 3,                # subprojects per Shuntfile
+    'template_folders' : 2,      # 'shunts' folders per Shuntfile
+    'views' : 10,                # views per Shuntfile
+    'template_lines' : 50,       # lines of text per view template
+    'include_depth' : 3,         # chain of {% include %} per view
+    'extends_depth' : 3,         # chain of {% extends %} per view
+    'resources' : 5,             # resource files per Shuntfile
+    'resource_size' : 16 * 1024, # bytes per resource file
+    'resource_dirs' : 1,         # resource directories per Shuntfile
+    'resource_dir_files' : 20,   # files in each resource directory
+    'hmap_keys' : 1000,          # keys in the root Shuntfile 'vars' hmap
+    'git_repos' : 1,             # remote (local bare) git template paths
+    'seed' : 42,
+}
+
+##============================================================================
+
+##
+# Returns a complete shape from a partial one
+def make_shape( **overrides ):
+    shape = dict( DEFAULT_SHAPE )
+    for key, value in overrides.items():
+        if key not in DEFAULT_SHAPE:
+            raise ValueError( "Unknown project shape key '{0}'. Known keys are {1}".format(
+                key, sorted( DEFAULT_SHAPE ) ) )
+        if value is not None:
+            shape[ key ] = value
+    return shape
+
+##============================================================================
+
+##
+# Write a text file, creating its directory
+def _write( path, text ):
+    path.parent.mkdir( parents = True, exist_ok = True )
+    path.write_text( text )
+
+##
+# Returns the YAML text of a Shuntfile (JSON is valid YAML)
+def _shuntfile_text( project, hmap_keys ):
+    data = { 'project' : project }
+    if hmap_keys > 0:
+        per_section = 50
+        data[ 'vars' ] = {
+            "section_{0}".format( s ) : {
+                "key_{0}".format( k ) : "value {0} of section {1}".format( k, s )
+                for k in range( s * per_section, min( hmap_keys, ( s + 1 ) * per_section ) ) }
+            for s in range( ( hmap_keys + per_section - 1 ) // per_section ) }
+    return json.dumps( data, indent = 2 ) + "\n"
+
+##============================================================================
+
+##
+# Write the shared templates (layouts and partials) into a folder
+def _write_shared_templates( folder, shape ):
+    _write( folder / "layout_0.tf",
+            "# layout 0\n{% block body %}{% endblock %}\n" )
+    for d in range( 1, shape[ 'extends_depth' ] ):
+        _write( folder / "layout_{0}.tf".format( d ),
+                "{{% extends 'layout_{0}.tf' %}}\n"
+                "{{% block body %}}# layout {1}\n{{{{ super() }}}}{{% endblock %}}\n".format( d - 1, d ) )
+    for d in range( shape[ 'include_depth' ] ):
+        text = "# partial {0}\n".format( d )
+        if d + 1 < shape[ 'include_depth' ]:
+            text += "{{% include 'partial_{0}.tf' %}}\n".format( d + 1 )
+        _write( folder / "partial_{0}.tf".format( d ), text )
+
+##
+# Returns the text of a view template
+def _view_text( name, shape, git_partials ):
+    lines = []
+    if shape[ 'extends_depth' ] > 0:
+        lines.append( "{{% extends 'layout_{0}.tf' %}}".format( shape[ 'extends_depth' ] - 1 ) )
+        lines.append( "{% block body %}" )
+    lines.append( "# view {0}".format( name ) )
+    if shape[ 'include_depth' ] > 0:
+        lines.append( "{% include 'partial_0.tf' %}" )
+    for partial in git_partials:
+        lines.append( "{{% include '{0}' %}}".format( partial ) )
+    for i in range( shape[ 'template_lines' ] ):
+        lines.append( "resource \"null_resource\" \"r{0}_{{{{ {1} }}}}\" {{ }}".format( i, i ) )
+    if shape[ 'extends_depth' ] > 0:
+        lines.append( "{% endblock %}" )
+    return "\n".join( lines ) + "\n"
+
+##============================================================================
+
+##
+# Create a local bare git repository holding one partial template.
+# Returns ( file:// url, partial name )
+def _make_git_repo( remotes, index ):
+    work = remotes / "work_{0}".format( index )
+    bare = remotes / "templates_{0}.git".format( index )
+    partial = "git_partial_{0}.tf".format( index )
+    _write( work / partial, "# from git repository {0}\n".format( index ) )
+    env_args = [ '-c', 'user.name=shunt-bench', '-c', 'user.email=bench@localhost' ]
+    subprocess.run( [ 'git', 'init', '--quiet', work.as_posix() ], check = True )
+    subprocess.run( [ 'git' ] + env_args + [ 'add', '.' ], cwd = work.as_posix(), check = True )
+    subprocess.run( [ 'git' ] + env_args + [ 'commit', '--quiet', '-m', 'templates' ],
+                    cwd = work.as_posix(), check = True )
+    subprocess.run( [ 'git', 'clone', '--quiet', '--bare', work.as_posix(), bare.as_posix() ],
+                    check = True )
+    shutil.rmtree( work.as_posix() )
+    return bare.resolve().as_uri(), partial
+
+##============================================================================
+
+##
+# Generate a synthetic project in out_dir (which must not exist).
+# Returns a description of what was generated: the root Shuntfile,
+# every Shuntfile, and the counts of views and resource files
+def generate_project( out_dir, shape = None ):
+    if shape is None:
+        shape = make_shape()
+    rng = random.Random( shape[ 'seed' ] )
+    out = pathlib.Path( out_dir ).resolve()
+    if out.exists():
+        raise ValueError( "Output directory '{0}' already exists".format( out ) )
+    out.mkdir( parents = True )
+
+    # the remote template repositories
+    remotes = []
+    for i in range( shape[ 'git_repos' ] ):
+        remotes.append( _make_git_repo( out / "remotes", i ) )
+
+    shuntfiles = []
+    views = 0
+    resource_files = 0
+
+    # explicit stack of ( directory, depth, node id )
+    stack = [ ( out / "project", 0, "0" ) ]
+    while len( stack ) > 0:
+        directory, depth, node_id = stack.pop()
+
+        # template folders, the first holds the views and resources
+        folders = [ directory / "shunts" ]
+        for f in range( 1, shape[ 'template_folders' ] ):
+            folders.append( directory / "extra_{0}".format( f ) / "shunts" )
+        for folder in folders:
+            _write_shared_templates( folder, shape )
+
+        # views
+        git_partials = [ partial for _, partial in remotes ] if depth == 0 else []
+        view_names = []
+        for v in range( shape[ 'views' ] ):
+            name = "view_{0}_{1}.tf".format( node_id.replace( '.', '_' ), v )
+            _write( folders[0] / name, _view_text( name, shape, git_partials ) )
+            view_names.append( name )
+        views += len( view_names )
+
+        # resources
+        resource_names = []
+        for r in range( shape[ 'resources' ] ):
+            name = "res_{0}_{1}.dat".format( node_id.replace( '.', '_' ), r )
+            ( folders[0] / name ).write_bytes( rng.randbytes( shape[ 'resource_size' ] ) )
+            resource_names.append( name )
+        for r in range( shape[ 'resource_dirs' ] ):
+            name = "resdir_{0}_{1}".format( node_id.replace( '.', '_' ), r )
+            for k in range( shape[ 'resource_dir_files' ] ):
+                path = folders[0] / name / "sub_{0}".format( k % 4 ) / "file_{0}.dat".format( k )
+                path.parent.mkdir( parents = True, exist_ok = True )
+                path.write_bytes( rng.randbytes( shape[ 'resource_size' ] ) )
+            resource_names.append( name )
+        resource_files += shape[ 'resources' ] + shape[ 'resource_dirs' ] * shape[ 'resource_dir_files' ]
+
+        # the Shuntfile
+        children = []
+        if depth < shape[ 'depth' ]:
+            children = [ "sub_{0}".format( c ) for c in range( shape[ 'fanout' ] ) ]
+        # every Shuntfile materializes into its own directory, so no
+        # run ever has to empty a directory another one wrote to
+        project = {
+            'views' : view_names,
+            'resources' : resource_names,
+            'materialize_path' : ( directory / "materialized_views" ).as_posix(),
+        }
+        if len( children ) > 0:
+            project[ 'subprojects' ] = children
+        if depth == 0 and len( remotes ) > 0:
+            project[ 'shunt_paths' ] = [
+                { 'source' : 'git',
+                  'destination' : "templates_{0}".format( i ),
+                  'args' : [ url, "templates_{0}".format( i ) ] }
+                for i, ( url, _ ) in enumerate( remotes ) ]
+        shuntfile = directory / "Shuntfile"
+        _write( shuntfile, _shuntfile_text( project, shape[ 'hmap_keys' ] if depth == 0 else 0 ) )
+        shuntfiles.append( shuntfile.as_posix() )
+
+        for c in reversed( range( len( children ) ) ):
+            stack.append( ( directory / children[ c ], depth + 1, "{0}.{1}".format( node_id, c ) ) )
+
+    return {
+        'root' : out.as_posix(),
+        'shuntfile' : ( out / "project" / "Shuntfile" ).as_posix(),
+        'shuntfiles' : shuntfiles,
+        'views' : views,
+        'resource_files' : resource_files,
+        'shape' : shape,
+    }
+
+##============================================================================
+
+##
+# Adds one command line option per shape key to a parser
+def add_shape_arguments( parser ):
+    for key, value in DEFAULT_SHAPE.items():
+        parser.add_argument( "--" + key.replace( '_', '-' ),
+                             type = int,
+                             default = None,
+                             help = "(default {0})".format( value ) )
+
+##
+# Returns the shape given by parsed command line options
+def shape_from_arguments( args ):
+    return make_shape( **{ key : getattr( args, key ) for key in DEFAULT_SHAPE } )
+
+##============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'out_dir' )
+    add_shape_arguments( parser )
+    args = parser.parse_args()
+    info = generate_project( args.out_dir, shape_from_arguments( args ) )
+    print( json.dumps( { k : v for k, v in info.items() if k != 'shuntfiles' }, indent = 2 ) )
+
+##============================================================================
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 import logging
 logger = logging.getLogger( __name__ )
 
-from hmap import hmap_get, hmap_set, hmap_paths
-import from variables import has_free_variables
+from hmap import hmap_paths, is_fully_resolved
+
+import os
+import threading
+import concurrent.futures
 
 DIRECTIVE_PREFIX = '@'
 
@@ -55,8 +58,8 @@ def extract_directives_without_free_variables( parse_state ):
     # ok, we will go over all the possible values of
     # the hmap and parse any directives
     directives = []
-    for path, value in hmap_paths( parse_state.hmap ):
-        if is_directive( value ) and not has_free_variables( value ):
+    for path, value in hmap_paths( parse_state.hmap, leaves_only = True ):
+        if is_directive( value ) and is_fully_resolved( value ):
             directives.append( parse_directive( path, value, parse_state ) )
 
     return directives
@@ -73,35 +76,42 @@ def parse_directive( path, value, parse_state ):
     tokens = value.split(' ',1)
     directive = tokens[0][1:].lower()
 
+    from parse import line_info_message
+
     parser = parse_state.get_directive_parser( directive )
     if parser is None:
-        msg = "Cannot parse directive '{0}' at path '{1}' with value '{2}'"
-        msg.format( directive, path, value )
+        msg = "Cannot parse directive '{0}' at path '{1}' with value '{2}'".format(
+            directive, path, value )
         line_info = parse_state.get_line_info_for_path( path )
         msg += " " + line_info_message( line_info )
         logger.error( msg )
         raise RuntimeError( msg )
 
     # ok, just parse the directive value and return the parsed
-    return parser( directive, parse_state, path, tokens[1] )
+    argument = tokens[1].strip() if len( tokens ) > 1 else ''
+    return parser( directive, parse_state, path, argument )
 
 ##============================================================================
 
 ##
 # The default directive parser only knowns of one directive: include
 def _default_directive_parser( directive, parse_state, path, argument ):
+
+    # imported here since parse imports this module
+    from parse import line_info_message, check_and_parse_single_path
+
     if directive != 'include':
-        msg = "Unknown directive '{0}' at path '{1}' value '{2}'".format(
+        msg = "Unknown directive '{0}' at path '{1}' argument '{2}'".format(
             directive,
             path,
-            value )
+            argument )
         line_info = parse_state.get_line_info_for_path( path )
         msg += " " + line_info_message( line_info )
         logger.error( msg )
         raise RuntimeError( msg )
 
     # make sure our argument has no free variables
-    if has_free_variables( argument ):
+    if not is_fully_resolved( argument ):
         msg = "Unable to parse 'include' directive with free variables in argument: '{0}'".format( argument ) + line_info_message( parse_state.get_line_info_for_path( path ) )
         logger.error( msg )
         raise RuntimeError( msg )
@@ -129,7 +139,8 @@ def _default_directive_parser( directive, parse_state, path, argument ):
 # Each directive has a name and parser along with an object that is
 # a callable on Directive( parser.ParseState ) and return the new ParseState.
 #
-# The directive *may* change hte given parse_state
+# Directives do not change the given parse_state (its hmap is
+# persistent), they return a new one with the given one as parent
 class Directive( object ):
 
     ##
@@ -151,17 +162,132 @@ class IncludeDirective( Directive ):
         self.path = path
 
     ##
-    # Includes the file where the directive was
+    # Includes the file where the directive was.
+    # Returns a new parse state sharing all but the included path
+    # with the given one
     def __call__( self, parse_state ):
         logger.info( "Including file '{0}' into path '{1}'".format(
             self.filename,
             self.path ) )
-        with open( self.filename ) as f:
-            hmap_set(
-                parse_state.hmap,
-                self.path,
-                f.read() )
-        return parse_state
+        return parse_state.with_value(
+            self.path,
+            INCLUDE_CONTENT_CACHE.read( self.filename ) )
+
+##============================================================================
+
+##
+# A cache of the content of included files, keyed by resolved path
+# and checked against the file's modification time and size, so files
+# included again (from many paths, or in later parses) are not re-read
+class FileContentCache( object ):
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.reads = 0
+
+    ##
+    # Returns the content of a file, from the cache if unchanged
+    def read( self, filename ):
+        path = os.path.realpath( filename )
+        st = os.stat( path )
+        signature = ( st.st_mtime_ns, st.st_size )
+        with self.lock:
+            entry = self.entries.get( path, None )
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+        with open( path ) as f:
+            content = f.read()
+        with self.lock:
+            self.entries[ path ] = ( signature, content )
+            self.reads += 1
+        return content
+
+    ##
+    # Forget every cached file
+    def clear( self ):
+        with self.lock:
+            self.entries.clear()
+
+##
+# The content cache used by include directives
+INCLUDE_CONTENT_CACHE = FileContentCache()
+
+##
+# Maximum number of included files read at the same time
+DEFAULT_INCLUDE_WORKERS = 8
+
+##============================================================================
+
+##
+# Execute all the directives (without free variables) of a parse state
+# until none are left, returning the resulting parse state.
+#
+# Each round extracts the directives, reads every distinct included
+# file once (concurrently, through the content cache) and applies all
+# the includes to the hmap in a single pass. Other directives are then
+# applied one at a time. Included content may itself be a directive,
+# so rounds repeat until a fixpoint; a file included (directly or not)
+# into its own path is a cycle and raises RuntimeError, as does a
+# round which changes nothing
+def execute_directives( parse_state,
+                        max_workers = DEFAULT_INCLUDE_WORKERS,
+                        cache = None ):
+    if cache is None:
+        cache = INCLUDE_CONTENT_CACHE
+
+    # path -> chain of files included there so far
+    chains = {}
+    while True:
+        directives = extract_directives_without_free_variables( parse_state )
+        if len( directives ) == 0:
+            return parse_state
+        includes = [ d for d in directives if isinstance( d, IncludeDirective ) ]
+        others = [ d for d in directives if not isinstance( d, IncludeDirective ) ]
+
+        # cycles
+        for d in includes:
+            key = tuple( d.path )
+            filename = os.path.realpath( d.filename )
+            chain = chains.get( key, [] )
+            if filename in chain:
+                msg = "Include cycle detected at path '{0}': {1}".format(
+                    d.path,
+                    " -> ".join( chain + [ filename ] ) )
+                logger.error( msg )
+                raise RuntimeError( msg )
+            chains[ key ] = chain + [ filename ]
+
+        # read each distinct file once, concurrently
+        filenames = sorted( set( os.path.realpath( d.filename ) for d in includes ) )
+        contents = {}
+        if len( filenames ) == 1 or max_workers <= 1:
+            for filename in filenames:
+                contents[ filename ] = cache.read( filename )
+        elif len( filenames ) > 1:
+            workers = min( max_workers, len( filenames ) )
+            with concurrent.futures.ThreadPoolExecutor( max_workers = workers ) as executor:
+                for filename, content in zip( filenames, executor.map( cache.read, filenames ) ):
+                    contents[ filename ] = content
+        logger.info( "Including {0} distinct file(s) into {1} path(s)".format(
+            len( filenames ), len( includes ) ) )
+
+        # apply the includes in one pass, then the rest
+        previous = parse_state
+        if len( includes ) > 0:
+            parse_state = parse_state.with_values( {
+                tuple( d.path ) : contents[ os.path.realpath( d.filename ) ]
+                for d in includes } )
+        for d in others:
+            parse_state = d( parse_state )
+
+        if next( parse_state.diff( previous ), None ) is None:
+            msg = "Directives {0} did not change the hmap, unable to reach a fixpoint".format(
+                [ d.path for d in directives ] )
+            logger.error( msg )
+            raise RuntimeError( msg )
 
 ##============================================================================
 ##============================================================================
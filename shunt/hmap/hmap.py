@@ -2,12 +2,14 @@ import logging
 logger = logging.getLogger( __name__ )
 
 import copy
-import tempfile
-import os
+import functools
 
 import jinja2
+import jinja2.meta
 import yaml
 
+import shunt.yamlutils as yamlutils
+
 ##
 # Interface functions for Hiearchichal Maps (hmaps)
 # which are jsut dictionaries-of-dictionaries :)
@@ -17,6 +19,9 @@ TEMPLATE_HANDLEBAR_START = "{{"
 TEMPLATE_HANDLEBAR_END = "}}"
 JINJA_VARIABLE_KEY = "_"
 
+_SCALAR_RESOLVER = yaml.resolver.Resolver()
+_YAML_STR_TAG = "tag:yaml.org,2002:str"
+
 ##============================================================================
 
 ##
@@ -41,11 +46,60 @@ def structured_key_to_path( sk, delim='/' ):
 
 ##============================================================================
 
+##
+# A path which has already been parsed (from a structured key or a
+# list of keys) into an immutable tuple of keys.
+#
+# Structured keys are compiled once and cached (see compile_path) so
+# hot lookups do not re-split and re-parse them on every call
+class CompiledPath( object ):
+    __slots__ = ( 'keys', )
+
+    def __init__( self, keys ):
+        self.keys = tuple( keys )
+
+    def __len__( self ):
+        return len( self.keys )
+
+    def __repr__( self ):
+        return "CompiledPath( {0} )".format( list( self.keys ) )
+
+##
+# The number of compiled structured keys remembered
+COMPILED_PATH_CACHE_SIZE = 4096
+
+@functools.lru_cache( maxsize = COMPILED_PATH_CACHE_SIZE )
+def _compile_structured_key( sk, delim ):
+    return CompiledPath( structured_key_to_path( sk, delim=delim ) )
+
+@functools.lru_cache( maxsize = COMPILED_PATH_CACHE_SIZE )
+def _compile_keys( keys ):
+    return CompiledPath( keys )
+
+##
+# Returns the CompiledPath for a structured key, list of keys or
+# CompiledPath. Structured keys (and tuples) are cached
+def compile_path( sk_or_path, delim='/' ):
+    if isinstance( sk_or_path, CompiledPath ):
+        return sk_or_path
+    if isinstance( sk_or_path, str ):
+        return _compile_structured_key( sk_or_path, delim )
+    if isinstance( sk_or_path, tuple ):
+        try:
+            return _compile_keys( sk_or_path )
+        except TypeError:
+            return CompiledPath( sk_or_path )
+    return CompiledPath( sk_or_path )
+
+##============================================================================
+
 ##
 # Take a path of a structured key and return a path
 def ensure_path( sk_or_path, delim='/' ):
     if isinstance( sk_or_path, str ):
         return structured_key_to_path( sk_or_path, delim=delim )
+    if isinstance( sk_or_path, CompiledPath ):
+        return list( sk_or_path.keys )
     return sk_or_path
 
 ##============================================================================
@@ -58,28 +112,53 @@ def ensure_path( sk_or_path, delim='/' ):
 #
 # This will *change* the given hmap (potentially) since it will
 # *create* the hmap structure down the path if it was not
-# previously created in the hmap
+# previously created in the hmap. Use hmap_lookup to only read.
 def hmap_probe( hmap, path ):
-    path = ensure_path( path )
-    if path is None or hmap is None or len(path) < 1:
+    if path is None or hmap is None:
         return None, None
-    if len(path) == 1:
-        return hmap, path[0]
-    if path[0] not in hmap:
-        hmap[ path[0] ] = {}
-    return hmap_probe( hmap[ path[0] ], path[1:] )
+    keys = compile_path( path ).keys
+    if len( keys ) < 1:
+        return None, None
+    node = hmap
+    for key in keys[:-1]:
+        if key not in node:
+            node[ key ] = {}
+        node = node[ key ]
+    return node, keys[-1]
+
+##============================================================================
+
+##
+# Returns the value at a path in an hmap, or the given default if
+# there is no such path.
+# This never changes the hmap and walks the path iteratively
+def hmap_lookup( hmap, path, default ):
+    if path is None or hmap is None:
+        return default
+    keys = compile_path( path ).keys
+    if len( keys ) < 1:
+        return default
+    node = hmap
+    for key in keys:
+        if isinstance( node, dict ):
+            if key not in node:
+                return default
+        elif isinstance( node, list ) and isinstance( key, int ):
+            if key < 0 or key >= len( node ):
+                return default
+        else:
+            return default
+        node = node[ key ]
+    return node
 
 ##============================================================================
 
 ##
 # Get the value for a path from an hmap
 # Or returns the given default value.
-# This may change the given hmap by probing it.
+# This does *not* change the given hmap
 def hmap_get( hmap, path, default ):
-    node, key = hmap_probe( hmap, path )
-    if node is None or key not in node:
-        return default
-    return node[ key ]
+    return hmap_lookup( hmap, path, default )
 
 ##============================================================================
 
@@ -100,10 +179,51 @@ def hmap_set( hmap, path, value ):
 ##
 # returns true if the given path has a set value in the given hmap
 def hmap_has_path( hmap, path ):
-    node, key = hmap_probe( hmap_probe, path )
-    return node is not None and key in node
+    missing = object()
+    return hmap_lookup( hmap, path, missing ) is not missing
 
 
+##============================================================================
+
+##
+# Iterate over the nodes of an hmap (dicts and lists, nested), yielding
+# ( path, value ) pairs in depth-first order, where path is the tuple
+# of keys (list indices for lists) from the root to value.
+#
+# The walk uses an explicit stack of iterators, so memory is bounded by
+# the depth of the hmap and not its size. The path tuple of a node is
+# built once and shared as the prefix of all of its children's paths.
+#
+# If prune( path, value ) returns true for a node, neither it nor
+# anything below it is yielded.
+# With leaves_only, only non-container values are yielded.
+def hmap_paths( hmap, prune = None, leaves_only = False ):
+    if not isinstance( hmap, ( dict, list, tuple ) ):
+        return
+    stack = [ ( (), _child_items( hmap ) ) ]
+    while len( stack ) > 0:
+        prefix, items = stack[-1]
+        item = next( items, None )
+        if item is None:
+            stack.pop()
+            continue
+        key, value = item
+        path = prefix + ( key, )
+        if prune is not None and prune( path, value ):
+            continue
+        is_container = isinstance( value, ( dict, list, tuple ) )
+        if not is_container or not leaves_only:
+            yield path, value
+        if is_container:
+            stack.append( ( path, _child_items( value ) ) )
+
+##
+# Returns an iterator over the ( key, value ) children of a container
+def _child_items( x ):
+    if isinstance( x, dict ):
+        return iter( x.items() )
+    return enumerate( x )
+
 ##============================================================================
 ##============================================================================
 
@@ -112,11 +232,13 @@ def hmap_has_path( hmap, path ):
 # returns a new hmap which has the structured keys resolves into
 # an actual structure in the hmap (so not more keys are strucutred-keys)
 #
-# The resulting hmap *may* share structure with the input hmap
+# The resulting hmap shares every subtree without structured keys
+# with the input hmap (and is the input hmap if it has none)
 def resolve_structured_keys( hmap, delim='/' ):
 
     # ok, create a new dict as the base
     base = {}
+    changed = False
 
     # now, let's check each key of the given hmap
     # and resolve if it is a strucutred key, otherwise
@@ -125,7 +247,9 @@ def resolve_structured_keys( hmap, delim='/' ):
 
         # recurse to value irregardless of key if it is an hmap node
         if isinstance( value, dict ):
-            value = resolve_structured_keys( value, delim=delim )
+            resolved = resolve_structured_keys( value, delim=delim )
+            changed = changed or resolved is not value
+            value = resolved
 
         # nothing to resolve for this key, jsut use hte value
         if not is_structured_key( key ):
@@ -133,6 +257,7 @@ def resolve_structured_keys( hmap, delim='/' ):
         else:
 
             # resolve the key
+            changed = True
             path = ensure_path( key )
             temp_map = base
             for p in path[:-1]:
@@ -142,7 +267,10 @@ def resolve_structured_keys( hmap, delim='/' ):
             # ok, last part of path gets the value
             temp_map[path[-1]] = value
 
-    # return the resolved map
+    # return the resolved map, or the given one if nothing in it
+    # needed resolving
+    if not changed:
+        return hmap
     return base
 
 ##============================================================================
@@ -150,15 +278,24 @@ def resolve_structured_keys( hmap, delim='/' ):
 ##============================================================================
 
 ##
-# Returns true iff the given object does not have any free variables
-# (which are template {{ }} handlebar slots) in it
-def has_free_variables( x ):
-    if isinstance( x, (list,tuple) ):
-        return not any( has_free_variables, x )
-    if isinstance( x, dict ):
-        return not any( has_free_variables, x.items() )
+# Returns true iff the given object is fully resolved: it does not
+# have any free variables (which are template {{ }} handlebar slots)
+# in it, neither in keys nor in values
+def is_fully_resolved( x ):
+    if not isinstance( x, ( dict, list, tuple ) ):
+        return not _is_template_string( x )
+    for path, value in hmap_paths( x ):
+        if _is_template_string( path[-1] ):
+            return False
+        if not isinstance( value, ( dict, list, tuple ) ) and _is_template_string( value ):
+            return False
+    return True
+
+##
+# Returns true iff the string form of x has template handlebars in it
+def _is_template_string( x ):
     s = str(x)
-    return TEMPLATE_HANDLEBAR_START not in s and TEMPLATE_HANDLEBAR_END not in s
+    return TEMPLATE_HANDLEBAR_START in s or TEMPLATE_HANDLEBAR_END in s
 
 ##============================================================================
 ##============================================================================
@@ -178,42 +315,80 @@ def has_free_variables( x ):
 # This does a global resolve on all the free variables since
 # the templates are treated globally
 #
+# The hmap is walked in the order of its YAML dump (sorted keys) and
+# every string holding template code is rendered on its own against
+# the variables set so far by 'vars' blocks, just as if the whole
+# dumped document were rendered as a single template and re-parsed.
+# Only branches with rendered strings are rebuilt, the rest is shared
+# with the given hmap.
+#
 # Returns a new parse state with given parse state as parent
 def resolve_free_variables( parse_state, template_context ):
 
-    # first, translate any variable blocks into jinja set statements
-    # for use within the hmap
-    hmap_with_jinja_vars = add_jinja_variable_nodes( parse_state.hmap, template_context )
-
-    # write out the resulting hmap's YAML
-    with tempfile.NamedTemporaryFile( mode='w', prefix='shunt-pre-resolve_') as f:
-        f.write( yaml.dump( hmap_with_jinja_vars ) )
-        f.flush()
-        logger.info( "dumping pre-resolve into '{0}'".format( f.name ) )
-
-        # ok, load in the jinja template
-        template, render_context = template_context.load_intermediate_template( f.name )
-
-        # now render the template
-        template_string = template.render(render_context)
-        opened_file = None
-        with open( f.name + ".rendered", 'w' ) as wf:
-            opened_file = f.name + ".rendered"
-            wf.write( template_string )
-            
-        
-        # ok, repase the resulting yaml
-        try:
-            new_parse_state = parse_yaml( opened_file, parent=parse_state )
-        except Exception as e:
-            msg = "Unable to re-load rendered template as YAML. Rendering at '{0}'".format( opened_file )
-            raise RuntimeError( msg ) from e
+    # imported here since parse imports this module
+    import parse
 
-        # ok, remove rendered temporary file
-        os.remove( opened_file )
+    context = dict( template_context.context )
+    new_hmap, _ = _resolve_node( parse_state.hmap, template_context, context )
+    return parse.ParseState( new_hmap, parent = parse_state )
 
-        # return the resulting parse
-        return new_parse_state
+##============================================================================
+
+##
+# Returns the keys of a dictionary in YAML dump order (sorted when
+# the keys can be sorted)
+def _dump_order( keys ):
+    try:
+        return sorted( keys )
+    except TypeError:
+        return list( keys )
+
+##
+# Resolve the free variables of a node given the variables set so far
+# (which get updated by any 'vars' blocks inside the node).
+# Returns the resolved node and whether it differs from the given one
+def _resolve_node( x, template_context, context ):
+
+    if isinstance( x, str ):
+        if not template_context.is_template_string( x ):
+            return x, False
+        return template_context.render_scalar( x, context ), True
+
+    if isinstance( x, ( list, tuple ) ):
+        resolved = []
+        changed = False
+        for value in x:
+            value, value_changed = _resolve_node( value, template_context, context )
+            resolved.append( value )
+            changed = changed or value_changed
+        if not changed:
+            return x, False
+        return type(x)( resolved ), True
+
+    if not isinstance( x, dict ):
+        return x, False
+
+    # the variables of a 'vars' block are set where the JINJA_VARIABLE_KEY
+    # would appear in the dump, and that key itself renders empty
+    keys = list( x.keys() )
+    if 'vars' in x and JINJA_VARIABLE_KEY not in x:
+        keys.append( JINJA_VARIABLE_KEY )
+    resolved = {}
+    changed = False
+    for key in _dump_order( keys ):
+        if key == JINJA_VARIABLE_KEY and 'vars' in x:
+            for ( name, value ) in x['vars'].items():
+                context[ str( discard_handlebars( name ) ).strip() ] = str( discard_handlebars( value ) )
+            resolved[ key ] = ''
+            changed = True
+            continue
+        new_key, key_changed = _resolve_node( key, template_context, context )
+        value, value_changed = _resolve_node( x[ key ], template_context, context )
+        resolved[ new_key ] = value
+        changed = changed or key_changed or value_changed
+    if not changed:
+        return x, False
+    return resolved, True
 
 ##============================================================================
 ##============================================================================
@@ -230,7 +405,10 @@ def add_jinja_variable_nodes( hmap, template_context ):
 
         # lists and tuples and just recursed over each element :)
         if isinstance( hmap, (list,tuple) ):
-            return type(hmap)( map( lambda x: add_jinja_variable_nodes(x,template_context), hmap ) )
+            elements = [ add_jinja_variable_nodes(x,template_context) for x in hmap ]
+            if all( a is b for a, b in zip( elements, hmap ) ):
+                return hmap
+            return type(hmap)( elements )
 
         # everything else is an atom and cannot have vars 
         return hmap
@@ -254,12 +432,17 @@ def add_jinja_variable_nodes( hmap, template_context ):
         new_hmap[ JINJA_VARIABLE_KEY ] = "\n".join( jinja_sets )
 
     # recurse to children
+    changed = 'vars' in hmap
     for (key, value) in hmap.items():
         if key == 'vars':
             continue
         new_hmap[ key ] = add_jinja_variable_nodes( value, template_context )
+        changed = changed or new_hmap[ key ] is not value
 
-    # return new structure
+    # return new structure, or the given one if there were no
+    # variables anywhere in it
+    if not changed:
+        return hmap
     return new_hmap
         
 
@@ -307,6 +490,56 @@ class TemplateContext( object ):
             self.context = {}
         else:
             self.context = context
+        self._scalar_cache = {}
+        self._variables_cache = {}
+
+    ##
+    # Returns true iff the given string has any template code in it
+    def is_template_string( self, x ):
+        env = self.environment
+        return ( env.variable_start_string in x
+                 or env.block_start_string in x
+                 or env.comment_start_string in x )
+
+    ##
+    # Returns the compiled template for a string along with whether the
+    # string would be dumped as a plain (unquoted) YAML scalar.
+    # Each distinct string is compiled only once
+    def compile_scalar( self, source ):
+        compiled = self._scalar_cache.get( source, None )
+        if compiled is None:
+            template = self.environment.from_string( source )
+            dumped = yaml.dump( source, Dumper = yaml.SafeDumper )
+            plain = dumped[:1] not in ( '"', "'", '|', '>' )
+            compiled = ( template, plain )
+            self._scalar_cache[ source ] = compiled
+        return compiled
+
+    ##
+    # Returns the set of variables a string with template code in it
+    # references (and does not set itself).
+    # Each distinct string is analysed only once
+    def scalar_variables( self, source ):
+        names = self._variables_cache.get( source, None )
+        if names is None:
+            ast = self.environment.parse( source )
+            names = frozenset( jinja2.meta.find_undeclared_variables( ast ) )
+            self._variables_cache[ source ] = names
+        return names
+
+    ##
+    # Render a string with template code in it against the given
+    # variables (on top of the context of this template context).
+    # Results of plain YAML scalars get the type YAML would give them
+    # (so '{{ x }}0' may become a number) while quoted ones stay strings
+    def render_scalar( self, source, variables ):
+        template, plain = self.compile_scalar( source )
+        result = template.render( variables )
+        if plain:
+            tag = _SCALAR_RESOLVER.resolve( yaml.ScalarNode, result, ( True, False ) )
+            if tag != _YAML_STR_TAG:
+                return yamlutils.load_yaml_string( result )
+        return result
 
     ##
     #
@@ -1,9 +1,15 @@
 import logging
 logger = logging.getLogger( __name__ )
 
-from hmap import hmap_get, hmap_set
+from hmap import hmap_get, hmap_set, ensure_path
+from persistent import PersistentHmap, path_copy, hmap_diff, thawed_data
 import directives
 
+import shunt.yamlutils as yamlutils
+
+import array
+import bisect
+
 import yaml
 
 ##============================================================================
@@ -18,7 +24,7 @@ class ParseState( object ):
 
     ##
     # The default directive parser
-    DEFAULT_DIRECTIVE_PARSER = directives._default_directive_parser
+    DEFAULT_DIRECTIVE_PARSER = staticmethod( directives._default_directive_parser )
 
     ##
     # Create a new parse state
@@ -27,7 +33,7 @@ class ParseState( object ):
                   line_info = None,
                   parent = None,
                   directive_parsers = None):
-        self.hmap = hmap
+        self.tree = PersistentHmap.freeze( hmap )
         self.line_info = line_info
         self.parent = parent
         self.directive_parsers = directive_parsers
@@ -35,11 +41,45 @@ class ParseState( object ):
             self.directive_parsers = {}
             directives.fill_known_directive_parsers( self.directive_parsers )
 
+    ##
+    # The (plain, read-only) hmap of this state. It shares every
+    # subtree not changed since the parent state with the parent's hmap.
+    # Documents whose top level is not a mapping (a list, a scalar,
+    # None for empty ones) are kept as they are
+    @property
+    def hmap( self ):
+        return thawed_data( self.tree )
+
+    ##
+    # Returns a new parse state, with this one as parent, where the
+    # given path of the hmap has the given value.
+    # Only the path is copied, the rest is shared with this state
+    def with_value( self, path, value ):
+        return self.with_values( { tuple( ensure_path( path ) ) : value } )
+
+    ##
+    # Returns a new parse state, with this one as parent, where the
+    # given paths (a dictionary from paths to values) are set
+    def with_values( self, updates ):
+        return ParseState(
+            path_copy( self.hmap, updates ),
+            line_info = self.line_info,
+            parent = self,
+            directive_parsers = self.directive_parsers )
+
+    ##
+    # Iterate over the ( path, old, new ) differences between another
+    # parse state and this one
+    def diff( self, other ):
+        return hmap_diff( other.hmap, self.hmap )
+
     ##
     # returns hte line information for a path if any or None
     def get_line_info_for_path( self, path ):
         if self.line_info is None:
             return None
+        if isinstance( self.line_info, LineIndex ):
+            return self.line_info.lookup( path )
         return hmap_get( self.line_info, path, None )
         
 
@@ -49,6 +89,7 @@ class ParseState( object ):
         parser = self.directive_parsers.get( directive, default )
         if default is None and parser is None:
             return self.DEFAULT_DIRECTIVE_PARSER
+        return parser
 
 
 ##============================================================================
@@ -73,6 +114,176 @@ class LineInformation( object ):
 
 ##============================================================================
 
+##
+# A compact index of the line information of every node of a parsed
+# YAML document, built in one pass over the composed node tree.
+#
+# Rather than a parallel hmap of LineInformation objects (or any
+# per-node path), every node is a row of parallel arrays. Keys are
+# interned once in a key table (tagged with their type, so 1 and '1'
+# differ), and each row stores the id of its parent row and of its
+# key as a single 64 bit ( parent * number of keys + key ) id. Rows
+# are numbered breadth first with the children of a node in key id
+# order, so those ids are sorted and finding a path is one binary
+# search per key of the path, from the root down. With the marks in
+# array('I') columns that is about 32 bytes per node, and the
+# LineInformation is only created on lookup.
+#
+# The index is cached with the parse as plain data (see parse_yaml).
+#
+# Lines and columns are 1-based, offsets are 0-based stream offsets
+class LineIndex( object ):
+    __slots__ = ( 'keys', 'key_ids', 'child_ids',
+                  'start_line', 'stop_line',
+                  'start_column', 'stop_column',
+                  'start_offset', 'stop_offset' )
+
+    ##
+    # Bumped whenever what the index holds changes, so cached indexes
+    # are not reused
+    VERSION = 3
+
+    def __init__( self ):
+        self.keys = []
+        self.key_ids = {}
+        self.child_ids = array.array( 'q' )
+        self.start_line = array.array( 'I' )
+        self.stop_line = array.array( 'I' )
+        self.start_column = array.array( 'I' )
+        self.stop_column = array.array( 'I' )
+        self.start_offset = array.array( 'I' )
+        self.stop_offset = array.array( 'I' )
+
+    def __len__( self ):
+        return len( self.child_ids )
+
+    ##
+    # Returns the whole index as plain data (builtin types and arrays
+    # only) and back, which is what the parse cache keeps
+    def state( self ):
+        return ( self.keys,
+                 self.child_ids,
+                 self.start_line, self.stop_line,
+                 self.start_column, self.stop_column,
+                 self.start_offset, self.stop_offset )
+
+    @classmethod
+    def from_state( cls, state ):
+        index = cls()
+        ( index.keys,
+          index.child_ids,
+          index.start_line, index.stop_line,
+          index.start_column, index.stop_column,
+          index.start_offset, index.stop_offset ) = state
+        index.key_ids = { key : i for i, key in enumerate( index.keys ) }
+        return index
+
+    ##
+    # Build the index for a composed YAML node tree (the root node
+    # of the document, as yamlutils.compose_yaml_file returns).
+    # Mapping keys which are not scalars are not indexed
+    @classmethod
+    def from_node( cls, root ):
+        index = cls()
+        constructor = yaml.constructor.SafeConstructor()
+
+        # intern the keys while collecting the children of every node
+        nodes = [ root ]
+        children = [ [] ]
+        stack = [ 0 ]
+        while len( stack ) > 0:
+            n = stack.pop()
+            node = nodes[ n ]
+            if isinstance( node, yaml.MappingNode ):
+                items = []
+                for key_node, value_node in node.value:
+                    if not isinstance( key_node, yaml.ScalarNode ):
+                        continue
+                    items.append( ( constructor.construct_object( key_node, deep = True ),
+                                    value_node ) )
+            elif isinstance( node, yaml.SequenceNode ):
+                items = list( enumerate( node.value ) )
+            else:
+                continue
+            for key, value_node in items:
+                key_id = index._intern( key )
+                children[ n ].append( ( key_id, len( nodes ) ) )
+                nodes.append( value_node )
+                children.append( [] )
+                stack.append( len( nodes ) - 1 )
+
+        # and number the rows breadth first, children in key id order
+        # (a later duplicate key wins, as when constructing the data)
+        number_of_keys = max( 1, len( index.keys ) )
+        columns = ( index.start_line, index.stop_line,
+                    index.start_column, index.stop_column,
+                    index.start_offset, index.stop_offset )
+        queue = [ ( -1, 0 ) ]
+        row = 0
+        while row < len( queue ):
+            child_id, n = queue[ row ]
+            node = nodes[ n ]
+            index.child_ids.append( child_id )
+            for column, value in zip( columns,
+                                      ( node.start_mark.line + 1,
+                                        node.end_mark.line + 1,
+                                        node.start_mark.column + 1,
+                                        node.end_mark.column + 1,
+                                        node.start_mark.index,
+                                        node.end_mark.index ) ):
+                column.append( value )
+            last = dict( children[ n ] )
+            for key_id in sorted( last ):
+                queue.append( ( row * number_of_keys + key_id, last[ key_id ] ) )
+            row += 1
+        return index
+
+    ##
+    # Returns the id of a key, adding it to the key table if new
+    def _intern( self, key ):
+        tagged = _tagged_key( key )
+        key_id = self.key_ids.get( tagged, None )
+        if key_id is None:
+            key_id = len( self.keys )
+            self.keys.append( tagged )
+            self.key_ids[ tagged ] = key_id
+        return key_id
+
+    ##
+    # Returns the LineInformation for a path (structured key or list
+    # of keys) or None if the path is not in the index
+    def lookup( self, path ):
+        if len( self.child_ids ) == 0:
+            return None
+        number_of_keys = max( 1, len( self.keys ) )
+        row = 0
+        for key in ensure_path( path ):
+            try:
+                key_id = self.key_ids.get( _tagged_key( key ), None )
+            except TypeError:
+                # unhashable keys are never in the index
+                return None
+            if key_id is None:
+                return None
+            child_id = row * number_of_keys + key_id
+            row = bisect.bisect_left( self.child_ids, child_id, row + 1 )
+            if row == len( self.child_ids ) or self.child_ids[ row ] != child_id:
+                return None
+        return LineInformation(
+            self.start_line[ row ],
+            self.stop_line[ row ],
+            self.start_column[ row ],
+            self.stop_column[ row ],
+            self.start_offset[ row ],
+            self.stop_offset[ row ] )
+
+##
+# Returns a key of a LineIndex, tagged with its type
+def _tagged_key( key ):
+    return ( type( key ).__name__, key )
+
+##============================================================================
+
 ##
 # Returns a human readable message for hte line information given.
 # If given a None will return "<no_line_info>" so is safe to
@@ -112,11 +323,34 @@ def check_and_parse_single_path( x, parse_state, path ):
 
 ##============================================================================
 
-def parse_yaml( filename, parent=None ):
-    with open(filename) as f:
+##
+# Parse a YAML file into a new ParseState.
+# With line_info, the state also gets a LineIndex of the file so
+# errors can point at their lines. Either way the parse (with its
+# index) goes through the YAML parse cache (see yamlutils)
+def parse_yaml( filename, parent=None, line_info=False ):
+    if not line_info:
         return ParseState(
-            yaml.load(f),
+            yamlutils.load_yaml_file( filename ),
             parent = parent )
+    data, state = yamlutils.load_composed_yaml_file(
+        filename,
+        _data_and_line_index_state,
+        "LineIndex:{0}".format( LineIndex.VERSION ) )
+    index = None
+    if state is not None:
+        index = LineIndex.from_state( state )
+    return ParseState(
+        data,
+        line_info = index,
+        parent = parent )
+
+##
+# Returns ( data, LineIndex state or None ) for a composed YAML document
+def _data_and_line_index_state( data, root ):
+    if root is None:
+        return data, None
+    return data, LineIndex.from_node( root ).state()
 
 ##============================================================================
 ##============================================================================
@@ -0,0 +1,217 @@
+import logging
+logger = logging.getLogger( __name__ )
+
+import collections.abc
+import copy
+
+from hmap import compile_path, hmap_lookup
+
+##============================================================================
+
+##
+# Marker for a missing value (in diffs) and for deleting a path
+# (in path_copy updates)
+MISSING = object()
+
+##============================================================================
+
+##
+# Returns a copy of a plain hmap with the values at the given paths
+# (a dictionary from paths to values) replaced. A value of MISSING
+# deletes the path instead.
+#
+# Only the dicts and lists along those paths are copied (and missing
+# intermediate dicts created), everything else is shared with the
+# given hmap, so an update costs O(depth) containers.
+# The given hmap is never changed
+def path_copy( hmap, updates ):
+    if len( updates ) == 0:
+        return hmap
+    fresh = set()
+
+    def _copy( x ):
+        c = dict( x ) if isinstance( x, dict ) else list( x )
+        fresh.add( id( c ) )
+        return c
+
+    root = _copy( hmap )
+    for path, value in updates.items():
+        keys = compile_path( path ).keys
+        if len( keys ) < 1:
+            raise ValueError( "Cannot update an hmap at an empty path" )
+        node = root
+        for key in keys[:-1]:
+            if isinstance( node, dict ) and key not in node:
+                child = {}
+                fresh.add( id( child ) )
+            else:
+                child = node[ key ]
+                if id( child ) not in fresh:
+                    child = _copy( child )
+            node[ key ] = child
+            node = child
+        if isinstance( value, PersistentHmap ):
+            value = value.data
+        if value is MISSING:
+            if isinstance( node, dict ):
+                node.pop( keys[-1], None )
+            else:
+                del node[ keys[-1] ]
+        else:
+            node[ keys[-1] ] = value
+    return root
+
+##============================================================================
+
+##
+# Iterate over the differences between two plain hmaps, yielding
+# ( path, old, new ) for every leaf (or whole subtree) that differs,
+# with MISSING for paths only on one side.
+# Subtrees shared by both (the same object) are skipped without
+# looking inside, so diffing two versions of a persistent hmap costs
+# only as much as what was changed
+def hmap_diff( old, new ):
+    stack = [ ( (), old, new ) ]
+    while len( stack ) > 0:
+        path, a, b = stack.pop()
+        if a is b:
+            continue
+        if isinstance( a, dict ) and isinstance( b, dict ):
+            keys = list( a ) + [ key for key in b if key not in a ]
+            for key in reversed( keys ):
+                stack.append( ( path + ( key, ), a.get( key, MISSING ), b.get( key, MISSING ) ) )
+        elif isinstance( a, list ) and isinstance( b, list ) and len( a ) == len( b ):
+            for index in reversed( range( len( a ) ) ):
+                stack.append( ( path + ( index, ), a[ index ], b[ index ] ) )
+        elif a != b:
+            yield path, a, b
+
+##============================================================================
+
+##
+# An immutable hmap.
+#
+# A PersistentHmap holds a plain hmap (dicts and lists) which it never
+# changes and which nobody else may change. Updates (set_in,
+# delete_in, update_in) return a new PersistentHmap sharing every
+# untouched subtree with this one, so keeping every version of an
+# hmap around (as ParseState parent chains do) costs only the
+# changed paths, snapshots are free and diffs are cheap.
+#
+# Freezing a plain hmap adopts it without copying, and the plain hmap
+# is available as .data for all the hmap functions, so conversions
+# both ways are lazy. Reading through the Mapping interface wraps dict
+# children on access (and gives lists as tuples).
+class PersistentHmap( collections.abc.Mapping ):
+    __slots__ = ( '_data', )
+
+    ##
+    # Create a persistent hmap owning the given plain dict.
+    # The dict must not be changed afterwards
+    def __init__( self, data = None ):
+        if data is None:
+            data = {}
+        if not isinstance( data, dict ):
+            msg = "A PersistentHmap must hold a dict, got type={0}".format( type( data ) )
+            raise ValueError( msg )
+        self._data = data
+
+    ##
+    # Returns a PersistentHmap for a plain hmap dict (adopted, not
+    # copied), the given PersistentHmap itself, or any other value
+    # (a list, a scalar, None) as it is
+    @classmethod
+    def freeze( cls, x ):
+        if isinstance( x, PersistentHmap ) or not isinstance( x, dict ):
+            return x
+        return cls( x )
+
+    ##
+    # The plain hmap (read-only)
+    @property
+    def data( self ):
+        return self._data
+
+    def __getitem__( self, key ):
+        return _wrap( self._data[ key ] )
+
+    def __iter__( self ):
+        return iter( self._data )
+
+    def __len__( self ):
+        return len( self._data )
+
+    def __repr__( self ):
+        return "PersistentHmap( {0} )".format( self._data )
+
+    def __eq__( self, other ):
+        if isinstance( other, PersistentHmap ):
+            other = other.data
+        if self._data is other:
+            return True
+        if not isinstance( other, dict ):
+            return NotImplemented
+        return self._data == other
+
+    __hash__ = None
+
+    ##
+    # Returns the value at a path, or default
+    def get_in( self, path, default = None ):
+        missing = object()
+        value = hmap_lookup( self._data, path, missing )
+        if value is missing:
+            return default
+        return _wrap( value )
+
+    ##
+    # Returns a new hmap with the value at path set (creating
+    # intermediate dicts as needed)
+    def set_in( self, path, value ):
+        return PersistentHmap( path_copy( self._data, { path : value } ) )
+
+    ##
+    # Returns a new hmap without the given path
+    def delete_in( self, path ):
+        return PersistentHmap( path_copy( self._data, { path : MISSING } ) )
+
+    ##
+    # Returns a new hmap with several paths set at once (a dictionary
+    # from paths to values, MISSING to delete)
+    def update_in( self, updates ):
+        return PersistentHmap( path_copy( self._data, updates ) )
+
+    ##
+    # Iterate over the ( path, old, new ) differences from another
+    # hmap (persistent or plain) to this one
+    def diff( self, other ):
+        if isinstance( other, PersistentHmap ):
+            other = other.data
+        return hmap_diff( other, self._data )
+
+    ##
+    # Returns a mutable deep copy as a plain hmap
+    def thaw( self ):
+        return copy.deepcopy( self._data )
+
+##============================================================================
+
+##
+# Returns the plain value of a frozen value (see PersistentHmap.freeze)
+def thawed_data( x ):
+    if isinstance( x, PersistentHmap ):
+        return x.data
+    return x
+
+##
+# Wraps a plain hmap value for reading through a PersistentHmap
+def _wrap( x ):
+    if isinstance( x, dict ):
+        return PersistentHmap( x )
+    if isinstance( x, list ):
+        return tuple( _wrap( v ) for v in x )
+    return x
+
+##============================================================================
+##============================================================================
+##============================================================================
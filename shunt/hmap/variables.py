@@ -0,0 +1,218 @@
+import logging
+logger = logging.getLogger( __name__ )
+
+from hmap import hmap_paths, discard_handlebars, DEFAULT_TEMPLATE_CONTEXT
+from persistent import path_copy
+import parse
+
+##============================================================================
+
+##
+# The key of the variable blocks in an hmap
+VARS_KEY = 'vars'
+
+##============================================================================
+
+##
+# The dependency graph between the variables of an hmap (set in 'vars'
+# blocks) and the strings with template code in it.
+#
+# Variables are global, and when a variable is set in more than one
+# 'vars' block the last one in the document wins. A variable value
+# may itself use other variables ( b: "{{ a }}-suffix" ), so variables
+# are resolved in topological order, and cycles are an error.
+# Variables used but not set anywhere come from the context of the
+# template context (or are undefined); those can be overridden with
+# update_variable too.
+#
+# Once resolved, changing a variable (update_variable) only re-renders
+# the variables and strings depending on it. The resolved hmap is
+# never changed in place: updates rebuild the touched branches and
+# share everything else with the previous resolved hmap.
+class VariableGraph( object ):
+
+    ##
+    # Build the graph for an hmap and resolve it
+    def __init__( self, hmap, template_context = None ):
+        if template_context is None:
+            template_context = DEFAULT_TEMPLATE_CONTEXT
+        self.hmap = hmap
+        self.template_context = template_context
+
+        # name -> ( path of definition, raw value )
+        self.definitions = {}
+
+        # path -> string with template code, for every such leaf
+        self.templates = {}
+
+        for path, value in hmap_paths( hmap ):
+            if path[-1] == VARS_KEY and isinstance( value, dict ):
+                for key, raw in value.items():
+                    name = str( discard_handlebars( key ) ).strip()
+                    self.definitions[ name ] = ( path + ( key, ), raw )
+            elif isinstance( value, str ) and template_context.is_template_string( value ):
+                self.templates[ path ] = value
+
+        # context variable name -> value set with update_variable
+        self.context_overrides = {}
+
+        self._link()
+        self.values = {}
+        self.resolved = hmap
+        self.resolve()
+
+    ##
+    # Computes the dependencies (and dependents) of every variable and
+    # template leaf, and the topological order of the variables.
+    # Dependents are recorded for every name referenced, context
+    # variables included, while only variables set in 'vars' blocks
+    # take part in the ordering.
+    # Raises RuntimeError if the variables depend on each other in a cycle
+    def _link( self ):
+        self.variable_dependencies = {}
+        self.variable_dependents = {}
+        self.leaf_dependents = {}
+        for name, ( _, raw ) in self.definitions.items():
+            references = self._references( raw )
+            self.variable_dependencies[ name ] = references & self.definitions.keys()
+            for ref in references:
+                self.variable_dependents.setdefault( ref, set() ).add( name )
+        for path, source in self.templates.items():
+            for name in self._references( source ):
+                self.leaf_dependents.setdefault( name, set() ).add( path )
+        self.order = self._topological_order()
+
+    ##
+    # Returns the variables referenced by a raw value
+    def _references( self, raw ):
+        if not isinstance( raw, str ) or not self.template_context.is_template_string( raw ):
+            return frozenset()
+        return self.template_context.scalar_variables( raw )
+
+    ##
+    # Returns the variables ordered so that every variable comes after
+    # the variables it depends on.
+    # Raises RuntimeError naming the cycle if there is none
+    def _topological_order( self ):
+        WHITE, GREY, BLACK = 0, 1, 2
+        color = { name : WHITE for name in self.definitions }
+        order = []
+        for start in sorted( self.definitions ):
+            if color[ start ] != WHITE:
+                continue
+            stack = [ ( start, iter( sorted( self.variable_dependencies[ start ] ) ) ) ]
+            trail = [ start ]
+            color[ start ] = GREY
+            while len( stack ) > 0:
+                name, deps = stack[-1]
+                dep = next( deps, None )
+                if dep is None:
+                    color[ name ] = BLACK
+                    order.append( name )
+                    stack.pop()
+                    trail.pop()
+                elif color[ dep ] == GREY:
+                    cycle = trail[ trail.index( dep ): ] + [ dep ]
+                    msg = "Variable dependency cycle detected: {0}".format(
+                        " -> ".join( cycle ) )
+                    logger.error( msg )
+                    raise RuntimeError( msg )
+                elif color[ dep ] == WHITE:
+                    color[ dep ] = GREY
+                    stack.append( ( dep, iter( sorted( self.variable_dependencies[ dep ] ) ) ) )
+                    trail.append( dep )
+        return order
+
+    ##
+    # Returns the value of a variable given the values of the variables
+    # it depends on
+    def _render_variable( self, name ):
+        _, raw = self.definitions[ name ]
+        if not isinstance( raw, str ) or not self.template_context.is_template_string( raw ):
+            return str( raw )
+        template, _ = self.template_context.compile_scalar( raw )
+        return template.render( self.values )
+
+    ##
+    # Resolve every variable and template leaf from scratch (keeping
+    # the context variables changed with update_variable).
+    # Returns the resolved hmap
+    def resolve( self ):
+        self.values = dict( self.template_context.context )
+        self.values.update( self.context_overrides )
+        for name in self.order:
+            self.values[ name ] = self._render_variable( name )
+        updates = {}
+        for path, source in self.templates.items():
+            updates[ path ] = self.template_context.render_scalar( source, self.values )
+        self.resolved = path_copy( self.hmap, updates )
+        return self.resolved
+
+    ##
+    # Change the value of a variable (one set in a 'vars' block, or a
+    # context variable) and re-render only what depends on it.
+    # Returns the paths of the re-rendered leaves
+    def update_variable( self, name, raw ):
+
+        # update the definition (or the context) and relink, keeping
+        # the previous graph if the change introduces a cycle
+        updates = {}
+        if name in self.definitions:
+            previous = ( dict( self.definitions ), dict( self.templates ) )
+            path, _ = self.definitions[ name ]
+            self.definitions[ name ] = ( path, raw )
+            self.templates.pop( path, None )
+            if isinstance( raw, str ) and self.template_context.is_template_string( raw ):
+                self.templates[ path ] = raw
+            else:
+                updates[ path ] = raw
+            try:
+                self._link()
+            except RuntimeError:
+                self.definitions, self.templates = previous
+                self._link()
+                raise
+            self.hmap = path_copy( self.hmap, { path : raw } )
+        else:
+            self.context_overrides[ name ] = raw
+            self.values[ name ] = raw
+
+        # the variables affected, in topological order
+        affected = { name }
+        stack = [ name ]
+        while len( stack ) > 0:
+            for dep in self.variable_dependents.get( stack.pop(), () ):
+                if dep not in affected:
+                    affected.add( dep )
+                    stack.append( dep )
+        for var in self.order:
+            if var in affected:
+                self.values[ var ] = self._render_variable( var )
+
+        # and the leaves using them
+        paths = set()
+        for var in affected:
+            paths.update( self.leaf_dependents.get( var, () ) )
+        if name in self.definitions and self.definitions[ name ][0] in self.templates:
+            paths.add( self.definitions[ name ][0] )
+        for path in paths:
+            updates[ path ] = self.template_context.render_scalar(
+                self.templates[ path ], self.values )
+        self.resolved = path_copy( self.resolved, updates )
+        logger.info( "Variable '{0}' changed, re-rendered {1} of {2} template strings".format(
+            name, len( paths ), len( self.templates ) ) )
+        return sorted( paths, key = lambda p: [ str(k) for k in p ] )
+
+##============================================================================
+
+##
+# Resolves the variables of a parse state through a VariableGraph.
+# Returns the new parse state (with given parse state as parent) and
+# the graph, which can be kept around to cheaply apply later changes
+def resolve_variables( parse_state, template_context = None ):
+    graph = VariableGraph( parse_state.hmap, template_context )
+    return parse.ParseState( graph.resolved, parent = parse_state ), graph
+
+##============================================================================
+##============================================================================
+##============================================================================
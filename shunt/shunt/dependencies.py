@@ -0,0 +1,319 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.manifest as manifest
+
+import contextlib
+import hashlib
+import json
+import os
+import os.path
+import pathlib
+import threading
+
+import jinja2
+
+##============================================================================
+
+##
+# The dependency graph lives next to the materialization directory
+# (like the manifest), so a materialize path of 'materialized_views'
+# has a graph at 'materialized_views.shunt-deps.json'
+DEPENDENCIES_SUFFIX = ".shunt-deps.json"
+DEPENDENCIES_VERSION = 1
+
+##
+# Several Shuntfiles may share a materialization path and hence a
+# graph, so all read-modify-write cycles of a graph go through this lock
+_DEPENDENCIES_LOCK = threading.Lock()
+
+##
+# The template load recorders active on each thread
+_RECORDERS = threading.local()
+
+##============================================================================
+
+##
+# Returns the path of the dependency graph for a materialization path
+def dependencies_path( materialize_path ):
+    p = pathlib.Path( materialize_path )
+    return p.with_name( p.name + DEPENDENCIES_SUFFIX ).as_posix()
+
+##============================================================================
+
+##
+# Context manager recording every template loaded on this thread while
+# the block runs (by name, including {% include %}, {% extends %} and
+# {% import %} with names only known at render time).
+# Yields a map template-name => filename, the filename being None for
+# templates looked for but not found (say a missing alternative of a
+# list include), since creating one later changes the output
+@contextlib.contextmanager
+def record_template_loads():
+    loaded = {}
+    stack = getattr( _RECORDERS, 'stack', None )
+    if stack is None:
+        stack = _RECORDERS.stack = []
+    stack.append( loaded )
+    try:
+        yield loaded
+    finally:
+        stack.pop()
+
+##
+# Note that a template was loaded (filename None if it was not found)
+# for every recorder active on this thread
+def note_template_load( name, filename ):
+    for loaded in getattr( _RECORDERS, 'stack', () ):
+        if loaded.get( name ) is None:
+            loaded[ name ] = filename
+
+##============================================================================
+
+##
+# Adds the templates recorded while rendering a view to the inputs of
+# its manifest entry (see manifest.template_closure), so that views
+# including templates by names only known at render time can be
+# skipped as precisely as any other view
+def add_loaded_inputs( env, inputs, loaded ):
+    for name, filename in loaded.items():
+        if name in inputs:
+            continue
+        sha256 = None
+        if filename is not None:
+            source, filename, _ = env.loader.get_source( env, name )
+            sha256 = hashlib.sha256( source.encode( 'utf-8' ) ).hexdigest()
+        inputs[ name ] = {
+            'filename' : filename,
+            'sha256' : sha256,
+        }
+
+##============================================================================
+
+##
+# Returns the dependencies of a rendered view: the static closure of
+# its template (see manifest.template_closure, computed unless given
+# as inputs) merged with the templates actually loaded while rendering
+# it, as a map template-name => filename (None if not found)
+def view_templates( env, view_name, loaded, inputs = None ):
+    templates = dict( loaded )
+    if inputs is None:
+        try:
+            inputs, _ = manifest.template_closure( env, view_name )
+        except jinja2.TemplateNotFound:
+            inputs = {}
+    for name, info in inputs.items():
+        if templates.get( name ) is None:
+            templates[ name ] = info[ 'filename' ]
+    return templates
+
+##============================================================================
+
+##
+# Returns the index of the template path a file lives in, or None
+def _template_path_index( template_paths, filename ):
+    if filename is None:
+        return None
+    for i, p in enumerate( template_paths ):
+        root = pathlib.Path( p ).resolve().as_posix()
+        if filename == root or filename.startswith( root + os.sep ):
+            return i
+    return None
+
+##
+# Returns true iff one of the changed paths is one of the given paths
+# or a directory holding one of them
+def _touches( changed, paths ):
+    for path in paths:
+        if path in changed:
+            return True
+        parent = os.path.dirname( path )
+        while parent and parent != os.sep:
+            if parent in changed:
+                return True
+            parent = os.path.dirname( parent )
+    return False
+
+##============================================================================
+
+##
+# The persisted dependency graph of a materialization path: for every
+# view of every Shuntfile materialized there, every template it
+# touched (resolved against the Shuntfile's template paths), and for
+# every Shuntfile its resources.
+#
+# The structure is:
+#   { 'version' : int,
+#     'shuntfiles' : { shuntfile_path : entry } }
+# where each entry is:
+#   { 'template_paths' : [ paths ],
+#     'views' : { view_name : { 'output', 'templates' : { name : filename } } },
+#     'resources' : { target : source } }
+#
+# A changed file maps to the views to rebuild with affected_views:
+# every view which loaded a template of the same name from any of the
+# template paths (so edits, deletions and new files shadowing a
+# template are all caught), and every view of a changed Shuntfile
+class DependencyGraph( object ):
+
+    ##
+    # Create a graph for a materialization path with the given data
+    # (may be None for an empty graph)
+    def __init__( self, materialize_path, data = None ):
+        self.materialize_path = materialize_path
+        self.path = dependencies_path( materialize_path )
+        if data is None or data.get( 'version' ) != DEPENDENCIES_VERSION:
+            data = { 'version' : DEPENDENCIES_VERSION,
+                     'shuntfiles' : {} }
+        self.data = data
+
+    ##
+    # Load the graph of a materialization path.
+    # Missing or unreadable graphs are treated as empty
+    @staticmethod
+    def load( materialize_path ):
+        dpath = dependencies_path( materialize_path )
+        data = None
+        if pathlib.Path( dpath ).exists():
+            try:
+                with open( dpath ) as f:
+                    data = json.load( f )
+            except ValueError:
+                logger.warning( "Ignoring unreadable dependency graph '{0}'".format( dpath ) )
+        return DependencyGraph( materialize_path, data )
+
+    ##
+    # Returns the entry for a shuntfile (or None)
+    def entry( self, shuntfile_path ):
+        return self.data[ 'shuntfiles' ].get( shuntfile_path, None )
+
+    ##
+    # Replace the entry of a shuntfile and save the graph, merging
+    # with whatever other Shuntfiles saved meanwhile
+    def update( self, shuntfile_path, new_entry ):
+        with _DEPENDENCIES_LOCK:
+            self.data = DependencyGraph.load( self.materialize_path ).data
+            self.data[ 'shuntfiles' ][ shuntfile_path ] = new_entry
+            self.save()
+
+    ##
+    # Drop the entries of every shuntfile not in the given set, saving
+    # the graph (or removing it once no entry is left)
+    def prune( self, shuntfile_paths ):
+        with _DEPENDENCIES_LOCK:
+            self.data = DependencyGraph.load( self.materialize_path ).data
+            gone = set( self.data[ 'shuntfiles' ] ) - set( shuntfile_paths )
+            if len( gone ) == 0:
+                return
+            for sf_path in gone:
+                del self.data[ 'shuntfiles' ][ sf_path ]
+            if len( self.data[ 'shuntfiles' ] ) > 0:
+                self.save()
+            elif pathlib.Path( self.path ).exists():
+                os.unlink( self.path )
+
+    ##
+    # Write the graph to disk
+    def save( self ):
+        tmp_path = self.path + ".tmp"
+        with open( tmp_path, 'w' ) as f:
+            json.dump( self.data, f, indent=2, sort_keys=True )
+        os.replace( tmp_path, self.path )
+
+    ##
+    # Returns the map shuntfile_path => set of view names which must be
+    # rebuilt when the given files (absolute paths) changed.
+    # A changed directory (say one renamed or removed as a whole)
+    # affects the views of every template below it
+    def affected_views( self, changed_paths ):
+        changed = set( pathlib.Path( p ).resolve().as_posix() for p in changed_paths )
+        affected = {}
+        for sf_path, entry in self.data[ 'shuntfiles' ].items():
+            views = set()
+            if sf_path in changed:
+                views.update( entry[ 'views' ] )
+            else:
+                names = set()
+                for path in changed:
+                    for p in entry[ 'template_paths' ]:
+                        root = pathlib.Path( p ).resolve().as_posix()
+                        if path.startswith( root + os.sep ):
+                            names.add( os.path.relpath( path, root ) )
+                for view, info in entry[ 'views' ].items():
+                    if ( _touches( names, info[ 'templates' ].keys() )
+                         or _touches( changed, ( f for f in info[ 'templates' ].values()
+                                                 if f is not None ) ) ):
+                        views.add( view )
+            if len( views ) > 0:
+                affected[ sf_path ] = views
+        return affected
+
+    ##
+    # Returns the list of ( shuntfile_path, resource target ) whose
+    # source is, or contains, one of the given changed files
+    def affected_resources( self, changed_paths ):
+        changed = set( pathlib.Path( p ).resolve().as_posix() for p in changed_paths )
+        affected = []
+        for sf_path, entry in sorted( self.data[ 'shuntfiles' ].items() ):
+            for target, source in sorted( entry[ 'resources' ].items() ):
+                if any( path == source or path.startswith( source + os.sep )
+                        for path in changed ):
+                    affected.append( ( sf_path, target ) )
+        return affected
+
+    ##
+    # Returns the lines explaining why a view is materialized the way
+    # it is: which Shuntfile asks for it, where it goes, and every
+    # template it depends on with the template path it was found in
+    # and the template paths whose copy it shadows.
+    # Returns an empty list if the view is not in the graph
+    def why( self, view_name ):
+        lines = []
+        for sf_path, entry in sorted( self.data[ 'shuntfiles' ].items() ):
+            info = entry[ 'views' ].get( view_name, None )
+            if info is None:
+                continue
+            template_paths = entry[ 'template_paths' ]
+            lines.append( "View '{0}' of Shuntfile '{1}'".format( view_name, sf_path ) )
+            lines.append( "  output: {0}".format( info[ 'output' ] ) )
+            lines.append( "  depends on the Shuntfile and {0} template(s):".format(
+                len( info[ 'templates' ] ) ) )
+            for name, filename in sorted( info[ 'templates' ].items() ):
+                if filename is None:
+                    lines.append( "    {0}: not found (creating it changes the view)".format( name ) )
+                    continue
+                index = _template_path_index( template_paths, filename )
+                lines.append( "    {0}: {1}{2}".format(
+                    name,
+                    filename,
+                    "" if index is None else " (template path #{0})".format( index ) ) )
+                for i, p in enumerate( template_paths ):
+                    if index is None or i <= index:
+                        continue
+                    shadowed = pathlib.Path( p ).joinpath( name )
+                    if shadowed.exists():
+                        lines.append( "      shadows {0}".format( shadowed.as_posix() ) )
+            if len( entry[ 'resources' ] ) > 0:
+                lines.append( "  resources of the same Shuntfile (not inputs of the view):" )
+                for target, source in sorted( entry[ 'resources' ].items() ):
+                    lines.append( "    {0} <- {1}".format( target, source ) )
+        return lines
+
+##============================================================================
+
+##
+# Returns the dependency graphs of the materialization paths of a
+# loaded subproject tree (see scheduler.build_subproject_tree)
+def project_graphs( nodes ):
+    graphs = []
+    seen = set()
+    for node in nodes:
+        if node.materialize_path in seen:
+            continue
+        seen.add( node.materialize_path )
+        graphs.append( DependencyGraph.load( node.materialize_path ) )
+    return graphs
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,199 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.dependencies as dependencies
+import shunt.template_index as template_index
+
+import collections
+import os
+import pathlib
+import posixpath
+import threading
+
+import jinja2
+
+##============================================================================
+
+##
+# The maximum number of compiled templates each environment keeps
+# in memory. Jinja's default (400) is too small for large projects
+# whose views share many base templates and macros
+TEMPLATE_CACHE_SIZE = 4000
+
+##============================================================================
+
+##
+# A FileSystemLoader which counts the templates it actually has
+# to load (so the template was not in the environment's cache) and
+# those the environment's cache still had.
+#
+# Every template lookup of a render (cached or not, including those
+# of {% include %}, {% extends %} and {% import %}) either gets the
+# source here or checks that the cached template is up to date with
+# the uptodate function returned from here, so this is also where the
+# templates a view depends on are recorded (see shunt.dependencies).
+#
+# Templates are found through the file index of the search path (see
+# shunt.template_index), shared with resource resolution, instead of
+# probing every folder of the search path in turn
+class _CountingLoader( jinja2.FileSystemLoader ):
+
+    ##
+    # count is called with the name of every counter to increase
+    def __init__( self, count, searchpath, **kwargs ):
+        super().__init__( searchpath, **kwargs )
+        self.count = count
+
+    def load( self, environment, name, globals=None ):
+        self.count( 'template_cache_misses' )
+        return super().load( environment, name, globals )
+
+    def get_source( self, environment, template ):
+        pieces = jinja2.loaders.split_template_path( template )
+        index = template_index.get_template_index( self.searchpath )
+        i = index.find_file( "/".join( pieces ) )
+        while i is not None:
+            filename = posixpath.join( self.searchpath[ i ], *pieces )
+            try:
+                with open( filename, encoding = self.encoding ) as f:
+                    contents = f.read()
+                mtime = os.path.getmtime( filename )
+                break
+            except FileNotFoundError:
+                # removed (or a symlink left dangling) since the index
+                # was refreshed, later search paths may still have it
+                i = index.find_file( "/".join( pieces ), start = i + 1 )
+        if i is None:
+            dependencies.note_template_load( template, None )
+            raise jinja2.TemplateNotFound(
+                template,
+                "{0!r} not found in search paths: {1}".format(
+                    template, ", ".join( repr( p ) for p in self.searchpath ) ) )
+
+        filename = os.path.normpath( filename )
+        dependencies.note_template_load( template, filename )
+
+        # the environment asks every time it reuses the cached template
+        def uptodate():
+            try:
+                if os.path.getmtime( filename ) != mtime:
+                    return False
+            except OSError:
+                return False
+            self.count( 'template_cache_hits' )
+            dependencies.note_template_load( template, filename )
+            return True
+
+        return contents, filename, uptodate
+
+##============================================================================
+
+##
+# An on-disk bytecode cache which counts hits and misses
+class _CountingBytecodeCache( jinja2.FileSystemBytecodeCache ):
+
+    def __init__( self, count, directory ):
+        super().__init__( directory )
+        self.count = count
+
+    def load_bytecode( self, bucket ):
+        super().load_bytecode( bucket )
+        if bucket.code is None:
+            self.count( 'bytecode_cache_misses' )
+        else:
+            self.count( 'bytecode_cache_hits' )
+
+##============================================================================
+
+##
+# A pool of jinja2 environments keyed by the template search path.
+#
+# A single pool lives for a whole materialization run so that
+# templates shared between views (and subprojects with the same
+# template paths) are only ever parsed and compiled once.
+# If a bytecode cache path is given, compiled templates are also
+# kept on disk there so later runs skip compilation entirely.
+#
+# The pool is shared by the threads materializing subprojects, so its
+# stats are only ever changed under its lock (see count)
+class EnvironmentPool( object ):
+
+    ##
+    # Create a new, empty pool with an optional on-disk bytecode
+    # cache directory
+    def __init__( self, bytecode_cache_path = None ):
+        self.environments = {}
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.bytecode_cache = None
+        if bytecode_cache_path is not None:
+            pathlib.Path( bytecode_cache_path ).mkdir( parents=True,
+                                                      exist_ok=True )
+            self.bytecode_cache = _CountingBytecodeCache( self.count,
+                                                          bytecode_cache_path )
+
+    ##
+    # Increase a counter of the stats
+    def count( self, name, n = 1 ):
+        with self.lock:
+            self.stats[ name ] += n
+
+    ##
+    # Add counts (a map counter-name => n, say those of a worker
+    # process) to the stats
+    def add_stats( self, counts ):
+        with self.lock:
+            self.stats.update( counts )
+
+    ##
+    # Returns the environment for the given template paths,
+    # creating it the first time those paths are seen
+    def get( self, template_paths ):
+        key = tuple( template_paths )
+        with self.lock:
+            env = self.environments.get( key, None )
+            if env is None:
+                self.stats[ 'environment_misses' ] += 1
+                env = jinja2.Environment(
+                    loader = _CountingLoader( self.count,
+                                              list( key ),
+                                              followlinks=True ),
+                    bytecode_cache = self.bytecode_cache,
+                    cache_size = TEMPLATE_CACHE_SIZE )
+                self.environments[ key ] = env
+            else:
+                self.stats[ 'environment_hits' ] += 1
+            return env
+
+    ##
+    # Returns a map of the cache hit/miss counts so far
+    def cache_stats( self ):
+        with self.lock:
+            s = collections.Counter( self.stats )
+        return {
+            'environment_hits' : s[ 'environment_hits' ],
+            'environment_misses' : s[ 'environment_misses' ],
+            'template_cache_hits' : s[ 'template_cache_hits' ],
+            'template_cache_misses' : s[ 'template_cache_misses' ],
+            'bytecode_cache_hits' : s[ 'bytecode_cache_hits' ],
+            'bytecode_cache_misses' : s[ 'bytecode_cache_misses' ],
+        }
+
+    ##
+    # Log the cache hit/miss counts
+    def log_stats( self ):
+        stats = self.cache_stats()
+        logger.info( "Template caches: environments {0} hits / {1} misses, templates {2} hits / {3} misses".format(
+            stats[ 'environment_hits' ],
+            stats[ 'environment_misses' ],
+            stats[ 'template_cache_hits' ],
+            stats[ 'template_cache_misses' ] ) )
+        if self.bytecode_cache is not None:
+            logger.info( "Bytecode cache '{0}': {1} hits / {2} misses".format(
+                self.bytecode_cache.directory,
+                stats[ 'bytecode_cache_hits' ],
+                stats[ 'bytecode_cache_misses' ] ) )
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,264 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.profiling as profiling
+
+import pathlib
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import concurrent.futures
+
+##============================================================================
+
+##
+# Remote (git, s3) template paths are fetched into a persistent cache
+# outside of the materialization path so they survive between runs.
+# The cache lives in $SHUNT_FETCH_CACHE, or $XDG_CACHE_HOME/shunt/fetch,
+# or ~/.cache/shunt/fetch
+FETCH_CACHE_ENV_VAR = "SHUNT_FETCH_CACHE"
+
+##
+# Cached fetches younger than this many seconds are used as is,
+# without any network I/O
+DEFAULT_FETCH_TTL = 10 * 60
+
+##
+# Maximum number of remote paths fetched at the same time
+DEFAULT_FETCH_WORKERS = 8
+
+##============================================================================
+
+##
+# Returns the default directory of the fetch cache
+def default_fetch_cache_path():
+    if os.environ.get( FETCH_CACHE_ENV_VAR ):
+        return os.environ[ FETCH_CACHE_ENV_VAR ]
+    base = os.environ.get( 'XDG_CACHE_HOME' )
+    if not base:
+        base = ( pathlib.Path.home() / ".cache" ).as_posix()
+    return ( pathlib.Path( base ) / "shunt" / "fetch" ).as_posix()
+
+##============================================================================
+
+##
+# Makes sure a path object (a dictionary with 'source', 'destination'
+# and 'args' keys) is well formed, raising ValueError if not
+def validate_remote_path( path ):
+
+    # ok, ensure that path is astructure
+    if not isinstance( path, dict ):
+        msg = "Invalid path object. Expected string or dictionary but got type={0} '{1}'".format(
+            type(path),
+            path )
+        raise ValueError( msg )
+
+    # makre sure we at least have a source and destination
+    if 'source' not in path or 'destination' not in path:
+        msg = "Malformed path object. Paths need to have 'source' and 'destination' keys defined. Path = '{0}'".format( path )
+        raise ValueError( msg )
+
+    # ok, lookup the source
+    if path['source'] not in KNOWN_FETCHERS:
+        msg = "Invalid path source '{0}'. We don't know how to materialize such a path".format( path['source'] )
+        raise ValueError( msg )
+
+##============================================================================
+
+##
+# Returns the cache key for a path object: a digest of its source
+# and arguments (the destination is only where the result lands)
+def fetch_key( path ):
+    data = json.dumps( [ path['source'], path.get( 'args', [] ) ] )
+    return hashlib.sha256( data.encode( 'utf-8' ) ).hexdigest()[:32]
+
+##============================================================================
+
+##
+# Fetch a git path into a directory.
+# New clones are shallow, existing ones are updated with a
+# shallow fetch of whatever they track
+def _git_fetch( path, directory, update ):
+    destination = pathlib.Path( directory ) / path['destination']
+    if not update:
+        args = list( path.get( 'args', [] ) )
+        logger.info( "Cloning GIT path: '{0}' into '{1}'".format(
+            path, directory ) )
+        subprocess.run( ['git','clone','--depth','1'] + args,
+                        cwd = directory,
+                        check = True )
+    else:
+        logger.info( "Updating GIT path: '{0}' in '{1}'".format(
+            path, destination ) )
+        subprocess.run( ['git','fetch','--depth','1','origin'],
+                        cwd = destination,
+                        check = True )
+        subprocess.run( ['git','reset','--hard','--quiet','FETCH_HEAD'],
+                        cwd = destination,
+                        check = True )
+
+##============================================================================
+
+##
+# Fetch an s3 path into a directory.
+# The aws s3 commands (cp, sync) are simply re-run to update
+def _s3_fetch( path, directory, update ):
+    logger.info( "Fetching S3 path: '{0}' into '{1}'".format(
+        path, directory ) )
+    subprocess.run( ['aws','s3'] + list( path.get( 'args', [] ) ),
+                    cwd = directory,
+                    check = True )
+
+##============================================================================
+
+##
+# A mapping from source to fetch function for remote paths.
+# Fetch functions take ( path, directory, update ) and must leave
+# the result at directory/path['destination']
+KNOWN_FETCHERS = {
+    'git' : _git_fetch,
+    's3' : _s3_fetch,
+}
+
+##============================================================================
+
+##
+# A persistent cache of fetched remote paths keyed by (source, args).
+#
+# Entries younger than ttl seconds are used without network I/O.
+# Older ones are updated in place. When offline, no network I/O is
+# ever done and missing entries are an error.
+class FetchCache( object ):
+
+    ##
+    # Create a new fetch cache in the given directory (None for
+    # the default directory)
+    def __init__( self,
+                  cache_path = None,
+                  ttl = DEFAULT_FETCH_TTL,
+                  offline = False,
+                  max_workers = DEFAULT_FETCH_WORKERS ):
+        if cache_path is None:
+            cache_path = default_fetch_cache_path()
+        self.cache_path = pathlib.Path( cache_path ).resolve().as_posix()
+        self.ttl = ttl
+        self.offline = offline
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    ##
+    # Returns the lock guarding a single cache entry
+    def _key_lock( self, key ):
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[ key ] = threading.Lock()
+            return self.key_locks[ key ]
+
+    ##
+    # Returns the metadata of a cache entry or None if not cached
+    def _read_meta( self, key ):
+        meta_path = pathlib.Path( self.cache_path ) / ( key + ".json" )
+        if not meta_path.exists():
+            return None
+        try:
+            with open( meta_path.as_posix() ) as f:
+                return json.load( f )
+        except ValueError:
+            return None
+
+    ##
+    # Writes the metadata of a cache entry
+    def _write_meta( self, key, path ):
+        meta_path = pathlib.Path( self.cache_path ) / ( key + ".json" )
+        tmp_path = meta_path.as_posix() + ".tmp"
+        with open( tmp_path, 'w' ) as f:
+            json.dump( { 'source' : path['source'],
+                         'args' : path.get( 'args', [] ),
+                         'fetched_at' : time.time() }, f )
+        os.replace( tmp_path, meta_path.as_posix() )
+
+    ##
+    # Returns the local directory for a remote path object, fetching
+    # or updating it first if need be.
+    # If force is True the entry is updated even if not yet stale
+    def fetch( self, path, force = False ):
+        validate_remote_path( path )
+        key = fetch_key( path )
+        entry_path = pathlib.Path( self.cache_path ) / key
+        result = ( entry_path / path['destination'] ).resolve().as_posix()
+
+        with self._key_lock( key ):
+            meta = self._read_meta( key )
+            cached = meta is not None and pathlib.Path( result ).exists()
+
+            # offline only ever uses what is there
+            if self.offline:
+                if not cached:
+                    msg = "Path '{0}' is not in the fetch cache '{1}' and we are offline".format(
+                        path, self.cache_path )
+                    raise RuntimeError( msg )
+                return result
+
+            # fresh enough, use as is
+            age = None
+            if cached:
+                age = time.time() - meta[ 'fetched_at' ]
+            if cached and not force and self.ttl is not None and age < self.ttl:
+                logger.info( "Using cached path '{0}' ({1:.0f}s old)".format(
+                    result, age ) )
+                return result
+
+            # update an existing entry in place
+            fetcher = KNOWN_FETCHERS[ path['source'] ]
+            if cached:
+                with profiling.span( "fetch remote path", source = path['source'], key = key, update = True ):
+                    fetcher( path, entry_path.as_posix(), True )
+                self._write_meta( key, path )
+                return result
+
+            # fetch a new entry into a scratch directory and move it
+            # into place so an interrupted fetch never looks cached
+            scratch = pathlib.Path( self.cache_path ) / "{0}.tmp-{1}".format(
+                key, os.getpid() )
+            if scratch.exists():
+                shutil.rmtree( scratch.as_posix() )
+            scratch.mkdir( parents = True )
+            try:
+                with profiling.span( "fetch remote path", source = path['source'], key = key, update = False ):
+                    fetcher( path, scratch.as_posix(), False )
+                if entry_path.exists():
+                    shutil.rmtree( entry_path.as_posix() )
+                os.replace( scratch.as_posix(), entry_path.as_posix() )
+            finally:
+                if scratch.exists():
+                    shutil.rmtree( scratch.as_posix() )
+            self._write_meta( key, path )
+            return result
+
+    ##
+    # Given a list of template paths (strings or remote path objects)
+    # returns the list of local paths, in the same order.
+    # All remote paths are fetched concurrently.
+    def fetch_all( self, paths, force = False ):
+        remote = [ p for p in paths if not isinstance( p, str ) ]
+        for p in remote:
+            validate_remote_path( p )
+        if len( remote ) == 0:
+            return list( paths )
+
+        workers = max( 1, min( self.max_workers, len( remote ) ) )
+        with concurrent.futures.ThreadPoolExecutor( max_workers = workers ) as executor:
+            futures = [ executor.submit( self.fetch, p, force )
+                        if not isinstance( p, str ) else None
+                        for p in paths ]
+            return [ p if f is None else f.result()
+                     for p, f in zip( paths, futures ) ]
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -1,6 +1,8 @@
 import logging
 logger = logging.getLogger( __name__ )
 
+import functools
+
 
 ##
 # Interface functions for Hiearchichal Maps (hmaps)
@@ -32,11 +34,60 @@ def structured_key_to_path( sk, delim='/' ):
 
 ##============================================================================
 
+##
+# A path which has already been parsed (from a structured key or a
+# list of keys) into an immutable tuple of keys.
+#
+# Structured keys are compiled once and cached (see compile_path) so
+# hot lookups do not re-split and re-parse them on every call
+class CompiledPath( object ):
+    __slots__ = ( 'keys', )
+
+    def __init__( self, keys ):
+        self.keys = tuple( keys )
+
+    def __len__( self ):
+        return len( self.keys )
+
+    def __repr__( self ):
+        return "CompiledPath( {0} )".format( list( self.keys ) )
+
+##
+# The number of compiled structured keys remembered
+COMPILED_PATH_CACHE_SIZE = 4096
+
+@functools.lru_cache( maxsize = COMPILED_PATH_CACHE_SIZE )
+def _compile_structured_key( sk, delim ):
+    return CompiledPath( structured_key_to_path( sk, delim=delim ) )
+
+@functools.lru_cache( maxsize = COMPILED_PATH_CACHE_SIZE )
+def _compile_keys( keys ):
+    return CompiledPath( keys )
+
+##
+# Returns the CompiledPath for a structured key, list of keys or
+# CompiledPath. Structured keys (and tuples) are cached
+def compile_path( sk_or_path, delim='/' ):
+    if isinstance( sk_or_path, CompiledPath ):
+        return sk_or_path
+    if isinstance( sk_or_path, str ):
+        return _compile_structured_key( sk_or_path, delim )
+    if isinstance( sk_or_path, tuple ):
+        try:
+            return _compile_keys( sk_or_path )
+        except TypeError:
+            return CompiledPath( sk_or_path )
+    return CompiledPath( sk_or_path )
+
+##============================================================================
+
 ##
 # Take a path of a structured key and return a path
 def ensure_path( sk_or_path, delim='/' ):
     if isinstance( sk_or_path, str ):
         return structured_key_to_path( sk_or_path, delim=delim )
+    if isinstance( sk_or_path, CompiledPath ):
+        return list( sk_or_path.keys )
     return sk_or_path
 
 ##============================================================================
@@ -49,37 +100,63 @@ def ensure_path( sk_or_path, delim='/' ):
 #
 # This will *change* the given hmap (potentially) since it will
 # *create* the hmap structure down the path if it was not
-# previously created in the hmap
+# previously created in the hmap. Use hmap_lookup to only read.
 def hmap_probe( hmap, path ):
-    path = ensure_path( path )
-    if path is None or hmap is None or len(path) < 1:
+    if path is None or hmap is None:
         return None, None
-    if len(path) == 1:
-        return hmap, path[0]
-    next_element_type = dict
-    if isinstance( path[1], int ):
-        next_element_type = list
-    if isinstance( path[0], int ) and isinstance( hmap, list ):
-        while len( hmap ) < path[0]:
-            hmap.append( None )
-        if len(hmap) == path[0]:
-            hmap.append( next_element_type() )
-    else:
-        if path[0] not in hmap:
-            hmap[ path[0] ] = next_element_type()
-    return hmap_probe( hmap[ path[0] ], path[1:] )
+    keys = compile_path( path ).keys
+    if len( keys ) < 1:
+        return None, None
+    node = hmap
+    for i in range( len( keys ) - 1 ):
+        key = keys[ i ]
+        next_element_type = dict
+        if isinstance( keys[ i + 1 ], int ):
+            next_element_type = list
+        if isinstance( key, int ) and isinstance( node, list ):
+            while len( node ) < key:
+                node.append( None )
+            if len( node ) == key:
+                node.append( next_element_type() )
+        else:
+            if key not in node:
+                node[ key ] = next_element_type()
+        node = node[ key ]
+    return node, keys[-1]
+
+##============================================================================
+
+##
+# Returns the value at a path in an hmap, or the given default if
+# there is no such path.
+# This never changes the hmap and walks the path iteratively
+def hmap_lookup( hmap, path, default ):
+    if path is None or hmap is None:
+        return default
+    keys = compile_path( path ).keys
+    if len( keys ) < 1:
+        return default
+    node = hmap
+    for key in keys:
+        if isinstance( node, dict ):
+            if key not in node:
+                return default
+        elif isinstance( node, list ) and isinstance( key, int ):
+            if key < 0 or key >= len( node ):
+                return default
+        else:
+            return default
+        node = node[ key ]
+    return node
 
 ##============================================================================
 
 ##
 # Get the value for a path from an hmap
 # Or returns the given default value.
-# This may change the given hmap by probing it.
+# This does *not* change the given hmap
 def hmap_get( hmap, path, default ):
-    node, key = hmap_probe( hmap, path )
-    if node is None or ( isinstance(node,dict) and key not in node ) or ( isinstance( node, list ) and len(node) <= key):
-        return default
-    return node[ key ]
+    return hmap_lookup( hmap, path, default )
 
 ##============================================================================
 
@@ -110,10 +187,8 @@ def hmap_set( hmap, path, value ):
 ##
 # returns true if the given path has a set value in the given hmap
 def hmap_has_path( hmap, path ):
-    node, key = hmap_probe( hmap_probe, path )
-    return node is not None and (
-           ( isinstance(node,dict) and key in node )
-        or ( isinstance(node,list) and key < len(node) ) )
+    missing = object()
+    return hmap_lookup( hmap, path, missing ) is not missing
 
 
 ##============================================================================
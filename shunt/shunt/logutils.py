@@ -1,14 +1,36 @@
 import logging
 logger = logging.getLogger( __name__ )
 
+import sys
 import traceback
 
 ##============================================================================
 
+##
+# Returns the depth of the call stack at the caller of this function.
+# Counts frames by walking sys._getframe() back pointers, which is
+# the same number traceback.extract_stack() would give without
+# building (and reading the source lines of) every frame summary
+def _stack_depth():
+    getframe = getattr( sys, '_getframe', None )
+    if getframe is None:
+        return len( traceback.extract_stack() ) - 1
+    depth = 0
+    frame = getframe( 1 )
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+##============================================================================
+
+##
+# A logger adapter indenting messages by how deep in the call stack
+# they were logged from
 class CustomAdapter(logging.LoggerAdapter):
     @staticmethod
     def indent():
-        indentation_level = len(traceback.extract_stack())
+        indentation_level = _stack_depth()
         return indentation_level-4  # Remove logging infrastructure frames
 
     def process(self, msg, kwargs):
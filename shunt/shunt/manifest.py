@@ -0,0 +1,323 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import pathlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import jinja2
+import jinja2.meta
+
+##============================================================================
+
+##
+# The manifest lives next to the materialization directory, so
+# a materialize path of 'materialized_views' has a manifest at
+# 'materialized_views.shunt-manifest.json'
+MANIFEST_SUFFIX = ".shunt-manifest.json"
+MANIFEST_VERSION = 1
+
+##
+# Size of the chunks used when hashing file contents
+HASH_CHUNK_SIZE = 1024 * 1024
+
+##
+# Several Shuntfiles (a project and its subprojects) may share a
+# materialization path and hence a manifest, and independent
+# subprojects are materialized on concurrent threads (see
+# scheduler.run_schedule), so all read-modify-write cycles of a
+# manifest go through this lock
+_MANIFEST_LOCK = threading.Lock()
+
+##============================================================================
+
+##
+# Returns the path of the manifest for a given materialization path
+def manifest_path( materialize_path ):
+    p = pathlib.Path( materialize_path )
+    return p.with_name( p.name + MANIFEST_SUFFIX ).as_posix()
+
+##============================================================================
+
+##
+# Returns the hex sha256 digest of the contents of a file.
+# The file is read in chunks so large files do not live in memory
+def hash_file( path ):
+    h = hashlib.sha256()
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( HASH_CHUNK_SIZE ), b'' ):
+            h.update( chunk )
+    return h.hexdigest()
+
+##============================================================================
+
+##
+# Returns true iff two files have the same content: the same size and,
+# only then, the same streamed hash
+def same_content( path_a, path_b ):
+    try:
+        if os.path.getsize( path_a ) != os.path.getsize( path_b ):
+            return False
+    except OSError:
+        return False
+    return hash_file( path_a ) == hash_file( path_b )
+
+##============================================================================
+
+##
+# Returns the hex sha256 digest of a file or a whole directory tree.
+# Directory digests include the relative path of every file so
+# renames are detected as well as content changes
+def hash_tree( path ):
+    p = pathlib.Path( path )
+    if not p.is_dir():
+        return hash_file( path )
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk( path, followlinks=True ):
+        dirs.sort()
+        for name in sorted( files ):
+            full = os.path.join( root, name )
+            rel = os.path.relpath( full, path )
+            h.update( rel.encode( 'utf-8' ) )
+            h.update( b'\0' )
+            h.update( hash_file( full ).encode( 'ascii' ) )
+    return h.hexdigest()
+
+##============================================================================
+
+##
+# Returns the hex sha256 digest of an hmap (or any yaml-like structure)
+def hash_hmap( hmap ):
+    data = json.dumps( hmap, sort_keys=True, default=str )
+    return hashlib.sha256( data.encode( 'utf-8' ) ).hexdigest()
+
+##============================================================================
+
+##
+# Computes the closure of templates that a view depends on.
+#
+# Returns a pair ( inputs, dynamic ) where inputs is a map
+# template-name => { 'filename', 'sha256' } (both None for templates
+# referenced but not found) and dynamic is True iff
+# some template in the closure includes/extends/imports a template
+# whose name is only known at render time (so we cannot know the
+# full closure statically)
+def template_closure( env, view_name ):
+    inputs = {}
+    dynamic = False
+    pending = [ view_name ]
+    while len( pending ) > 0:
+        name = pending.pop()
+        if name in inputs:
+            continue
+        try:
+            source, filename, _ = env.loader.get_source( env, name )
+        except jinja2.TemplateNotFound:
+            if name == view_name:
+                raise
+            # say an alternative of a list include; creating it later
+            # changes the view
+            inputs[ name ] = { 'filename' : None, 'sha256' : None }
+            continue
+        inputs[ name ] = {
+            'filename' : filename,
+            'sha256' : hashlib.sha256( source.encode( 'utf-8' ) ).hexdigest(),
+        }
+        for ref in jinja2.meta.find_referenced_templates( env.parse( source ) ):
+            if ref is None:
+                dynamic = True
+            elif ref not in inputs:
+                pending.append( ref )
+    return inputs, dynamic
+
+##============================================================================
+
+##
+# Returns true iff the recorded template inputs of a view still
+# resolve to the same files with the same content for the given
+# environment. Inputs recorded with no filename were looked for but
+# not found, and must still not be found.
+def template_inputs_unchanged( env, inputs ):
+    for name, info in inputs.items():
+        try:
+            source, filename, _ = env.loader.get_source( env, name )
+        except jinja2.TemplateNotFound:
+            if info[ 'filename' ] is None:
+                continue
+            return False
+        if filename != info[ 'filename' ]:
+            return False
+        if hashlib.sha256( source.encode( 'utf-8' ) ).hexdigest() != info[ 'sha256' ]:
+            return False
+    return True
+
+##============================================================================
+
+##
+# Returns a new, empty manifest entry for a shuntfile
+def empty_entry():
+    return {
+        'hmap' : None,
+        'template_paths' : [],
+        'views' : {},
+        'resources' : {},
+    }
+
+##============================================================================
+
+##
+# Removes a previously materialized output (file or directory)
+# if it exists
+def remove_output( path ):
+    p = pathlib.Path( path )
+    if p.is_dir() and not p.is_symlink():
+        shutil.rmtree( path )
+    elif p.exists() or p.is_symlink():
+        p.unlink()
+
+##============================================================================
+
+##
+# A manifest records, for every Shuntfile materialized into a
+# materialization path, what inputs each output was produced from.
+#
+# The structure is:
+#   { 'version' : int,
+#     'shuntfiles' : { shuntfile_path : entry },
+#     'tree_paths' : [ materialization paths ] }
+# where each entry is:
+#   { 'hmap' : sha256,
+#     'template_paths' : [ paths ],
+#     'views' : { view_name : { 'output', 'inputs', 'dynamic' } },
+#     'resources' : { target : { 'source', 'strategy', 'signature' } } }
+# and 'tree_paths', only in the manifest of the root of a subproject
+# tree, lists the materialization paths of the whole tree as of its
+# last run (see tree_paths)
+class Manifest( object ):
+
+    ##
+    # Create a new manifest for a materialization path with the
+    # given data (may be None for an empty manifest)
+    def __init__( self, materialize_path, data = None ):
+        self.materialize_path = materialize_path
+        self.path = manifest_path( materialize_path )
+        if data is None or data.get( 'version' ) != MANIFEST_VERSION:
+            data = { 'version' : MANIFEST_VERSION,
+                     'shuntfiles' : {} }
+        self.data = data
+
+    ##
+    # Load the manifest for a materialization path.
+    # Missing or unreadable manifests are treated as empty
+    @staticmethod
+    def load( materialize_path ):
+        mpath = manifest_path( materialize_path )
+        data = None
+        if pathlib.Path( mpath ).exists():
+            try:
+                with open( mpath ) as f:
+                    data = json.load( f )
+            except ValueError:
+                logger.warning( "Ignoring unreadable manifest '{0}'".format( mpath ) )
+        return Manifest( materialize_path, data )
+
+    ##
+    # Returns the entry for a shuntfile (or an empty entry)
+    def entry( self, shuntfile_path ):
+        return self.data[ 'shuntfiles' ].get( shuntfile_path, empty_entry() )
+
+    ##
+    # Returns the set of output paths claimed by all shuntfiles
+    # other than the given one
+    def outputs_of_others( self, shuntfile_path ):
+        outputs = set()
+        for sf_path, entry in self.data[ 'shuntfiles' ].items():
+            if sf_path == shuntfile_path:
+                continue
+            outputs.update( v[ 'output' ] for v in entry[ 'views' ].values() )
+            outputs.update( entry[ 'resources' ].keys() )
+        return outputs
+
+    ##
+    # Replace the entry for a shuntfile with a new entry, removing
+    # any outputs the old entry produced that the new entry no
+    # longer does (unless another shuntfile also produces them).
+    # The manifest is saved to disk afterwards.
+    # Returns the number of outputs removed
+    def update( self, shuntfile_path, new_entry ):
+        with _MANIFEST_LOCK:
+            on_disk = Manifest.load( self.materialize_path )
+            self.data = on_disk.data
+            old_entry = self.entry( shuntfile_path )
+            keep = self.outputs_of_others( shuntfile_path )
+            keep.update( v[ 'output' ] for v in new_entry[ 'views' ].values() )
+            keep.update( new_entry[ 'resources' ].keys() )
+            stale = set( v[ 'output' ] for v in old_entry[ 'views' ].values() )
+            stale.update( old_entry[ 'resources' ].keys() )
+            for output in sorted( stale - keep ):
+                logger.info( "Removing stale output '{0}'".format( output ) )
+                remove_output( output )
+            self.data[ 'shuntfiles' ][ shuntfile_path ] = new_entry
+            self.save()
+            return len( stale - keep )
+
+    ##
+    # Returns the materialization paths of the whole subproject tree
+    # last materialized with this path as its root
+    def tree_paths( self ):
+        return list( self.data.get( 'tree_paths', [] ) )
+
+    ##
+    # Record the materialization paths of the whole subproject tree
+    # materialized with this path as its root, saving the manifest
+    def set_tree_paths( self, paths ):
+        with _MANIFEST_LOCK:
+            self.data = Manifest.load( self.materialize_path ).data
+            self.data[ 'tree_paths' ] = sorted( paths )
+            self.save()
+
+    ##
+    # Remove the entries of every shuntfile not in the given set (those
+    # no longer materialized here, say a subproject which left the
+    # tree or whose materialize_path changed) along with their outputs,
+    # unless a remaining shuntfile also produces them.
+    # The manifest is saved to disk afterwards, or removed once no
+    # entry is left.
+    # Returns the number of outputs removed
+    def prune( self, shuntfile_paths ):
+        with _MANIFEST_LOCK:
+            self.data = Manifest.load( self.materialize_path ).data
+            gone = sorted( set( self.data[ 'shuntfiles' ] ) - set( shuntfile_paths ) )
+            if len( gone ) == 0:
+                return 0
+            stale = set()
+            for sf_path in gone:
+                logger.info( "Shuntfile '{0}' no longer materializes into '{1}', removing its outputs".format(
+                    sf_path, self.materialize_path ) )
+                entry = self.data[ 'shuntfiles' ].pop( sf_path )
+                stale.update( v[ 'output' ] for v in entry[ 'views' ].values() )
+                stale.update( entry[ 'resources' ].keys() )
+            keep = self.outputs_of_others( None )
+            for output in sorted( stale - keep ):
+                logger.info( "Removing stale output '{0}'".format( output ) )
+                remove_output( output )
+            if len( self.data[ 'shuntfiles' ] ) > 0:
+                self.save()
+            elif pathlib.Path( self.path ).exists():
+                os.unlink( self.path )
+            return len( stale - keep )
+
+    ##
+    # Write the manifest to disk
+    def save( self ):
+        tmp_path = self.path + ".tmp"
+        with open( tmp_path, 'w' ) as f:
+            json.dump( self.data, f, indent=2, sort_keys=True )
+        os.replace( tmp_path, self.path )
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,225 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import json
+import os
+import threading
+import time
+
+##============================================================================
+
+##
+# Categories of spans listed one by one in the summary
+SUMMARY_CATEGORIES = ( 'view', 'resource' )
+
+##
+# Default number of slowest views/resources in the summary
+DEFAULT_SUMMARY_TOP = 10
+
+##
+# The active profiler, None when profiling is off
+_PROFILER = None
+
+##============================================================================
+
+##
+# Collects timing spans (as Chrome trace "complete" events).
+# Spans on the same thread nest by time, so the trace shows the
+# phases of a run as a flame chart per thread (and per process)
+class Profiler( object ):
+
+    def __init__( self ):
+        self.events = []
+        self.lock = threading.Lock()
+
+    ##
+    # Record a finished span
+    def record( self, name, cat, start, end, args ):
+        event = {
+            'name' : name,
+            'cat' : cat,
+            'ph' : 'X',
+            'ts' : start * 1e6,
+            'dur' : ( end - start ) * 1e6,
+            'pid' : os.getpid(),
+            'tid' : threading.get_ident(),
+        }
+        if args:
+            event[ 'args' ] = args
+        with self.lock:
+            self.events.append( event )
+
+    ##
+    # Returns the recorded events and forgets them
+    def drain( self ):
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+##============================================================================
+
+##
+# A timing span, recorded when it exits.
+# Arguments (say bytes written) can be added while it runs with set()
+class _Span( object ):
+    __slots__ = ( 'profiler', 'name', 'cat', 'args', 'start' )
+
+    def __init__( self, profiler, name, cat, args ):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def set( self, key, value ):
+        self.args[ key ] = value
+
+    def __enter__( self ):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        if exc_type is not None:
+            self.args[ 'error' ] = exc_type.__name__
+        self.profiler.record( self.name,
+                              self.cat,
+                              self.start,
+                              time.perf_counter(),
+                              self.args )
+        return False
+
+##
+# The span handed out when profiling is off: it does nothing at all
+class _NullSpan( object ):
+    __slots__ = ()
+
+    def set( self, key, value ):
+        pass
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+##============================================================================
+
+##
+# Returns a context manager timing the block as a span with the given
+# name, category and arguments.
+# When profiling is off this is a shared object doing nothing
+def span( name, cat = 'phase', **args ):
+    profiler = _PROFILER
+    if profiler is None:
+        return _NULL_SPAN
+    return _Span( profiler, name, cat, args )
+
+##
+# Turn profiling on (in this process)
+def enable():
+    global _PROFILER
+    if _PROFILER is None:
+        _PROFILER = Profiler()
+
+##
+# Turn profiling off, returning the events recorded so far
+def disable():
+    global _PROFILER
+    events = drain_events()
+    _PROFILER = None
+    return events
+
+##
+# Returns true iff profiling is on
+def is_enabled():
+    return _PROFILER is not None
+
+##
+# Returns (and forgets) the events recorded so far, for instance by a
+# worker process handing them to its parent
+def drain_events():
+    if _PROFILER is None:
+        return []
+    return _PROFILER.drain()
+
+##
+# Add events recorded elsewhere (say in a worker process)
+def add_events( events ):
+    if _PROFILER is None or not events:
+        return
+    with _PROFILER.lock:
+        _PROFILER.events.extend( events )
+
+##============================================================================
+
+##
+# Writes the recorded events as a Chrome trace-event file (viewable in
+# chrome://tracing or Perfetto). The events are kept.
+# Returns the events written
+def write_trace( path ):
+    if _PROFILER is None:
+        return []
+    with _PROFILER.lock:
+        events = sorted( _PROFILER.events, key = lambda e: e[ 'ts' ] )
+    tmp_path = "{0}.{1}.tmp".format( path, os.getpid() )
+    with open( tmp_path, 'w' ) as f:
+        json.dump( { 'traceEvents' : events,
+                     'displayTimeUnit' : 'ms' }, f )
+    os.replace( tmp_path, path )
+    logger.info( "Wrote {0} profile events to '{1}'".format( len( events ), path ) )
+    return events
+
+##============================================================================
+
+##
+# Log a summary of the recorded events: total time per phase, the
+# top_n slowest views and resources, and the bytes views and
+# resources wrote
+def log_summary( top_n = DEFAULT_SUMMARY_TOP ):
+    if _PROFILER is None:
+        return
+    with _PROFILER.lock:
+        events = list( _PROFILER.events )
+
+    totals = {}
+    for e in events:
+        if e[ 'cat' ] == 'phase':
+            count, dur = totals.get( e[ 'name' ], ( 0, 0.0 ) )
+            totals[ e[ 'name' ] ] = ( count + 1, dur + e[ 'dur' ] )
+    logger.info( "Profile, time per phase:" )
+    for name, ( count, dur ) in sorted( totals.items(), key = lambda kv: -kv[1][1] ):
+        logger.info( "  {0:10.3f}s {1:6d}x  {2}".format( dur / 1e6, count, name ) )
+
+    for cat in SUMMARY_CATEGORIES:
+        spans = [ e for e in events if e[ 'cat' ] == cat ]
+        if len( spans ) == 0:
+            continue
+        spans.sort( key = lambda e: -e[ 'dur' ] )
+        logger.info( "Profile, {0} slowest {1}s (of {2}):".format(
+            min( top_n, len( spans ) ), cat, len( spans ) ) )
+        for e in spans[:top_n]:
+            args = e.get( 'args', {} )
+            if 'bytes' in args:
+                size = "{0} bytes".format( args[ 'bytes' ] )
+            elif 'files' in args:
+                size = "{0} files".format( args[ 'files' ] )
+            else:
+                size = "-"
+            logger.info( "  {0:10.3f}s {1:>16}  {2}".format(
+                e[ 'dur' ] / 1e6,
+                size,
+                e[ 'name' ] ) )
+
+    views_written = sum( e.get( 'args', {} ).get( 'bytes', 0 ) for e in events
+                         if e[ 'cat' ] == 'view' and e.get( 'args', {} ).get( 'written', True ) )
+    resources_written = sum( e.get( 'args', {} ).get( 'bytes', 0 ) for e in events
+                             if e[ 'cat' ] == 'resource' )
+    logger.info( "Profile, {0} bytes of views and {1} bytes of resources written".format(
+        views_written, resources_written ) )
+
+##============================================================================
+##============================================================================
+##============================================================================
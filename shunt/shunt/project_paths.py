@@ -2,12 +2,42 @@ import shunt.logutils as logutils
 logger = logutils.getLogger( __name__ )
 
 import pathlib
+import os
+import os.path
+import fnmatch
+import json
+import threading
 import shunt.shuntfile as shuntfile
+import shunt.profiling as profiling
 
 ##============================================================================
 
 TEMPLATE_FOLDER_NAME = "shunts"
 MATERIALIZE_FOLDER_NAME = "materialized_views"
+BYTECODE_CACHE_SUFFIX = ".shunt-cache"
+
+##
+# The index of template paths found under a project root is kept in
+# its own folder at the root, so that (re)writing the index does not
+# change the mtime of the root itself
+INDEX_FOLDER_NAME = ".shunt"
+INDEX_FILENAME = "template-paths.json"
+INDEX_VERSION = 1
+
+##
+# Directories matching these patterns are never searched for
+# template folders. More patterns can be given in a IGNORE_FILENAME
+# file at the project root
+IGNORE_FILENAME = ".shuntignore"
+DEFAULT_IGNORE_PATTERNS = [
+    ".git",
+    ".hg",
+    ".svn",
+    INDEX_FOLDER_NAME,
+    MATERIALIZE_FOLDER_NAME,
+    MATERIALIZE_FOLDER_NAME + ".*",
+]
+
 
 ##============================================================================
 
@@ -19,17 +49,36 @@ MATERIALIZE_FOLDER_NAME = "materialized_views"
 #   Map[ prefix => path ] for all template paths
 def find_all_template_paths( start_path = '.' ):
 
-    # ok, first we will find the "root" directory which is the
-    # topmost directory with a shuntfile
-    root_path, shuntfile_path = find_shunt_root_path( start_path = start_path )
+    with profiling.span( "find template paths" ):
+
+        # ok, first we will find the "root" directory which is the
+        # topmost directory with a shuntfile
+        root_path, shuntfile_path = find_shunt_root_path( start_path = start_path )
 
-    # Ok, find all the template paths from the root
-    implicit_template_paths = find_all_template_paths_from_root( root_path )
+        # Ok, find all the template paths from the root.
+        # These are only looked for once per root
+        with _ROOT_TEMPLATE_PATHS_LOCK:
+            implicit_template_paths = _ROOT_TEMPLATE_PATHS.get( root_path, None )
+            if implicit_template_paths is None:
+                implicit_template_paths = find_all_template_paths_from_root( root_path )
+                _ROOT_TEMPLATE_PATHS[ root_path ] = implicit_template_paths
 
-    # read in any template paths explicitly set in hte shuntfile
-    explicit_template_paths = extract_template_paths_from_shuntfile( shuntfile_path )
+        # read in any template paths explicitly set in hte shuntfile
+        explicit_template_paths = extract_template_paths_from_shuntfile( shuntfile_path )
 
-    return explicit_template_paths + implicit_template_paths
+        return explicit_template_paths + implicit_template_paths
+
+##
+# The implicit template paths already found for each project root
+_ROOT_TEMPLATE_PATHS = {}
+_ROOT_TEMPLATE_PATHS_LOCK = threading.Lock()
+
+##
+# Forget the template paths found for every root, so the next
+# find_all_template_paths looks again (through the on-disk index)
+def clear_template_path_cache():
+    with _ROOT_TEMPLATE_PATHS_LOCK:
+        _ROOT_TEMPLATE_PATHS.clear()
 
 ##============================================================================
 
@@ -41,10 +90,15 @@ def extract_template_paths_from_shuntfile( shuntfile_path ):
         [ 'project', 'shunt_paths' ],
         [] )
 
-    # relative paths are relative to the shuntfile itself
+    # relative paths are relative to the shuntfile itself.
+    # Remote path objects (git, s3) are passed through as is
     ret = []
     for p in paths:
 
+        if not isinstance( p, str ):
+            ret.append( p )
+            continue
+
         if pathlib.Path( p ).is_absolute():
             ret.append( p )
             continue
@@ -84,28 +138,146 @@ def find_shunt_root_path( start_path, original_start_path=None ):
 
 ##
 # Finds all of the template paths and prefixes given the root node for
-# a shunt project
-def find_all_template_paths_from_root( root_path, prefix=None ):
-
-    # Now we will look for any template folders
-    root_p = pathlib.Path( root_path )
+# a shunt project.
+#
+# The tree is walked with os.scandir, never descending into template
+# folders themselves nor into ignored directories (see
+# load_ignore_patterns). The result is cached in an index file at the
+# root which stays valid as long as none of the walked directories
+# changed (their mtimes), so warm startups do not walk the tree at all.
+def find_all_template_paths_from_root( root_path, prefix=None, use_index=True ):
+
+    root_path = pathlib.Path( root_path ).as_posix()
+    patterns = load_ignore_patterns( root_path )
+
+    # try the index first. The index folder is created before any
+    # walk so creating it does not invalidate the first index
+    index_path = os.path.join( root_path, INDEX_FOLDER_NAME, INDEX_FILENAME )
+    if use_index:
+        template_paths = _read_template_path_index( index_path, root_path, patterns )
+        if template_paths is not None:
+            return template_paths
+        try:
+            os.makedirs( os.path.dirname( index_path ), exist_ok=True )
+        except OSError as e:
+            logger.warning( "Unable to create template path index folder: {0}".format( e ) )
+            use_index = False
+
+    # ok, walk the tree
     template_paths = []
-    for child in root_p.iterdir():
-        if not child.is_dir():
+    dir_mtimes = {}
+    _scan_for_template_paths( root_path, root_path, patterns, template_paths, dir_mtimes )
+
+    # and remember what we found
+    if use_index:
+        _write_template_path_index( index_path, root_path, patterns, template_paths, dir_mtimes )
+    return template_paths
+
+##============================================================================
+
+##
+# Recursive helper for find_all_template_paths_from_root.
+# Appends found template folders to template_paths (in the same order as
+# a plain depth-first walk) and records the mtime of every directory
+# read into dir_mtimes ( relative path => mtime_ns )
+def _scan_for_template_paths( root_path, path, patterns, template_paths, dir_mtimes ):
+    rel = os.path.relpath( path, root_path )
+    try:
+        dir_mtimes[ rel ] = os.stat( path ).st_mtime_ns
+        entries = list( os.scandir( path ) )
+    except OSError as e:
+        logger.warning( "Unable to scan '{0}' for template paths: {1}".format( path, e ) )
+        return
+    for entry in entries:
+        try:
+            if not entry.is_dir():
+                continue
+        except OSError:
             continue
-        if child.name == TEMPLATE_FOLDER_NAME:
+        child = path + "/" + entry.name
+        if entry.name == TEMPLATE_FOLDER_NAME:
 
             # ok, found a templates folder
             # Add the folder path
-            template_paths.append( child.as_posix() )
+            template_paths.append( child )
 
-        else:
+        elif not is_ignored( os.path.relpath( child, root_path ), entry.name, patterns ):
 
             # ok, recurse down to find more templates :)
-            child_paths = find_all_template_paths_from_root( child.as_posix(), prefix=None )
-            template_paths.extend( child_paths )
+            _scan_for_template_paths( root_path, child, patterns, template_paths, dir_mtimes )
 
-    return template_paths
+##============================================================================
+
+##
+# Returns the patterns of directories never searched for template
+# folders: the defaults plus any in the '.shuntignore' file at the
+# root (one fnmatch pattern per line, '#' starts a comment)
+def load_ignore_patterns( root_path ):
+    patterns = list( DEFAULT_IGNORE_PATTERNS )
+    ignore_path = os.path.join( root_path, IGNORE_FILENAME )
+    if os.path.isfile( ignore_path ):
+        with open( ignore_path ) as f:
+            for line in f:
+                line = line.split( '#', 1 )[0].strip().rstrip( '/' )
+                if len( line ) > 0:
+                    patterns.append( line )
+    return patterns
+
+##============================================================================
+
+##
+# Returns true iff a directory matches any of the ignore patterns.
+# Patterns with a '/' match the path relative to the root, all others
+# match just the directory name
+def is_ignored( relative_path, name, patterns ):
+    for pattern in patterns:
+        if '/' in pattern:
+            if fnmatch.fnmatch( relative_path, pattern.lstrip( '/' ) ):
+                return True
+        elif fnmatch.fnmatch( name, pattern ):
+            return True
+    return False
+
+##============================================================================
+
+##
+# Returns the template paths stored in an index file, or None if
+# there is no index or it is out of date
+def _read_template_path_index( index_path, root_path, patterns ):
+    try:
+        with open( index_path ) as f:
+            index = json.load( f )
+    except ( OSError, ValueError ):
+        return None
+    if index.get( 'version' ) != INDEX_VERSION or index.get( 'ignore' ) != patterns:
+        return None
+    for rel, mtime in index[ 'dirs' ].items():
+        try:
+            if os.stat( os.path.join( root_path, rel ) ).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+    return [ os.path.normpath( os.path.join( root_path, p ) ) for p in index[ 'template_paths' ] ]
+
+##============================================================================
+
+##
+# Writes an index file for the template paths found under a root.
+# Failing to write the index (say a read-only checkout) is not an error
+def _write_template_path_index( index_path, root_path, patterns, template_paths, dir_mtimes ):
+    index = {
+        'version' : INDEX_VERSION,
+        'ignore' : patterns,
+        'dirs' : dir_mtimes,
+        'template_paths' : [ os.path.relpath( p, root_path ) for p in template_paths ],
+    }
+    tmp_path = "{0}.{1}.{2}.tmp".format( index_path, os.getpid(), threading.get_ident() )
+    try:
+        with open( tmp_path, 'w' ) as f:
+            json.dump( index, f )
+        os.replace( tmp_path, index_path )
+    except OSError as e:
+        logger.warning( "Unable to write template path index '{0}': {1}".format( index_path, e ) )
 
 ##============================================================================
 
@@ -130,6 +302,17 @@ def materialize_path( sf, parents ):
     # locations
     return ( pathlib.Path( sf.path ).parent / MATERIALIZE_FOLDER_NAME ).resolve().as_posix()
 
+##============================================================================
+
+##
+# Returns the directory for the on-disk template bytecode cache of
+# a materialization path. This lives *next to* the materialization
+# path (so 'materialized_views.shunt-cache') so that emptying the
+# materialization path does not also throw the cache away
+def bytecode_cache_path( materialize_path ):
+    p = pathlib.Path( materialize_path )
+    return p.with_name( p.name + BYTECODE_CACHE_SUFFIX ).as_posix()
+
 ##============================================================================
 ##============================================================================
 ##============================================================================
@@ -0,0 +1,249 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.manifest as manifest
+
+import hashlib
+import os
+import shutil
+import concurrent.futures
+
+##============================================================================
+
+##
+# How a resource is placed into the materialization path:
+#   copy     : a real copy (default)
+#   hardlink : hard links to the source files (copies across devices)
+#   symlink  : a symbolic link to the source file or directory
+#   reflink  : copy-on-write clones where the filesystem supports
+#              them (btrfs, xfs, ...), real copies otherwise
+COPY_STRATEGIES = ( 'copy', 'hardlink', 'symlink', 'reflink' )
+DEFAULT_COPY_STRATEGY = 'copy'
+
+##
+# How unchanged resources are detected:
+#   stat : same size and modification time (cheap, like rsync)
+#   hash : same content hash (reads every byte)
+CHANGE_DETECTIONS = ( 'stat', 'hash' )
+DEFAULT_CHANGE_DETECTION = 'stat'
+
+##
+# Maximum number of files placed at the same time for directory
+# resources, and the number of files below which we do not bother
+# with threads at all
+DEFAULT_COPY_WORKERS = 8
+PARALLEL_COPY_THRESHOLD = 16
+
+##
+# The linux ioctl cloning a whole file (copy-on-write)
+_FICLONE = 0x40049409
+
+##============================================================================
+
+##
+# Returns the copy strategy for a resource: its own 'strategy' key if
+# it has one, otherwise the given default.
+# Raises ValueError for unknown strategies
+def resource_strategy( res, default = DEFAULT_COPY_STRATEGY ):
+    strategy = default
+    if isinstance( res, dict ):
+        strategy = res.get( 'strategy', default )
+    if strategy not in COPY_STRATEGIES:
+        msg = "Unknown resource copy strategy '{0}' for resource '{1}'. Known strategies are {2}".format(
+            strategy, res, COPY_STRATEGIES )
+        raise ValueError( msg )
+    return strategy
+
+##============================================================================
+
+##
+# Returns a digest identifying the current state of a resource
+# (file or directory) for change detection.
+# With 'stat' only sizes and modification times are looked at, with
+# 'hash' the full content is hashed
+def resource_signature( path, change_detection = DEFAULT_CHANGE_DETECTION ):
+    if change_detection == 'hash':
+        return "hash:" + manifest.hash_tree( path )
+    if change_detection != 'stat':
+        msg = "Unknown change detection '{0}'. Known are {1}".format(
+            change_detection, CHANGE_DETECTIONS )
+        raise ValueError( msg )
+    h = hashlib.sha256()
+    if not os.path.isdir( path ):
+        st = os.stat( path )
+        h.update( "{0}:{1}".format( st.st_size, st.st_mtime_ns ).encode( 'utf-8' ) )
+        return "stat:" + h.hexdigest()
+    for root, dirs, files in os.walk( path, followlinks=True ):
+        dirs.sort()
+        for name in sorted( files ):
+            full = os.path.join( root, name )
+            st = os.stat( full )
+            h.update( "{0}\0{1}:{2}\0".format(
+                os.path.relpath( full, path ),
+                st.st_size,
+                st.st_mtime_ns ).encode( 'utf-8' ) )
+    return "stat:" + h.hexdigest()
+
+##============================================================================
+
+##
+# Returns true iff target already is an up to date placement of
+# source for the given strategy
+def _file_is_current( source, target, strategy ):
+    try:
+        tst = os.lstat( target )
+    except FileNotFoundError:
+        return False
+    if strategy == 'symlink':
+        return os.path.islink( target ) and os.readlink( target ) == source
+    if os.path.islink( target ):
+        return False
+    sst = os.stat( source )
+    same_file = ( sst.st_dev, sst.st_ino ) == ( tst.st_dev, tst.st_ino )
+    if strategy == 'hardlink' and same_file:
+        return True
+    if same_file:
+        return False
+    return sst.st_size == tst.st_size and sst.st_mtime_ns == tst.st_mtime_ns
+
+##
+# Returns true iff both paths are the same file (hardlinks of each other)
+def _same_inode( source, target ):
+    try:
+        sst = os.stat( source )
+        tst = os.stat( target )
+    except OSError:
+        return False
+    return ( sst.st_dev, sst.st_ino ) == ( tst.st_dev, tst.st_ino )
+
+##============================================================================
+
+##
+# Clone a file with the FICLONE ioctl, raising OSError if the
+# filesystem (or platform) cannot
+def _reflink( source, target ):
+    import fcntl
+    with open( source, 'rb' ) as src, open( target, 'wb' ) as dst:
+        fcntl.ioctl( dst.fileno(), _FICLONE, src.fileno() )
+    shutil.copystat( source, target )
+
+##============================================================================
+
+##
+# Place a single file at target using the given strategy,
+# replacing whatever was at target.
+# Copies preserve modification times so 'stat' change detection
+# works on the next run. A copy whose target already has the same
+# content (see manifest.same_content) is not made at all, so the
+# target keeps its modification time, unless the target is the source
+# itself (a hardlink placed earlier), which would stay shared.
+# Returns true iff the target was written
+def place_file( source, target, strategy ):
+    if ( strategy in ( 'copy', 'reflink' )
+         and os.path.isfile( target )
+         and not os.path.islink( target )
+         and not _same_inode( source, target )
+         and manifest.same_content( source, target ) ):
+        return False
+    if os.path.lexists( target ):
+        manifest.remove_output( target )
+    if strategy == 'symlink':
+        os.symlink( source, target )
+        return True
+    if strategy == 'hardlink':
+        try:
+            os.link( source, target )
+            return True
+        except OSError as e:
+            logger.info( "Unable to hardlink '{0}' ({1}), copying instead".format( source, e ) )
+    elif strategy == 'reflink':
+        try:
+            _reflink( source, target )
+            return True
+        except ( OSError, ImportError ):
+            if os.path.lexists( target ):
+                os.remove( target )
+    shutil.copy2( source, target )
+    return True
+
+##
+# Returns the size of an output (0 if it is gone)
+def _output_size( path ):
+    try:
+        return os.lstat( path ).st_size
+    except OSError:
+        return 0
+
+##============================================================================
+
+##
+# Place a resource (file or directory tree) at target using the given
+# strategy.
+#
+# Files already up to date at the target (same size and modification
+# time, same inode for hardlinks, same link for symlinks, or the same
+# content for copies) are left alone and files no longer in the
+# source are removed. Directory trees with many files are placed by a
+# pool of threads.
+#
+# Returns the counts of files { 'written', 'written_bytes',
+# 'unchanged', 'unchanged_bytes', 'deleted' }
+def place_resource( source, target, strategy = DEFAULT_COPY_STRATEGY,
+                    max_workers = DEFAULT_COPY_WORKERS ):
+    counts = { 'written' : 0, 'written_bytes' : 0,
+               'unchanged' : 0, 'unchanged_bytes' : 0, 'deleted' : 0 }
+
+    # single files and symlinked directories are one placement
+    if not os.path.isdir( source ) or strategy == 'symlink':
+        pending = [ ( source, target ) ]
+        if _file_is_current( source, target, strategy ):
+            pending = []
+            counts[ 'unchanged' ] += 1
+            counts[ 'unchanged_bytes' ] += _output_size( target )
+
+    # work out the files which need placing, and drop stale ones.
+    # Target directories that are not real directories (say symlinks
+    # placed by the 'symlink' strategy) are replaced
+    else:
+        pending = []
+        for root, dirs, files in os.walk( source, followlinks=True ):
+            rel = os.path.relpath( root, source )
+            troot = os.path.normpath( os.path.join( target, rel ) )
+            if os.path.lexists( troot ) and ( os.path.islink( troot ) or not os.path.isdir( troot ) ):
+                manifest.remove_output( troot )
+                counts[ 'deleted' ] += 1
+            os.makedirs( troot, exist_ok=True )
+            wanted = set( dirs ) | set( files )
+            for name in os.listdir( troot ):
+                if name not in wanted:
+                    manifest.remove_output( os.path.join( troot, name ) )
+                    counts[ 'deleted' ] += 1
+            for name in files:
+                src = os.path.join( root, name )
+                dst = os.path.join( troot, name )
+                if _file_is_current( src, dst, strategy ):
+                    counts[ 'unchanged' ] += 1
+                    counts[ 'unchanged_bytes' ] += _output_size( dst )
+                else:
+                    pending.append( ( src, dst ) )
+
+    # and place them
+    if len( pending ) < PARALLEL_COPY_THRESHOLD or max_workers <= 1:
+        written = [ place_file( src, dst, strategy ) for src, dst in pending ]
+    else:
+        with concurrent.futures.ThreadPoolExecutor( max_workers = max_workers ) as executor:
+            futures = [ executor.submit( place_file, src, dst, strategy )
+                        for src, dst in pending ]
+            written = [ f.result() for f in futures ]
+    for ( src, dst ), w in zip( pending, written ):
+        if w:
+            counts[ 'written' ] += 1
+            counts[ 'written_bytes' ] += _output_size( dst )
+        else:
+            counts[ 'unchanged' ] += 1
+            counts[ 'unchanged_bytes' ] += _output_size( dst )
+    return counts
+
+##============================================================================
+##============================================================================
+##============================================================================
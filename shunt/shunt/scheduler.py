@@ -0,0 +1,252 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.project_paths as project_paths
+import shunt.shuntfile as shuntfile
+
+import pathlib
+import heapq
+import time
+import concurrent.futures
+
+##============================================================================
+
+##
+# A single Shuntfile in the subproject tree of a project.
+#
+# Nodes know their loaded Shuntfile, the chain of parent Shuntfiles
+# (nearest first, as used by project_paths.materialize_path) and the
+# nodes which must be materialized before them
+class Subproject( object ):
+
+    ##
+    # Create a new node for a loaded shuntfile
+    def __init__( self, index, shuntfile_path, sf, parents, parent ):
+        self.index = index
+        self.shuntfile_path = shuntfile_path
+        self.sf = sf
+        self.parents = parents
+        self.parent = parent
+        self.materialize_path = project_paths.materialize_path( sf, parents )
+        self.children = []
+        self.depends_on = []
+        self.dependents = []
+        self.elapsed = None
+
+    def __repr__( self ):
+        return "Subproject( '{0}' )".format( self.shuntfile_path )
+
+##============================================================================
+
+##
+# Returns the Shuntfile path of a subproject (a directory relative to
+# the given shuntfile)
+def subproject_shuntfile_path( shuntfile_path, proj ):
+    return ( pathlib.Path( shuntfile_path ) / ".." / proj / shuntfile.SHUNT_FILENAME ).resolve().as_posix()
+
+##============================================================================
+
+##
+# Builds the full subproject tree rooted at the given shuntfile.
+#
+# Every Shuntfile is loaded before any of its subprojects (since the
+# materialization path of a subproject depends on its parents).
+# Returns the list of nodes in depth-first pre-order, which is the
+# order a serial materialization visits them in.
+#
+# Raises RuntimeError if subprojects reference each other in a cycle
+def build_subproject_tree( shuntfile_path, parents = None ):
+    nodes = []
+    if parents is None:
+        parents = []
+
+    # explicit stack of ( path, parents, parent-node, ancestor-paths )
+    stack = [ ( shuntfile_path, parents, None, [] ) ]
+    while len( stack ) > 0:
+        path, sf_parents, parent, ancestors = stack.pop()
+        key = pathlib.Path( path ).resolve().as_posix()
+        if key in ancestors:
+            cycle = ancestors[ ancestors.index( key ): ] + [ key ]
+            msg = "Subproject cycle detected: {0}".format( " -> ".join( cycle ) )
+            logger.error( msg )
+            raise RuntimeError( msg )
+
+        sf = shuntfile.load_shuntfile( path )
+        node = Subproject( len( nodes ), path, sf, sf_parents, parent )
+        nodes.append( node )
+        if parent is not None:
+            parent.children.append( node )
+
+        # push children reversed so they pop in declaration order
+        children = shuntfile.shuntfile_get( sf, ['project','subprojects'], [] )
+        for proj in reversed( children ):
+            stack.append( ( subproject_shuntfile_path( path, proj ),
+                            [ sf ] + sf_parents,
+                            node,
+                            ancestors + [ key ] ) )
+    return nodes
+
+##============================================================================
+
+##
+# Computes the dependencies between the nodes of a subproject tree:
+#   * every node depends on its parent
+#   * every node depends on the subprojects listed in its
+#     'project/depends_on' (directories relative to its Shuntfile)
+#   * if serialize_shared_paths is True, every node depends on the
+#     previous node (in pre-order) with the same materialization path
+#
+# Raises ValueError for unknown depends_on entries and RuntimeError
+# if the dependencies form a cycle
+def link_dependencies( nodes, serialize_shared_paths = True ):
+
+    by_path = {}
+    for node in nodes:
+        key = pathlib.Path( node.shuntfile_path ).resolve().as_posix()
+        by_path.setdefault( key, [] ).append( node )
+
+    last_by_materialize_path = {}
+    for node in nodes:
+        deps = []
+        if node.parent is not None:
+            deps.append( node.parent )
+        for proj in shuntfile.shuntfile_get( node.sf, ['project','depends_on'], [] ):
+            key = subproject_shuntfile_path( node.shuntfile_path, proj )
+            if key not in by_path:
+                msg = "Subproject '{0}' depends on '{1}' which is not part of the project".format(
+                    node.shuntfile_path, proj )
+                logger.error( msg )
+                raise ValueError( msg )
+            deps.extend( by_path[ key ] )
+        if serialize_shared_paths:
+            previous = last_by_materialize_path.get( node.materialize_path, None )
+            if previous is not None:
+                deps.append( previous )
+            last_by_materialize_path[ node.materialize_path ] = node
+        for dep in deps:
+            if dep is node:
+                msg = "Subproject '{0}' depends on itself".format( node.shuntfile_path )
+                logger.error( msg )
+                raise RuntimeError( msg )
+            if dep not in node.depends_on:
+                node.depends_on.append( dep )
+                dep.dependents.append( node )
+
+    _check_for_cycles( nodes )
+
+##============================================================================
+
+##
+# Raises RuntimeError if the depends_on edges of the nodes form a cycle
+def _check_for_cycles( nodes ):
+    WHITE, GREY, BLACK = 0, 1, 2
+    color = { node.index : WHITE for node in nodes }
+    for start in nodes:
+        if color[ start.index ] != WHITE:
+            continue
+        stack = [ ( start, iter( start.depends_on ) ) ]
+        trail = [ start ]
+        color[ start.index ] = GREY
+        while len( stack ) > 0:
+            node, deps = stack[-1]
+            dep = next( deps, None )
+            if dep is None:
+                color[ node.index ] = BLACK
+                stack.pop()
+                trail.pop()
+            elif color[ dep.index ] == GREY:
+                cycle = trail[ trail.index( dep ): ] + [ dep ]
+                msg = "Subproject dependency cycle detected: {0}".format(
+                    " -> ".join( n.shuntfile_path for n in cycle ) )
+                logger.error( msg )
+                raise RuntimeError( msg )
+            elif color[ dep.index ] == WHITE:
+                color[ dep.index ] = GREY
+                stack.append( ( dep, iter( dep.depends_on ) ) )
+                trail.append( dep )
+
+##============================================================================
+
+##
+# Runs fn( node ) for every node once all of its dependencies are done,
+# using at most max_workers threads.
+#
+# Among the nodes that are ready, the one earliest in pre-order goes
+# first, so with a single worker this is exactly the serial order.
+# If a node fails, the nodes depending on it are skipped and a
+# RuntimeError is raised once everything else is done.
+#
+# Returns the nodes with their 'elapsed' times filled in
+def run_schedule( nodes, fn, max_workers = 1 ):
+
+    unmet = { node.index : len( node.depends_on ) for node in nodes }
+    ready = [ node.index for node in nodes if unmet[ node.index ] == 0 ]
+    heapq.heapify( ready )
+    running = {}
+    failures = []
+    skipped = set()
+
+    def _timed( node ):
+        start = time.perf_counter()
+        fn( node )
+        return time.perf_counter() - start
+
+    def _skip( node ):
+        for dep in node.dependents:
+            if dep.index not in skipped:
+                skipped.add( dep.index )
+                _skip( dep )
+
+    with concurrent.futures.ThreadPoolExecutor( max_workers = max( 1, max_workers ) ) as executor:
+        while len( ready ) > 0 or len( running ) > 0:
+            while len( ready ) > 0 and len( running ) < max( 1, max_workers ):
+                node = nodes[ heapq.heappop( ready ) ]
+                running[ executor.submit( _timed, node ) ] = node
+            done, _ = concurrent.futures.wait(
+                running,
+                return_when = concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                node = running.pop( future )
+                try:
+                    node.elapsed = future.result()
+                except Exception as e:
+                    logger.error( "Failed materializing '{0}': {1}".format(
+                        node.shuntfile_path, e ) )
+                    failures.append( ( node, e ) )
+                    _skip( node )
+                    continue
+                for dep in node.dependents:
+                    unmet[ dep.index ] -= 1
+                    if unmet[ dep.index ] == 0 and dep.index not in skipped:
+                        heapq.heappush( ready, dep.index )
+
+    log_timings( nodes )
+    if len( failures ) > 0:
+        msg = "Unable to materialize {0} Shuntfile(s): {1}".format(
+            len( failures ),
+            [ node.shuntfile_path for node, _ in failures ] )
+        if len( skipped ) > 0:
+            msg += " (skipped {0} dependent Shuntfile(s))".format( len( skipped ) )
+        raise RuntimeError( msg ) from failures[0][1]
+    return nodes
+
+##============================================================================
+
+##
+# Log the time taken by every node, in tree order
+def log_timings( nodes ):
+    logger.info( "Subproject timings:" )
+    for node in nodes:
+        depth = len( node.parents )
+        if node.elapsed is None:
+            timing = "     -   "
+        else:
+            timing = "{0:8.3f}s".format( node.elapsed )
+        logger.info( "  {0} {1}{2}".format(
+            timing,
+            "  " * depth,
+            node.shuntfile_path ) )
+
+##============================================================================
+##============================================================================
+##============================================================================
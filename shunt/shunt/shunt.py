@@ -3,36 +3,303 @@ logger = logutils.getLogger( __name__ )
 
 import shunt.project_paths as project_paths
 import shunt.shuntfile as shuntfile
+import shunt.manifest as manifest
+import shunt.environments as environments
+import shunt.scheduler as scheduler
+import shunt.fetch as fetch
+import shunt.yamlutils as yamlutils
+import shunt.resources as resources
+import shunt.profiling as profiling
+import shunt.watch as watch
+import shunt.dependencies as dependencies
+import shunt.template_index as template_index
+import shunt.tfstate as tfstate
 
 import pathlib
 import os
+import sys
 import os.path
-import subprocess
-import shutil
-
-import jinja2
+import collections
+import concurrent.futures
+import contextlib
+import threading
+import logging
+import traceback
 
 ##============================================================================
 
 ##
 # Processes a Shuntfile and creates materializes all the views
-def materialize_views( shuntfile_path, parents = None ):
+#
+# If incremental is True, the materialization path is not emptied.
+# Instead a manifest (see shunt.manifest) next to the materialization
+# path records the inputs of every output, and only outputs whose
+# inputs changed are re-rendered/re-copied. Outputs which are no longer
+# produced are removed, including those of subprojects which left the
+# tree or now materialize somewhere else.
+#
+# All views (of this shuntfile and its subprojects) are rendered with
+# jinja2 environments from a single EnvironmentPool, so shared templates
+# are compiled once per run. If bytecode_cache is True the compiled
+# templates are also cached on disk next to the materialization path
+# so later runs skip compilation.
+#
+# If jobs > 1, views are rendered in a pool of that many worker
+# processes (each with its own template caches). Log output stays in
+# view order and failures are reported per view.
+#
+# The whole subproject tree is loaded first, then Shuntfiles are
+# materialized by a scheduler (see shunt.scheduler) using up to
+# subproject_jobs threads: a subproject starts once its parent and
+# everything in its 'project/depends_on' list is done. Unless
+# incremental, Shuntfiles sharing a materialization path still run
+# one after the other in tree order since each one empties it.
+#
+# Unless incremental, every existing materialization path must be
+# safe to empty (see shunt.tfstate). Those checks read the local
+# terraform state natively and all run concurrently at the start.
+#
+# Remote (git, s3) template paths are fetched, concurrently, into a
+# persistent FetchCache (see shunt.fetch) rather than into the
+# materialization path. Cached fetches younger than fetch_ttl seconds
+# are used as is and offline=True never touches the network.
+#
+# Resources are placed using resource_strategy (one of
+# resources.COPY_STRATEGIES) unless they have their own 'strategy' key,
+# and unchanged resources are detected with change_detection (one of
+# resources.CHANGE_DETECTIONS).
+#
+# The phases of the run are timed as spans (see shunt.profiling) when
+# profiling is enabled.
+#
+# An env_pool may be given to keep compiled templates across runs (as
+# --watch does); jinja2 recompiles templates whose files changed.
+#
+# When incremental, only may restrict the run to what some changes
+# affect (see watch.affected_selection): a map resolved Shuntfile path
+# => { 'views' : view names, 'resources' : resource targets }.
+# Shuntfiles not in it are skipped, and the other views and resources
+# of the ones in it are taken as unchanged without looking at their
+# inputs.
+def materialize_views( shuntfile_path,
+                       parents = None,
+                       incremental = False,
+                       bytecode_cache = False,
+                       jobs = 1,
+                       subproject_jobs = 1,
+                       fetch_cache_path = None,
+                       fetch_ttl = fetch.DEFAULT_FETCH_TTL,
+                       offline = False,
+                       resource_strategy = resources.DEFAULT_COPY_STRATEGY,
+                       change_detection = resources.DEFAULT_CHANGE_DETECTION,
+                       env_pool = None,
+                       only = None ):
+
+    if only is not None and not incremental:
+        raise ValueError( "Restricting a materialization to some views requires incremental" )
+
+    # template folders are looked for once per run (and their file
+    # indexes checked for changes), Shuntfiles are only re-parsed if
+    # they changed since they were last loaded
+    project_paths.clear_template_path_cache()
+    template_index.invalidate()
+
+    # load the whole subproject tree and work out what can run
+    # concurrently
+    with profiling.span( "load subproject tree" ):
+        nodes = scheduler.build_subproject_tree( shuntfile_path, parents )
+        scheduler.link_dependencies( nodes,
+                                     serialize_shared_paths = not incremental )
+
+    # the environment pool and worker processes are shared by the
+    # whole run (all subprojects)
+    bytecode_cache_path = None
+    if bytecode_cache:
+        bytecode_cache_path = project_paths.bytecode_cache_path(
+            nodes[0].materialize_path )
+    if env_pool is None:
+        env_pool = environments.EnvironmentPool( bytecode_cache_path )
+    fetch_cache = fetch.FetchCache( fetch_cache_path,
+                                    ttl = fetch_ttl,
+                                    offline = offline )
+    executor = None
+    if jobs is not None and jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = jobs,
+            initializer = _init_view_worker,
+            initargs = ( bytecode_cache_path, profiling.is_enabled() ) )
+    run = MaterializeRun( incremental = incremental,
+                          env_pool = env_pool,
+                          fetch_cache = fetch_cache,
+                          executor = executor,
+                          resource_strategy = resource_strategy,
+                          change_detection = change_detection )
+
+    # unless incremental, every existing materialization path is
+    # checked before it is emptied. The checks for the whole tree start
+    # now, all at once
+    check_executor = None
+    if not incremental:
+        paths = sorted( set( node.materialize_path for node in nodes
+                             if pathlib.Path( node.materialize_path ).exists() ) )
+        if len( paths ) > 0:
+            check_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = min( len( paths ), tfstate.DEFAULT_CHECK_WORKERS ) )
+            run.safety_checks = { p : check_executor.submit( tfstate.check_safe_to_empty, p )
+                                  for p in paths }
+
+    def _materialize_node( node ):
+        selected = None
+        if only is not None:
+            selected = only.get( pathlib.Path( node.shuntfile_path ).resolve().as_posix() )
+            if selected is None:
+                logger.info( "Shuntfile '{0}' not affected, skipping".format( node.shuntfile_path ) )
+                return
+        with profiling.span( node.shuntfile_path, cat = 'shuntfile' ):
+            _materialize_shuntfile( node.shuntfile_path,
+                                    node.sf,
+                                    node.parents,
+                                    run,
+                                    selected )
+
+    try:
+        scheduler.run_schedule(
+            nodes,
+            _materialize_node,
+            max_workers = subproject_jobs )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if check_executor is not None:
+            check_executor.shutdown()
+
+    # the outputs of Shuntfiles which left the tree (or materialize
+    # somewhere else now) go along with their manifest entries
+    if incremental and only is None:
+        with profiling.span( "prune manifests" ):
+            _prune_manifests( nodes, run )
+
+    env_pool.log_stats()
+    run.outputs.log_summary()
+    shuntfile.log_shuntfile_stats()
+
+##============================================================================
+
+##
+# Removes the manifest and dependency graph entries, and the outputs,
+# of Shuntfiles no longer materialized where they were. Every
+# materialization path of the tree now, and of the tree as of its
+# previous run (recorded in the manifest of its root), is looked at.
+# Materialization paths which left the tree are removed once empty
+def _prune_manifests( nodes, run ):
+    produced = {}
+    for node in nodes:
+        produced.setdefault( node.materialize_path, set() ).add(
+            pathlib.Path( node.shuntfile_path ).resolve().as_posix() )
+    root = manifest.Manifest.load( nodes[0].materialize_path )
+    for path in sorted( set( produced ) | set( root.tree_paths() ) ):
+        keep = produced.get( path, set() )
+        deleted = manifest.Manifest.load( path ).prune( keep )
+        dependencies.DependencyGraph.load( path ).prune( keep )
+        run.outputs.add( { 'deleted' : deleted } )
+        if path not in produced and pathlib.Path( path ).is_dir():
+            try:
+                os.rmdir( path )
+                logger.info( "Removed empty materialization path '{0}', no longer in the tree".format( path ) )
+            except OSError:
+                pass
+    root.set_tree_paths( produced )
+
+##============================================================================
+
+##
+# Counts of what happened to the outputs of a run: files written,
+# files left alone because their content was already right (and the
+# bytes not rewritten) and stale files deleted.
+# Shuntfiles materialized concurrently add to it from their threads
+class OutputCounts( object ):
+
+    def __init__( self ):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add( self, counts ):
+        with self.lock:
+            self.counts.update( counts )
+
+    def log_summary( self ):
+        c = self.counts
+        logger.info( "Outputs: {0} written, {1} unchanged ({2} bytes not rewritten), {3} deleted".format(
+            c[ 'written' ],
+            c[ 'unchanged' ],
+            c[ 'unchanged_bytes' ],
+            c[ 'deleted' ] ) )
+
+##============================================================================
+
+##
+# The state shared by every Shuntfile materialized in a single
+# materialize_views run: the options, the EnvironmentPool, the
+# FetchCache, the view executor (None to render in this process), the
+# OutputCounts and the materialization path safety checks started
+# ( materialize path => Future )
+class MaterializeRun( object ):
+
+    def __init__( self,
+                  incremental,
+                  env_pool,
+                  fetch_cache,
+                  executor,
+                  resource_strategy,
+                  change_detection ):
+        self.incremental = incremental
+        self.env_pool = env_pool
+        self.fetch_cache = fetch_cache
+        self.executor = executor
+        self.resource_strategy = resource_strategy
+        self.change_detection = change_detection
+        self.outputs = OutputCounts()
+        self.safety_checks = {}
+
+##============================================================================
+
+##
+# Materializes a single, already loaded, Shuntfile (but not its
+# subprojects) as part of the given MaterializeRun.
+# If selected is given (incremental runs only) the views and resources
+# outside of it keep what the manifest says they were
+def _materialize_shuntfile( shuntfile_path,
+                            sf,
+                            parents,
+                            run,
+                            selected = None ):
+
+    incremental = run.incremental
+    env_pool = run.env_pool
 
     logger.info( "Materializing Shuntfile '{0}'".format(
         shuntfile_path ) )
 
-    # ok, load the shuntfile
-    sf = shuntfile.load_shuntfile( shuntfile_path )
-
     # validate that the shuntfile has the needed structure
     validate_shuntfile( sf )
     logger.info( "Shuntfile at '{0}' valid!".format( shuntfile_path ) )
 
-    # ensure materiale directory exists and is empty
+    # ensure materiale directory exists and will be emptied of
+    # everything this Shuntfile does not produce (unless incremental,
+    # in which case we consult the manifest).
+    # Outputs are only rewritten if their content changes, so the
+    # directory is emptied once they are all in place
     materialize_path = project_paths.materialize_path( sf, parents )
-    if pathlib.Path( materialize_path ).exists():
-        logger.info( "Emptying previous materialization directory '{0}'".format( materialize_path ) )
-        _safe_empty_materialize_path( materialize_path )
+    empty_afterwards = False
+    if incremental:
+        mf = manifest.Manifest.load( materialize_path )
+        manifest_key = pathlib.Path( shuntfile_path ).resolve().as_posix()
+        previous = mf.entry( manifest_key )
+    elif pathlib.Path( materialize_path ).exists():
+        logger.info( "Checking previous materialization directory '{0}' can be emptied".format( materialize_path ) )
+        with profiling.span( "check materialization path" ):
+            _check_safe_to_empty( materialize_path, run )
+        empty_afterwards = True
     materialize_path = ensure_path( materialize_path )
     
     # ok, we want to take the template paths and process any which
@@ -40,163 +307,374 @@ def materialize_views( shuntfile_path, parents = None ):
     # This is because we allow git,s3 and other URL type paths.
     logger.info( "Materializing template paths" )
     template_paths = project_paths.find_all_template_paths(shuntfile_path)
-    template_paths = [ _materialize_path( p,
-                                          materialize_path )
-                       for p in template_paths ]
+    with profiling.span( "fetch template paths" ):
+        template_paths = run.fetch_cache.fetch_all( template_paths )
     logger.info( "Template paths: {0}".format( template_paths ) )
-
+    with profiling.span( "index template paths" ):
+        template_index.get_template_index( template_paths ).log_shadowed()
+
+    # the new manifest entry for this shuntfile. If the shuntfile
+    # itself or the template search path changed then nothing
+    # from the previous run can be trusted
+    if incremental:
+        entry = manifest.empty_entry()
+        entry[ 'hmap' ] = manifest.hash_hmap( sf.hmap )
+        entry[ 'template_paths' ] = template_paths
+        if ( previous[ 'hmap' ] != entry[ 'hmap' ]
+             or previous[ 'template_paths' ] != template_paths ):
+            logger.info( "Shuntfile or template paths changed, everything is out of date" )
+            previous = manifest.empty_entry()
 
     # ok, grab all of the resources and copy them
     logger.info( "Copying resources" )
+    resource_sources = {}
     for res in shuntfile.shuntfile_get( sf, ['project','resources'], [] ):
+        source_path, target_path = _resource_paths( template_paths,
+                                                    materialize_path,
+                                                    res )
+        resource_sources[ target_path ] = source_path
+
+        # skip resources whose content has not changed
+        if incremental:
+            old = previous[ 'resources' ].get( target_path )
+            if ( selected is not None
+                 and target_path not in selected[ 'resources' ]
+                 and old is not None
+                 and pathlib.Path( target_path ).exists() ):
+                entry[ 'resources' ][ target_path ] = old
+                continue
+            info = {
+                'source' : source_path,
+                'strategy' : resources.resource_strategy( res, run.resource_strategy ),
+                'signature' : resources.resource_signature( source_path,
+                                                            run.change_detection ),
+            }
+            entry[ 'resources' ][ target_path ] = info
+            if ( old == info
+                 and pathlib.Path( target_path ).exists() ):
+                logger.info( "Resource '{0}' unchanged, skipping".format( res ) )
+                continue
 
         # copy the resource
         _copy_resource( template_paths,
                         materialize_path,
-                        res )
+                        res,
+                        strategy = run.resource_strategy,
+                        outputs = run.outputs )
 
     # now, grab all of the wanted views
     logger.info( "Materializing views" )
+    env = env_pool.get( template_paths )
+    graph = dependencies.DependencyGraph.load( materialize_path )
+    graph_key = pathlib.Path( shuntfile_path ).resolve().as_posix()
+    previous_graph = graph.entry( graph_key ) or { 'views' : {} }
+    views = []
     for view in shuntfile.shuntfile_get( sf, ['project','views'], [] ):
 
-        # materialize the view
-        logger.info( "Materialize view '{0}'".format( view ) )
-        res = _materialize_view(
-            template_paths,
-            materialize_path,
-            view )
-        logger.info( "Materialized '{0}' to '{1}'".format(
-            view, res ) )
-
-    # ok, now grab all of hte subprojects and recurse
-    logger.info( "Processing subprojects" )
-    for proj in shuntfile.shuntfile_get( sf, ['project','subprojects'],[]):
-        new_parents = parents
-        if new_parents is None:
-            new_parents = []
-        new_parents = [ sf ] + new_parents
-        proj_path = ( pathlib.Path( shuntfile_path ) / ".." / proj / shuntfile.SHUNT_FILENAME ).resolve().as_posix()
-        logger.info( "Processing Subproject '{0}'".format( proj ) )
-        materialize_views( proj_path, parents = new_parents )
+        # skip views whose template closure has not changed
+        if incremental:
+            mpath = _view_output_path( materialize_path, view )
+            old = previous[ 'views' ].get( view )
+            if ( selected is not None
+                 and view not in selected[ 'views' ]
+                 and old is not None
+                 and old[ 'output' ] == mpath
+                 and pathlib.Path( mpath ).exists() ):
+                entry[ 'views' ][ view ] = old
+                continue
+            if ( old is not None
+                 and not old[ 'dynamic' ]
+                 and old[ 'output' ] == mpath
+                 and pathlib.Path( mpath ).exists()
+                 and manifest.template_inputs_unchanged( env, old[ 'inputs' ] ) ):
+                logger.info( "View '{0}' unchanged, skipping".format( view ) )
+                entry[ 'views' ][ view ] = old
+                continue
+            inputs, dynamic = manifest.template_closure( env, view )
+            entry[ 'views' ][ view ] = {
+                'output' : mpath,
+                'inputs' : inputs,
+                'dynamic' : dynamic,
+            }
+
+        views.append( view )
+
+    # materialize the views
+    loaded = _materialize_view_list( template_paths,
+                                     materialize_path,
+                                     views,
+                                     env_pool,
+                                     run.executor,
+                                     outputs = run.outputs )
+
+    # drop whatever this Shuntfile did not produce
+    if empty_afterwards:
+        keep = set( resource_sources )
+        keep.update( _view_output_path( materialize_path, view )
+                     for view in shuntfile.shuntfile_get( sf, ['project','views'], [] ) )
+        with profiling.span( "empty materialization path" ):
+            deleted = _remove_other_outputs( materialize_path, keep )
+        run.outputs.add( { 'deleted' : deleted } )
+
+    # record what every view depends on. Views which were not rendered
+    # keep what they depended on when they last were
+    with profiling.span( "update dependency graph" ):
+        graph_entry = {
+            'template_paths' : template_paths,
+            'views' : {},
+            'resources' : resource_sources,
+        }
+        for view in shuntfile.shuntfile_get( sf, ['project','views'], [] ):
+            old = previous_graph[ 'views' ].get( view )
+            if view not in loaded and old is not None:
+                graph_entry[ 'views' ][ view ] = old
+                continue
+            # the static closure comes for free when incremental,
+            # otherwise what the render loaded is all there is to it
+            inputs = {}
+            if incremental:
+                inputs = entry[ 'views' ][ view ][ 'inputs' ]
+            graph_entry[ 'views' ][ view ] = {
+                'output' : _view_output_path( materialize_path, view ),
+                'templates' : dependencies.view_templates( env,
+                                                           view,
+                                                           loaded.get( view, {} ),
+                                                           inputs ),
+            }
+        if graph.entry( graph_key ) != graph_entry:
+            graph.update( graph_key, graph_entry )
+
+    # record what we produced, removing stale outputs. The templates
+    # loaded while rendering complete the inputs of views including
+    # templates by names only known at render time
+    if incremental:
+        for view in views:
+            dependencies.add_loaded_inputs( env,
+                                            entry[ 'views' ][ view ][ 'inputs' ],
+                                            loaded[ view ] )
+            entry[ 'views' ][ view ][ 'dynamic' ] = False
+        with profiling.span( "update manifest" ):
+            deleted = mf.update( manifest_key, entry )
+        run.outputs.add( { 'deleted' : deleted } )
 
     # done message log
     logger.info( "Done Materializing Shutnfile '{0}'".format( shuntfile_path ) )
 
 ##============================================================================
 
-##
-# Actually materialize a single view.
-# This will run the jinja2 template defined by hte view and
-# output hte result into the materialzation path directory, creating
-# it if need be
-def _materialize_view( template_paths,
-                       materialize_path,
-                       view_name ):
-
+##============================================================================
 
+##
+# Materialize a list of views, in order.
+#
+# If an executor is given the views are rendered concurrently in its
+# worker processes, but the results are still logged in view order.
+# Every view is attempted, and if any fail a RuntimeError naming the
+# failed views is raised afterwards.
+#
+# Returns a map view-name => the templates loaded rendering it (see
+# dependencies.record_template_loads). Written and unchanged outputs
+# are counted in outputs (an OutputCounts) if given
+def _materialize_view_list( template_paths,
+                            materialize_path,
+                            views,
+                            env_pool,
+                            executor,
+                            outputs = None ):
+
+    def _count( outcome ):
+        if outputs is None:
+            return
+        if outcome[ 'written' ]:
+            outputs.add( { 'written' : 1 } )
+        else:
+            outputs.add( { 'unchanged' : 1, 'unchanged_bytes' : outcome[ 'bytes' ] } )
+
+    # serial rendering right here
+    loaded = {}
+    if executor is None:
+        for view in views:
+            logger.info( "Materialize view '{0}'".format( view ) )
+            res, loaded[ view ], outcome = _materialize_view(
+                template_paths,
+                materialize_path,
+                view,
+                env_pool = env_pool )
+            _count( outcome )
+            logger.info( "Materialized '{0}' to '{1}'".format(
+                view, res ) )
+        return loaded
+
+    # submit all views to the workers, then collect in order
+    futures = [ executor.submit( _materialize_view_job,
+                                 template_paths,
+                                 materialize_path,
+                                 view )
+                for view in views ]
+    failed = []
+    for view, future in zip( views, futures ):
+        logger.info( "Materialize view '{0}'".format( view ) )
+        res, stats, error, events, loaded[ view ], outcome = future.result()
+        env_pool.add_stats( stats )
+        profiling.add_events( events )
+        if error is not None:
+            logger.error( "Unable to materialize view '{0}':\n{1}".format(
+                view, error ) )
+            failed.append( view )
+            continue
+        _count( outcome )
+        logger.info( "Materialized '{0}' to '{1}'".format(
+            view, res ) )
+    if len( failed ) > 0:
+        msg = "Unable to materialize views {0} in '{1}'".format(
+            failed, materialize_path )
+        raise RuntimeError( msg )
+    return loaded
 
-    # ok, create a jinja2 environment with the given template paths
-    env = jinja2.Environment(
-        loader = jinja2.FileSystemLoader( template_paths,
-                                          followlinks=True ) )
-    logger.info( "_materialize_view: jinja2 template paths set to '{0}'".format(
-        template_paths ) )
+##============================================================================
 
-    # grab the template file using hte view name
-    template = env.get_template( view_name )
+##
+# The EnvironmentPool of a view worker process.
+# It lives as long as the worker so compiled templates are reused
+# for every view the worker renders
+_WORKER_ENV_POOL = None
 
-    # ok, render hte template to a file with the name
-    mpath = ( pathlib.Path( materialize_path ) / view_name ).resolve().as_posix()
-    with open( mpath, 'w' ) as f:
-        f.write( template.render() )
-    logger.info( "  rendered template for view '{1}' into '{0}'".format(
-        mpath,
-        view_name ) )
+##
+# Initializes a view worker process.
+# Workers do not log informational messages themselves (the parent
+# logs for them, in order) so that log output stays deterministic.
+# If profile is True the worker records spans and hands them back
+# with every view
+def _init_view_worker( bytecode_cache_path, profile = False ):
+    global _WORKER_ENV_POOL
+    _WORKER_ENV_POOL = environments.EnvironmentPool( bytecode_cache_path )
+    logging.disable( logging.INFO )
+    if profile:
+        profiling.enable()
 
-    return mpath
+##
+# Renders a single view in a worker process.
+# Returns ( output-path, cache-stats, error, profile-events,
+# loaded-templates, outcome ) where error is None or the formatted
+# traceback of the failure
+def _materialize_view_job( template_paths,
+                           materialize_path,
+                           view_name ):
+    before = collections.Counter( _WORKER_ENV_POOL.stats )
+    res = None
+    loaded = {}
+    outcome = None
+    error = None
+    try:
+        res, loaded, outcome = _materialize_view( template_paths,
+                                                  materialize_path,
+                                                  view_name,
+                                                  env_pool = _WORKER_ENV_POOL )
+    except Exception:
+        error = traceback.format_exc()
+    stats = collections.Counter( _WORKER_ENV_POOL.stats ) - before
+    return res, dict( stats ), error, profiling.drain_events(), loaded, outcome
 
 ##============================================================================
 
 ##
-# Given a path and a materialize_path,
-# materializes any paths needed and returns the resulting set of path.
+# Actually materialize a single view.
+# This will run the jinja2 template defined by hte view and
+# output hte result into the materialzation path directory, creating
+# it if need be.
 #
-# This handles URL/URI style paths by downloading them (recursively)
-# into the materialize_path if the materialize_path does not exists
-def _materialize_path( path,
-                        materialize_path,
-                        force=False ):
-
-    # string paths are trated as already materialized
-    if isinstance( path, str ):
-        return path
-
-    # ok, ensure that path is astructure
-    if not isinstance( path, dict ):
-        msg = "Invalid path object. Expected string or dictionary but got type={0} '{1}'".format(
-            type(path),
-            path )
-        raise ValueError( msg )
-
-    # makre sure we at least have a source and destination
-    if 'source' not in path or 'destination' not in path:
-        msg = "Malformed path object. Paths need to have 'source' and 'destination' keys defined. Path = '{0}'".format( path )
-        raise ValueError( msg )
-
-    # ok, lookup the source
-    source = path['source']
-    if source not in KNOWN_PATH_MATERIALIZATION_SOURCES:
-        msg = "Invalid path source '{0}'. We don't know how to materialize such a path".format( source )
-        raise ValueError( msg )
-
-    # check if destination already there and not forcing
-    if ( pathlib.Path( materialize_path ) / path['destination'] ).exists() and not force:
-        logger.info( "Skipping materialization of path '{0}' because destination exists and not forcing".format( path ) )
-        return ( pathlib.Path(materialize_path) / path['destination'] ).resolve().as_posix()
+# The jinja2 environment comes from the given EnvironmentPool (or a
+# fresh pool if None) so templates already compiled are reused.
+#
+# The view is streamed to disk chunk by chunk (so it never has to
+# fit in memory as a single string) into a temporary file which then
+# atomically replaces the output, so a failed render never leaves a
+# half-written view behind. An output whose content did not change is
+# not replaced at all (so it keeps its modification time).
+#
+# Returns ( output-path, loaded, outcome ) where loaded maps the name
+# of every template loaded for the view to its file (see
+# shunt.dependencies) and outcome is { 'written', 'bytes' }
+def _materialize_view( template_paths,
+                       materialize_path,
+                       view_name,
+                       env_pool = None ):
+
+    with profiling.span( view_name, cat = 'view' ) as view_span:
+
+        # ok, grab a jinja2 environment with the given template paths
+        if env_pool is None:
+            env_pool = environments.EnvironmentPool()
+        env = env_pool.get( template_paths )
+        logger.info( "_materialize_view: jinja2 template paths set to '{0}'".format(
+            template_paths ) )
+
+        # grab the template file using hte view name, recording every
+        # template it loads (here and while rendering)
+        with dependencies.record_template_loads() as loaded:
+            with profiling.span( "compile view template" ):
+                template = env.get_template( view_name )
+
+            # ok, render hte template to a file with the name
+            mpath = _view_output_path( materialize_path, view_name )
+            outcome = {}
+            with profiling.span( "render view" ):
+                with _atomic_output( mpath, outcome = outcome ) as f:
+                    for chunk in template.generate():
+                        f.write( chunk )
+                view_span.set( 'bytes', outcome[ 'bytes' ] )
+                view_span.set( 'written', outcome[ 'written' ] )
+        if outcome[ 'written' ]:
+            logger.info( "  rendered template for view '{1}' into '{0}'".format(
+                mpath,
+                view_name ) )
+        else:
+            logger.info( "  rendered template for view '{1}' unchanged, kept '{0}'".format(
+                mpath,
+                view_name ) )
 
-    # ok, grab the materialzer and run it
-    return KNOWN_PATH_MATERIALIZATION_SOURCES[ source ]( path,
-                                                         materialize_path,
-                                                         force = force )
+    return mpath, loaded, outcome
 
 ##============================================================================
 
 ##
-# Materialzie a git path
-def _git_materialize_path( path,
-                           materialize_path,
-                           force=False ):
-
-    logger.info( "Materializing GIT path: '{0}' into '{1}'".format(
-        path, materialize_path ) )
-    donep = subprocess.run( ['git','clone'] + path['args'],
-                            cwd = materialize_path,
-                            check = True )
-    return (pathlib.Path(materialize_path) / path['destination'] ).resolve().as_posix()
-    
-##============================================================================
+# Size of the write buffer used when streaming outputs to disk
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
 ##
-# Materialzie an s3 path
-def _s3_materialize_path( path,
-                          materialize_path,
-                          force=False ):
-
-    logger.info( "Materializing S3 path: '{0}' into '{1}'".format(
-        path, materialize_path ) )
-    donep = subprocess.run( ['aws','s3'] + path['args'],
-                            cwd = materialize_path,
-                            check = True )
-    return (pathlib.Path(materialize_path) / path['destination'] ).resolve().as_posix()
+# Context manager opening a temporary file next to the given path for
+# writing. When the block finishes the temporary file atomically
+# replaces the path, if the block raises it is removed instead.
+#
+# If an outcome dictionary is given, a path which already has the
+# same content (see manifest.same_content) is left alone, and outcome
+# gets 'written' (whether the path was replaced) and 'bytes' (its size)
+@contextlib.contextmanager
+def _atomic_output( path, mode = 'w', outcome = None ):
+    tmp_path = "{0}.{1}.{2}.shunt-tmp".format( path,
+                                               os.getpid(),
+                                               threading.get_ident() )
+    try:
+        with open( tmp_path, mode, buffering = OUTPUT_BUFFER_SIZE ) as f:
+            yield f
+        if outcome is not None:
+            outcome[ 'bytes' ] = os.path.getsize( tmp_path )
+            outcome[ 'written' ] = not ( os.path.isfile( path )
+                                         and not os.path.islink( path )
+                                         and manifest.same_content( tmp_path, path ) )
+            if not outcome[ 'written' ]:
+                return
+        os.replace( tmp_path, path )
+    finally:
+        if os.path.exists( tmp_path ):
+            os.remove( tmp_path )
 
 ##============================================================================
 
 ##
-# A mapping from source to path materalizer function for paths
-KNOWN_PATH_MATERIALIZATION_SOURCES = {
-    'git' : _git_materialize_path,
-    's3' : _s3_materialize_path,
-}
+# Returns the path a view is materialized to
+def _view_output_path( materialize_path, view_name ):
+    return ( pathlib.Path( materialize_path ) / view_name ).resolve().as_posix()
 
 ##============================================================================
 
@@ -209,10 +687,48 @@ def validate_shuntfile( sf ):
 ##============================================================================
 
 ##
-# Copy a resource into hte materialization path
+# Copy a resource into hte materialization path.
+# The resource is placed with its own 'strategy' if it has one,
+# otherwise with the given strategy (see shunt.resources). Files already
+# up to date at the target are not copied again. The files written,
+# left alone and deleted are counted in outputs (an OutputCounts) if
+# given
 def _copy_resource( template_paths,
                     materialize_path,
-                    res ):
+                    res,
+                    strategy = resources.DEFAULT_COPY_STRATEGY,
+                    outputs = None ):
+
+    # resolve the source and target paths
+    source_path, target_path = _resource_paths( template_paths,
+                                                materialize_path,
+                                                res )
+
+    # ok, copy the file
+    strategy = resources.resource_strategy( res, strategy )
+    with profiling.span( target_path, cat = 'resource', strategy = strategy ) as res_span:
+        counts = resources.place_resource( source_path,
+                                           target_path,
+                                           strategy )
+        res_span.set( 'files', counts[ 'written' ] )
+        res_span.set( 'bytes', counts[ 'written_bytes' ] )
+    if outputs is not None:
+        outputs.add( counts )
+    logger.info( "copied resource '{0}' TO -> '{1}' ({2}, {3} files placed, {4} unchanged)".format(
+        source_path,
+        target_path,
+        strategy,
+        counts[ 'written' ],
+        counts[ 'unchanged' ] ) )
+
+##============================================================================
+
+##
+# Returns the ( source, target ) paths for a resource.
+# Raises ValueError if the resource does not exist or has no target
+def _resource_paths( template_paths,
+                     materialize_path,
+                     res ):
 
     # get source path
     source_path = None
@@ -238,29 +754,25 @@ def _copy_resource( template_paths,
         msg = "Unable to copy resource '{0}', target path is not defined".format(res)
         raise ValueError( msg )
 
-    # resolve the target path
+    # resolve the target path. The target itself may be a symlink
+    # placed by a previous run, which must not be followed
     if pathlib.Path( target_path ).is_absolute():
-        target_path = pathlib.Path( materialize_path ).joinpath( pathlib.Path( target_path ).name ).resolve().as_posix()
-    else:
-        target_path = pathlib.Path( materialize_path ).joinpath( target_path ).resolve().as_posix()
+        target_path = pathlib.Path( target_path ).name
+    target_path = pathlib.Path( os.path.normpath( os.path.join(
+        pathlib.Path( materialize_path ).resolve().as_posix(),
+        target_path ) ) ).as_posix()
 
-    # ok, copy the file
-    if pathlib.Path( source_path ).is_dir():
-        shutil.copytree( source_path,
-                        target_path )
-    else:
-        shutil.copyfile( source_path,
-                         target_path )
-    logger.info( "copied resource '{0}' TO -> '{1}'".format(
-        source_path,
-        target_path ) )
+    return source_path, target_path
 
 ##============================================================================
 
 ##
 # Given a set of paths and a relative path,
 # searches the paths in order and returns the first which includes
-# a file or directory at the given relative path
+# a file or directory at the given relative path.
+#
+# The paths are searched through their index (see
+# shunt.template_index) rather than probed one by one
 def resolve_path( paths,
                   relative_path ):
 
@@ -278,12 +790,8 @@ def resolve_path( paths,
         else:
             return None
 
-    # Ok, check the path relative to the set of paths in order
-    # If it exists then return it as the path
-    for p in paths:
-        if pathlib.Path( p ).joinpath( relative_path ).exists():
-            return pathlib.Path( p ).joinpath( relative_path ).resolve().as_posix()
-    return None
+    # Ok, find the path relative to the set of paths in order
+    return template_index.get_template_index( paths ).resolve( relative_path )
 
 ##============================================================================
 
@@ -302,39 +810,220 @@ def ensure_path( p ):
 ##============================================================================
 
 ##
-# *Safely* empty the materialization path.
-# This takes care of ensuring that the terraform state does not
-# contain any resources, otherwise throws and exception
-def _safe_empty_materialize_path( materialize_path ):
-
-    # ok, call terraform show and make sure nothing is shown
-    cmd = [ 'terraform', 'show', "-no-color" ]
-    donep = subprocess.run( cmd,
-                            cwd = materialize_path,
-                            stdout=subprocess.PIPE,
-                            check = True )
-    if False and len(donep.stdout.strip()) > 1 and donep.stdout.strip().lower() != b"no state.":
-        raise RuntimeError( "Cannot not *safely* delete materialization path '{0}'. `terraform show` still returns resources being managed by terraform. Run `terraform destroy` first before trying to apply a shuntfile again! resources still shown = {1}".format( materialize_path, donep.stdout.strip() ) )
-
-    shutil.rmtree( materialize_path )
-        
+# Make sure the materialization path can *safely* be emptied (see
+# tfstate.check_safe_to_empty), using the check the run already
+# started for it if there is one
+def _check_safe_to_empty( materialize_path, run ):
+    check = run.safety_checks.get( materialize_path, None )
+    if check is not None:
+        check.result()
+        return
+    tfstate.check_safe_to_empty( materialize_path )
+
+##============================================================================
+
+##
+# Empty the materialization path of everything but the given outputs
+# (and whatever is inside those which are directories), leaving it as
+# if it had been emptied before they were materialized.
+# Returns the number of files (and symlinks) removed
+def _remove_other_outputs( materialize_path, keep ):
+    keep = set( pathlib.Path( p ).as_posix() for p in keep )
+    removed = 0
+    directories = []
+    for root, dirs, files in os.walk( materialize_path ):
+        for name in list( dirs ):
+            path = os.path.join( root, name )
+            if path in keep:
+                dirs.remove( name )
+            elif os.path.islink( path ):
+                dirs.remove( name )
+                files.append( name )
+            else:
+                directories.append( path )
+        for name in files:
+            path = os.path.join( root, name )
+            if path not in keep:
+                os.remove( path )
+                removed += 1
+
+    # and the directories left empty, deepest first
+    for path in reversed( directories ):
+        try:
+            os.rmdir( path )
+        except OSError:
+            pass
+    return removed
+
 
 ##============================================================================
 ##============================================================================
 ##============================================================================
 
+##
+# `shunt why VIEW`: explain what a materialized view depends on, from
+# the dependency graphs of the project (see shunt.dependencies).
+# With --changed FILE..., list the views those files would rebuild
+def why( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog = 'shunt why' )
+    parser.add_argument( 'view',
+                         nargs='?',
+                         default=None )
+    parser.add_argument( '--shuntfile',
+                         default='Shuntfile',
+                         help="The Shuntfile of the project (default ./Shuntfile)" )
+    parser.add_argument( '--changed',
+                         nargs='+',
+                         default=None,
+                         metavar='FILE',
+                         help="List the views and resources rebuilt if these files changed" )
+    args = parser.parse_args( argv )
+    if args.view is None and args.changed is None:
+        parser.error( "give a view, --changed files, or both" )
+
+    graphs = dependencies.project_graphs(
+        scheduler.build_subproject_tree( args.shuntfile ) )
+    found = True
+    if args.view is not None:
+        lines = []
+        for graph in graphs:
+            lines.extend( graph.why( args.view ) )
+        if len( lines ) == 0:
+            print( "View '{0}' is not in the dependency graph of '{1}' (materialize it first)".format(
+                args.view, args.shuntfile ) )
+            found = False
+        for line in lines:
+            print( line )
+    if args.changed is not None:
+        for graph in graphs:
+            for sf_path, views in sorted( graph.affected_views( args.changed ).items() ):
+                for view in sorted( views ):
+                    print( "rebuild view '{0}' of '{1}'".format( view, sf_path ) )
+            for sf_path, target in graph.affected_resources( args.changed ):
+                print( "recopy resource '{0}' of '{1}'".format( target, sf_path ) )
+    return 0 if found else 1
+
+##============================================================================
+
 def main():
-    import logging
+    if sys.argv[1:2] == [ 'why' ]:
+        sys.exit( why( sys.argv[2:] ) )
+
     logging.basicConfig( level=logging.INFO )
 
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument( 'shuntfile' )
+    parser.add_argument( '--incremental',
+                         action='store_true',
+                         help="Only re-materialize outputs whose inputs changed since the last run (tracked in a manifest next to the materialization path) instead of emptying the materialization path" )
+    parser.add_argument( '--bytecode-cache',
+                         action='store_true',
+                         help="Cache compiled templates on disk next to the materialization path so later runs skip template compilation" )
+    parser.add_argument( '--jobs', '-j',
+                         type=int,
+                         default=1,
+                         help="Number of worker processes rendering views in parallel (default 1, render in this process)" )
+    parser.add_argument( '--subproject-jobs',
+                         type=int,
+                         default=1,
+                         help="Number of subprojects materialized concurrently (default 1, one after the other)" )
+    parser.add_argument( '--fetch-cache',
+                         default=None,
+                         help="Directory caching remote (git, s3) template paths between runs (default ${0} or ~/.cache/shunt/fetch)".format( fetch.FETCH_CACHE_ENV_VAR ) )
+    parser.add_argument( '--fetch-ttl',
+                         type=float,
+                         default=fetch.DEFAULT_FETCH_TTL,
+                         help="Seconds a cached remote template path is used before it is updated (default {0})".format( fetch.DEFAULT_FETCH_TTL ) )
+    parser.add_argument( '--offline',
+                         action='store_true',
+                         help="Never fetch remote template paths, only use the fetch cache" )
+    parser.add_argument( '--resource-strategy',
+                         choices=resources.COPY_STRATEGIES,
+                         default=resources.DEFAULT_COPY_STRATEGY,
+                         help="How resources without their own 'strategy' are placed into the materialization path (default {0})".format( resources.DEFAULT_COPY_STRATEGY ) )
+    parser.add_argument( '--change-detection',
+                         choices=resources.CHANGE_DETECTIONS,
+                         default=resources.DEFAULT_CHANGE_DETECTION,
+                         help="How unchanged resources are detected with --incremental: size and mtime ('stat') or content hash ('hash') (default {0})".format( resources.DEFAULT_CHANGE_DETECTION ) )
+    parser.add_argument( '--profile',
+                         default=None,
+                         metavar='OUT_JSON',
+                         help="Time the phases of the run and write them as a Chrome trace-event file (chrome://tracing, Perfetto), and log a summary of the slowest views and resources" )
+    parser.add_argument( '--profile-top',
+                         type=int,
+                         default=profiling.DEFAULT_SUMMARY_TOP,
+                         help="Number of slowest views/resources in the --profile summary (default {0})".format( profiling.DEFAULT_SUMMARY_TOP ) )
+    parser.add_argument( '--watch',
+                         action='store_true',
+                         help="After materializing, keep watching the Shuntfiles, template paths and resources and incrementally re-materialize whenever they change (until interrupted)" )
+    parser.add_argument( '--watch-debounce',
+                         type=float,
+                         default=watch.DEFAULT_DEBOUNCE,
+                         help="Seconds without further changes before --watch re-materializes, so bursts of edits make a single run (default {0})".format( watch.DEFAULT_DEBOUNCE ) )
+    parser.add_argument( '--watch-poll',
+                         action='store_true',
+                         help="Make --watch poll for changes instead of using inotify" )
+    parser.add_argument( '--yaml-cache',
+                         default=None,
+                         help="Directory caching parsed YAML (Shuntfiles) keyed by content hash (default ${0}, if set)".format( yamlutils.PARSE_CACHE_ENV_VAR ) )
 
     args = parser.parse_args()
+    if args.yaml_cache is not None:
+        yamlutils.set_parse_cache_path( args.yaml_cache )
+
+    if args.profile is not None:
+        profiling.enable()
 
     sf_path = args.shuntfile
-    materialize_views( sf_path )
+
+    # with --watch the first run is as asked, every later one is
+    # incremental, only redoes what the changes affect and reuses the
+    # compiled templates of the ones before
+    env_pool = None
+    runs = [ 0 ]
+    if args.watch:
+        bytecode_cache_path = None
+        if args.bytecode_cache:
+            nodes = scheduler.build_subproject_tree( sf_path )
+            bytecode_cache_path = project_paths.bytecode_cache_path(
+                nodes[0].materialize_path )
+        env_pool = environments.EnvironmentPool( bytecode_cache_path )
+
+    def _materialize( selection = None ):
+        try:
+            with profiling.span( "materialize_views" ):
+                materialize_views( sf_path,
+                                   incremental = args.incremental or runs[0] > 0,
+                                   bytecode_cache = args.bytecode_cache,
+                                   jobs = args.jobs,
+                                   subproject_jobs = args.subproject_jobs,
+                                   fetch_cache_path = args.fetch_cache,
+                                   fetch_ttl = args.fetch_ttl,
+                                   offline = args.offline,
+                                   resource_strategy = args.resource_strategy,
+                                   change_detection = args.change_detection,
+                                   env_pool = env_pool,
+                                   only = selection )
+        finally:
+            runs[0] += 1
+
+    try:
+        if args.watch:
+            try:
+                watch.watch( sf_path,
+                             _materialize,
+                             debounce = args.watch_debounce,
+                             force_polling = args.watch_poll )
+            except KeyboardInterrupt:
+                logger.info( "Stopped watching" )
+        else:
+            _materialize()
+    finally:
+        if args.profile is not None:
+            profiling.write_trace( args.profile )
+            profiling.log_summary( args.profile_top )
 
 ##============================================================================
 
@@ -1,8 +1,14 @@
 import shunt.logutils as logutils
 logger = logutils.getLogger( __name__ )
 
-import yaml
 import shunt.hmap as hmap
+import shunt.yamlutils as yamlutils
+import shunt.profiling as profiling
+
+import pathlib
+import os
+import collections
+import threading
 
 SHUNT_FILENAME = "Shuntfile"
 
@@ -21,11 +27,59 @@ class Shuntfile( object ):
 ##============================================================================
 
 ##
-# Reads in a shuntfile into an hmap
+# Loaded Shuntfiles keyed by resolved path, along with the
+# ( mtime, size ) of the file when it was parsed
+_SHUNTFILE_CACHE = {}
+_SHUNTFILE_CACHE_LOCK = threading.Lock()
+
+##
+# Counts of Shuntfiles actually parsed and of loads served from cache
+SHUNTFILE_STATS = collections.Counter()
+
+##============================================================================
+
+##
+# Reads in a shuntfile into an hmap.
+#
+# Each file is only parsed once for as long as it does not change
+# (same mtime and size): later loads return the *same* Shuntfile
+# object, so callers must treat the returned object as immutable.
+# Since it is shared, its path is the resolved path whichever path
+# (say one relative to the current directory) it was loaded with
 def load_shuntfile( path ):
-    with open( path ) as f:
-        return Shuntfile( path,
-                          yaml.load( f ) )
+    key = pathlib.Path( path ).resolve().as_posix()
+    st = os.stat( key )
+    signature = ( st.st_mtime_ns, st.st_size )
+    with _SHUNTFILE_CACHE_LOCK:
+        cached = _SHUNTFILE_CACHE.get( key, None )
+        if cached is not None and cached[0] == signature:
+            SHUNTFILE_STATS[ 'cache_hits' ] += 1
+            return cached[1]
+    with profiling.span( "parse Shuntfile", path = key ):
+        sf = Shuntfile( key,
+                        yamlutils.load_yaml_file( key ) )
+    with _SHUNTFILE_CACHE_LOCK:
+        SHUNTFILE_STATS[ 'parses' ] += 1
+        _SHUNTFILE_CACHE[ key ] = ( signature, sf )
+    return sf
+
+##============================================================================
+
+##
+# Forget all cached Shuntfiles (and reset the counts)
+def clear_shuntfile_cache():
+    with _SHUNTFILE_CACHE_LOCK:
+        _SHUNTFILE_CACHE.clear()
+        SHUNTFILE_STATS.clear()
+
+##============================================================================
+
+##
+# Log how many Shuntfiles were parsed versus served from cache
+def log_shuntfile_stats():
+    logger.info( "Shuntfiles: {0} parsed, {1} loads served from cache".format(
+        SHUNTFILE_STATS[ 'parses' ],
+        SHUNTFILE_STATS[ 'cache_hits' ] ) )
 
 ##============================================================================
 
@@ -0,0 +1,458 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.dependencies as dependencies
+import shunt.manifest as manifest
+import shunt.project_paths as project_paths
+
+import os
+import os.path
+import threading
+import time
+
+##============================================================================
+
+##
+# Directories are never indexed inside a template path if they match
+# the ignore patterns of project_paths (version control folders, the
+# template path index, materialization folders and those listed in a
+# '.shuntignore' file of the template path itself) or
+# BYTECODE_CACHE_PATTERN, or if they are materialization folders
+# under another name: directories next to which shunt keeps a
+# manifest or a dependency graph. Otherwise with a template path
+# such as '.' rendered outputs could be found as templates.
+# The patterns are about directories only: files are always indexed,
+# whatever their name (say a template named 'materialized_views.tf')
+BYTECODE_CACHE_PATTERN = "*" + project_paths.BYTECODE_CACHE_SUFFIX
+MATERIALIZATION_MARKERS = ( manifest.MANIFEST_SUFFIX,
+                            dependencies.DEPENDENCIES_SUFFIX )
+
+##
+# How many shadowed files are listed one by one when reporting
+SHADOWED_LOG_LIMIT = 20
+
+##
+# Seconds an index is trusted before the next lookup checks its
+# directories for changes (see get_template_index)
+REFRESH_INTERVAL = 1.0
+
+##============================================================================
+
+##
+# Returns ( mtime_ns, size ) of a file, or None if it does not exist
+def _file_signature( path ):
+    try:
+        st = os.stat( path )
+    except OSError:
+        return None
+    return ( st.st_mtime_ns, st.st_size )
+
+##============================================================================
+
+##
+# Every file and directory below a single template path, found with
+# os.scandir walks.
+#
+# The mtime of every directory walked is kept, so refresh() only
+# lists again the directories in which entries were added, removed or
+# renamed since (file contents do not matter to the index), walking
+# only the directories that are new.
+#
+# Symbolic links whose target does not exist are not indexed (so
+# lookups fall through to later template paths, as with jinja2's
+# FileSystemLoader). Symbolic links are checked again on every
+# refresh, since their targets change without their directory
+class _RootScan( object ):
+
+    def __init__( self, root ):
+        self.root = root
+        self.has_symlinks = False
+        self.version = 0
+        self.generation = None
+        self.refreshed_at = time.monotonic()
+        self._reset()
+
+    ##
+    # Forget everything and walk the whole template path again
+    def _reset( self ):
+        self.ignore_signature = _file_signature(
+            os.path.join( self.root, project_paths.IGNORE_FILENAME ) )
+        self.patterns = project_paths.load_ignore_patterns( self.root ) + [ BYTECODE_CACHE_PATTERN ]
+        self.entries = {}     # relative path => is directory
+        self.dirs = {}        # relative directory => mtime_ns (None if missing)
+        self.children = {}    # relative directory => set of indexed names
+        self.symlinks = set() # relative paths of indexed symlinks
+        self.dangling = set() # relative paths of dangling symlinks
+        self._walk( '' )
+        self.version += 1
+
+    def _path( self, rel ):
+        return self.root if rel == '' else self.root + "/" + rel
+
+    def _join( self, rel, name ):
+        return name if rel == '' else rel + "/" + name
+
+    ##
+    # List a single directory. Returns ( mtime_ns, { name : ( is_dir,
+    # is_symlink ) } ) for the entries to index, or None if it cannot
+    # be listed
+    def _list( self, rel ):
+        path = self._path( rel )
+        try:
+            st = os.stat( path )
+            entries = list( os.scandir( path ) )
+        except OSError:
+            return None
+        names = set( entry.name for entry in entries )
+        listed = {}
+        for entry in entries:
+            child = self._join( rel, entry.name )
+            try:
+                is_dir = entry.is_dir()
+                is_symlink = entry.is_symlink()
+            except OSError:
+                continue
+            if is_dir and ( project_paths.is_ignored( child, entry.name, self.patterns )
+                            or any( entry.name + marker in names
+                                    for marker in MATERIALIZATION_MARKERS ) ):
+                continue
+            if is_symlink and not os.path.exists( entry.path ):
+                self.dangling.add( child )
+                continue
+            listed[ entry.name ] = ( is_dir, is_symlink )
+        return st.st_mtime_ns, listed
+
+    ##
+    # Walk a directory (relative to the root) and everything below it,
+    # adding it all
+    def _walk( self, rel_dir ):
+        stack = [ rel_dir ]
+        while len( stack ) > 0:
+            rel = stack.pop()
+            listing = self._list( rel )
+            if listing is None:
+                if rel == '':
+                    self.dirs[ rel ] = None
+                continue
+            self.dirs[ rel ], listed = listing
+            self.children[ rel ] = set( listed )
+            for name, ( is_dir, is_symlink ) in listed.items():
+                child = self._join( rel, name )
+                self.entries[ child ] = is_dir
+                if is_symlink:
+                    self.has_symlinks = True
+                    self.symlinks.add( child )
+                    if is_dir and self._is_loop( rel, child ):
+                        continue
+                if is_dir:
+                    stack.append( child )
+
+    ##
+    # Returns true iff a symlinked directory points to one of the
+    # directories it is in (so walking it would never end)
+    def _is_loop( self, rel, child ):
+        real = os.path.realpath( self._path( child ) )
+        parent = os.path.realpath( self._path( rel ) )
+        return parent == real or parent.startswith( real + "/" )
+
+    ##
+    # Drop an entry and, for directories, everything known below it
+    def _drop( self, rel ):
+        self.entries.pop( rel, None )
+        self.symlinks.discard( rel )
+        if rel not in self.dirs:
+            return
+        prefix = rel + "/"
+        for key in [ k for k in self.entries if k.startswith( prefix ) ]:
+            del self.entries[ key ]
+        for key in [ k for k in self.dirs if k == rel or k.startswith( prefix ) ]:
+            del self.dirs[ key ]
+            self.children.pop( key, None )
+        self.symlinks = set( k for k in self.symlinks if not k.startswith( prefix ) )
+        self.dangling = set( k for k in self.dangling if not k.startswith( prefix ) )
+
+    ##
+    # List a changed directory again: entries gone are dropped, new
+    # entries are added (new directories walked)
+    def _relist( self, rel ):
+        old_children = self.children.get( rel, set() )
+        self.dangling = set( k for k in self.dangling
+                             if not ( os.path.dirname( k ) == rel ) )
+        listing = self._list( rel )
+        if listing is None:
+            if rel == '':
+                self.entries.clear()
+                self.dirs = { '' : None }
+                self.children.clear()
+                self.symlinks.clear()
+                self.dangling.clear()
+            else:
+                self._drop( rel )
+            return
+        self.dirs[ rel ], listed = listing
+        self.children[ rel ] = set( listed )
+        for name in old_children:
+            child = self._join( rel, name )
+            if name not in listed or listed[ name ][0] != self.entries.get( child ):
+                self._drop( child )
+        for name, ( is_dir, is_symlink ) in listed.items():
+            child = self._join( rel, name )
+            if child in self.entries:
+                continue
+            self.entries[ child ] = is_dir
+            if is_symlink:
+                self.has_symlinks = True
+                self.symlinks.add( child )
+                if is_dir and self._is_loop( rel, child ):
+                    continue
+            if is_dir:
+                self._walk( child )
+
+    ##
+    # Bring the scan up to date with the directories changed since they
+    # were last listed (and dangling symlinks which now resolve).
+    # Returns true iff anything was listed again
+    def refresh( self ):
+        self.refreshed_at = time.monotonic()
+        if self.ignore_signature != _file_signature(
+                os.path.join( self.root, project_paths.IGNORE_FILENAME ) ):
+            logger.debug( "Ignore patterns of template path '{0}' changed".format( self.root ) )
+            self._reset()
+            return True
+        changed = set()
+        for rel, mtime in self.dirs.items():
+            try:
+                current = os.stat( self._path( rel ) ).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                changed.add( rel )
+        for rel in self.dangling:
+            if os.path.exists( self._path( rel ) ):
+                changed.add( os.path.dirname( rel ) )
+        for rel in self.symlinks:
+            if not os.path.exists( self._path( rel ) ):
+                changed.add( os.path.dirname( rel ) )
+        if len( changed ) == 0:
+            return False
+
+        # parents first, so directories they dropped are not listed
+        for rel in sorted( changed ):
+            if rel == '' or rel in self.dirs:
+                self._relist( rel )
+        self.version += 1
+        logger.debug( "Listed {0} changed directories of template path '{1}' again".format(
+            len( changed ), self.root ) )
+        return True
+
+##============================================================================
+
+##
+# An index of the files and directories of a list of template paths
+# (a search path), mapping every relative path to the first template
+# path which has it. It replaces probing every template path in turn
+# with exists() calls, for resources (resolve) and for the jinja2
+# loader (find_file, which like jinja2 only considers files).
+#
+# Entries found in more than one template path are shadowed by the
+# first; shadowed_files lists them.
+class TemplateIndex( object ):
+
+    def __init__( self, scans ):
+        self.scans = scans
+        self.roots = [ s.root for s in scans ]
+        self._versions = None
+        self.first = {}
+        self.first_file = {}
+        self.reported_shadowed = None
+        self._merge()
+
+    ##
+    # Rebuild the merged maps if any template path was rescanned
+    def _merge( self ):
+        versions = [ s.version for s in self.scans ]
+        if versions == self._versions:
+            return
+        first = {}
+        first_file = {}
+        for i in reversed( range( len( self.scans ) ) ):
+            for rel, is_dir in self.scans[ i ].entries.items():
+                first[ rel ] = i
+                if not is_dir:
+                    first_file[ rel ] = i
+        self.first = first
+        self.first_file = first_file
+        self._versions = versions
+
+    ##
+    # Returns the normalized relative path for a lookup, '' for the
+    # template path itself, or None if it points outside of it
+    @staticmethod
+    def _normalize( relative_path ):
+        rel = os.path.normpath( os.fspath( relative_path ) ).replace( os.sep, "/" )
+        if rel == '.':
+            return ''
+        if rel == '..' or rel.startswith( '../' ):
+            return None
+        return rel
+
+    ##
+    # Returns the index of the first template path with a file or
+    # directory at the relative path, or None
+    def find( self, relative_path ):
+        rel = self._normalize( relative_path )
+        if rel is None:
+            return None
+        if rel == '':
+            for i, scan in enumerate( self.scans ):
+                if scan.dirs.get( '' ) is not None:
+                    return i
+            return None
+        return self.first.get( rel, None )
+
+    ##
+    # Returns the index of the first template path (from start on) with
+    # a file at the relative path, or None
+    def find_file( self, relative_path, start = 0 ):
+        rel = self._normalize( relative_path )
+        if rel is None or rel == '':
+            return None
+        i = self.first_file.get( rel, None )
+        if i is None or i >= start:
+            return i
+        for i in range( start, len( self.scans ) ):
+            if self.scans[ i ].entries.get( rel ) is False:
+                return i
+        return None
+
+    ##
+    # Returns the resolved (absolute, symlinks followed) path of the
+    # first file or directory at the relative path in the template
+    # paths, or None. Paths leaving the template paths ('..') are
+    # looked for directly
+    def resolve( self, relative_path ):
+        rel = self._normalize( relative_path )
+        if rel is None:
+            for root in self.roots:
+                path = os.path.join( root, relative_path )
+                if os.path.exists( path ):
+                    return os.path.realpath( path )
+            return None
+        i = self.find( relative_path )
+        if i is None:
+            return None
+        if rel == '':
+            return _realroot( self.roots[ i ] )
+        if self.scans[ i ].has_symlinks:
+            return os.path.realpath( os.path.join( self.roots[ i ], rel ) )
+        return os.path.join( _realroot( self.roots[ i ] ), rel )
+
+    ##
+    # Returns the sorted list of ( relative path, [ template paths ] )
+    # for every file found in more than one template path, the first
+    # template path being the one used
+    def shadowed_files( self ):
+        shadowed = []
+        for rel, first in self.first_file.items():
+            roots = [ self.roots[ first ] ]
+            for i in range( first + 1, len( self.scans ) ):
+                if self.scans[ i ].entries.get( rel ) is False:
+                    roots.append( self.roots[ i ] )
+            if len( roots ) > 1:
+                shadowed.append( ( rel, roots ) )
+        shadowed.sort()
+        return shadowed
+
+    ##
+    # Log the shadowed files, unless they were already logged as they are
+    def log_shadowed( self ):
+        shadowed = self.shadowed_files()
+        if shadowed == self.reported_shadowed:
+            return
+        self.reported_shadowed = shadowed
+        if len( shadowed ) == 0:
+            return
+        logger.info( "{0} file(s) in template paths shadow files of later template paths".format(
+            len( shadowed ) ) )
+        for n, ( rel, roots ) in enumerate( shadowed ):
+            msg = "  '{0}' from '{1}' shadows {2}".format( rel, roots[0], roots[1:] )
+            if n < SHADOWED_LOG_LIMIT:
+                logger.info( msg )
+            else:
+                logger.debug( msg )
+        if len( shadowed ) > SHADOWED_LOG_LIMIT:
+            logger.info( "  ... and {0} more".format( len( shadowed ) - SHADOWED_LOG_LIMIT ) )
+
+##============================================================================
+
+##
+# Returns the resolved path of a template path, cached
+def _realroot( root ):
+    real = _REAL_ROOTS.get( root, None )
+    if real is None:
+        real = os.path.realpath( root )
+        _REAL_ROOTS[ root ] = real
+    return real
+
+_REAL_ROOTS = {}
+
+##============================================================================
+
+##
+# The scans of every template path and the indexes of every search
+# path seen, and the generation they are valid for
+_SCANS = {}
+_INDEXES = {}
+_GENERATION = [ 0 ]
+_LOCK = threading.Lock()
+
+##
+# Returns the index of a list of template paths.
+#
+# Indexes (and the scans of the template paths they share) live for
+# the whole process. They are checked against the mtimes of their
+# directories, so only what changed is listed again, the first time
+# they are used after invalidate() and otherwise at most every
+# REFRESH_INTERVAL seconds
+def get_template_index( template_paths ):
+    key = tuple( os.fspath( p ) for p in template_paths )
+    with _LOCK:
+        generation = _GENERATION[0]
+        now = time.monotonic()
+        index = _INDEXES.get( key, None )
+        if ( index is not None
+             and index.generation == generation
+             and now - index.refreshed_at < REFRESH_INTERVAL ):
+            return index
+        scans = []
+        for root in key:
+            scan = _SCANS.get( root, None )
+            if scan is None:
+                scan = _RootScan( root )
+                _SCANS[ root ] = scan
+            elif ( scan.generation != generation
+                   or now - scan.refreshed_at >= REFRESH_INTERVAL ):
+                scan.refresh()
+            scan.generation = generation
+            scans.append( scan )
+        if index is None:
+            index = TemplateIndex( scans )
+            _INDEXES[ key ] = index
+        else:
+            index._merge()
+        index.generation = generation
+        index.refreshed_at = now
+        return index
+
+##
+# Make every index check its template paths for changes the next time
+# it is used, however recently it was checked (say at the start of
+# every materialization run)
+def invalidate():
+    with _LOCK:
+        _GENERATION[0] += 1
+        _REAL_ROOTS.clear()
+
+##============================================================================
+##============================================================================
+##============================================================================
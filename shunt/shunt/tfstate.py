@@ -0,0 +1,191 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import json
+import os
+import os.path
+import subprocess
+import threading
+
+##============================================================================
+
+##
+# Where terraform keeps state in a working directory with the local
+# backend: the default workspace state, one state per other workspace,
+# and the data directory whose own terraform.tfstate records the
+# configured backend (not resources)
+STATE_FILENAME = "terraform.tfstate"
+WORKSPACE_STATES_DIRNAME = "terraform.tfstate.d"
+DATA_DIRNAME = ".terraform"
+
+##
+# Backends whose state lives in the working directory
+LOCAL_BACKENDS = ( 'local', )
+
+##
+# The state file format versions understood natively
+STATE_VERSIONS = ( 3, 4 )
+
+##
+# Default number of directories checked at the same time
+DEFAULT_CHECK_WORKERS = 8
+
+##
+# directory => ( signature, managed resources ) of the native checks
+# done so far
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+##============================================================================
+
+##
+# Returns the addresses of the managed resources (not data sources)
+# with at least one instance in a parsed state file.
+# Raises ValueError for state formats not understood
+def managed_resources( state ):
+    version = state.get( 'version', None )
+    if version not in STATE_VERSIONS:
+        msg = "Unsupported terraform state version '{0}', known versions are {1}".format(
+            version, STATE_VERSIONS )
+        raise ValueError( msg )
+    addresses = []
+    if version == 4:
+        for res in state.get( 'resources', [] ):
+            if res.get( 'mode', 'managed' ) != 'managed':
+                continue
+            if len( res.get( 'instances', [] ) ) == 0:
+                continue
+            address = "{0}.{1}".format( res.get( 'type' ), res.get( 'name' ) )
+            if res.get( 'module' ):
+                address = "{0}.{1}".format( res[ 'module' ], address )
+            addresses.append( address )
+    else:
+        for module in state.get( 'modules', [] ):
+            path = module.get( 'path', [ 'root' ] )
+            for name in module.get( 'resources', {} ):
+                if name.startswith( 'data.' ):
+                    continue
+                if len( path ) > 1:
+                    name = ".".join( "module.{0}".format( p ) for p in path[1:] ) + "." + name
+                addresses.append( name )
+    return sorted( addresses )
+
+##============================================================================
+
+##
+# Returns the configured backend of a working directory as
+# ( type, config ), the type being None if terraform was never
+# initialized there (so the local backend).
+# Raises RuntimeError if the configuration cannot be read
+def backend( directory ):
+    path = os.path.join( directory, DATA_DIRNAME, STATE_FILENAME )
+    try:
+        with open( path ) as f:
+            data = json.load( f )
+    except FileNotFoundError:
+        return None, {}
+    except ValueError as e:
+        msg = "Unreadable terraform backend configuration '{0}': {1}".format( path, e )
+        raise RuntimeError( msg )
+    if data.get( 'remote' ):
+        return data[ 'remote' ].get( 'type', 'remote' ), data[ 'remote' ].get( 'config', {} ) or {}
+    config = data.get( 'backend' ) or {}
+    return config.get( 'type', 'local' ), config.get( 'config', {} ) or {}
+
+##
+# Returns the local state files of a working directory with the local
+# backend (which may not exist): the default workspace and every other
+# workspace
+def state_files( directory, config = None ):
+    config = config or {}
+    paths = [ os.path.join( directory, config.get( 'path' ) or STATE_FILENAME ) ]
+    workspaces = os.path.join( directory, config.get( 'workspace_dir' ) or WORKSPACE_STATES_DIRNAME )
+    try:
+        names = sorted( os.listdir( workspaces ) )
+    except OSError:
+        names = []
+    for name in names:
+        paths.append( os.path.join( workspaces, name, STATE_FILENAME ) )
+    return paths
+
+##
+# Returns what the native check of a directory depends on: the
+# modification times and sizes of its state files (and their absence)
+def _signature( paths ):
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat( path )
+            signature.append( ( path, st.st_mtime_ns, st.st_size ) )
+        except OSError:
+            signature.append( ( path, None, None ) )
+    return tuple( signature )
+
+##============================================================================
+
+##
+# Returns the addresses of the resources terraform still manages from
+# a working directory, read straight from its local state files, or
+# None if that cannot be known without terraform (a remote backend).
+#
+# Results are cached per directory for as long as none of its state
+# files changes (modification time and size).
+# Raises RuntimeError for local state files which cannot be read
+def local_managed_resources( directory ):
+    directory = os.path.abspath( directory )
+    backend_type, config = backend( directory )
+    if backend_type is not None and backend_type not in LOCAL_BACKENDS:
+        logger.info( "Terraform backend '{0}' of '{1}' is not local".format(
+            backend_type, directory ) )
+        return None
+    paths = state_files( directory, config )
+    signature = _signature( paths )
+    with _CACHE_LOCK:
+        cached = _CACHE.get( directory, None )
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    addresses = []
+    for path, mtime, size in signature:
+        if mtime is None or size == 0:
+            continue
+        try:
+            with open( path ) as f:
+                state = json.load( f )
+            addresses.extend( managed_resources( state ) )
+        except ValueError as e:
+            msg = "Unreadable terraform state file '{0}', refusing to empty '{1}': {2}".format(
+                path, directory, e )
+            logger.error( msg )
+            raise RuntimeError( msg )
+    with _CACHE_LOCK:
+        _CACHE[ directory ] = ( signature, addresses )
+    return addresses
+
+##============================================================================
+
+##
+# Make sure a working directory (a materialization path) can *safely*
+# be emptied: terraform must not manage any resources from it.
+#
+# Local state is read natively. For remote backends `terraform show`
+# must only succeed, its output is not interpreted.
+# Raises RuntimeError if resources are still managed or if local state
+# files cannot be read
+def check_safe_to_empty( directory ):
+    addresses = local_managed_resources( directory )
+    if addresses is not None:
+        if len( addresses ) > 0:
+            raise RuntimeError( "Cannot not *safely* delete materialization path '{0}'. The terraform state still has resources being managed by terraform. Run `terraform destroy` first before trying to apply a shuntfile again! resources still managed = {1}".format( directory, addresses ) )
+        return
+
+    # ok, at least make sure terraform can read the remote state
+    cmd = [ 'terraform', 'show', "-no-color" ]
+    subprocess.run( cmd,
+                    cwd = directory,
+                    stdout=subprocess.PIPE,
+                    check = True )
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,419 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import shunt.dependencies as dependencies
+import shunt.manifest as manifest
+import shunt.project_paths as project_paths
+import shunt.scheduler as scheduler
+import shunt.shuntfile as shuntfile
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import os.path
+import pathlib
+import select
+import struct
+import time
+
+##============================================================================
+
+##
+# Seconds without further changes before a burst of changes is acted
+# upon, and the longest a burst may delay a run
+DEFAULT_DEBOUNCE = 0.05
+MAX_DEBOUNCE_WAIT = 1.0
+
+##
+# Seconds between scans of the polling watcher
+DEFAULT_POLL_INTERVAL = 0.5
+
+##
+# Names never worth reacting to: directories never searched for
+# templates (outputs, indexes, version control), and manifests,
+# caches and temporary files written by shunt itself or by editors.
+# The directory patterns only apply to directories, as in template
+# paths (see shunt.template_index)
+IGNORED_DIRECTORY_NAMES = list( project_paths.DEFAULT_IGNORE_PATTERNS )
+IGNORED_NAMES = [
+    "*" + manifest.MANIFEST_SUFFIX,
+    "*" + dependencies.DEPENDENCIES_SUFFIX,
+    "*" + project_paths.BYTECODE_CACHE_SUFFIX,
+    "*.shunt-tmp",
+    "*.tmp",
+    "*.swp",
+    "*.swx",
+    "*~",
+    ".#*",
+    "4913",
+]
+
+##============================================================================
+
+##
+# Returns true iff changes to a file (or directory if is_dir) name
+# are ignored
+def is_ignored_name( name, is_dir = False ):
+    patterns = IGNORED_NAMES
+    if is_dir:
+        patterns = IGNORED_DIRECTORY_NAMES + IGNORED_NAMES
+    for pattern in patterns:
+        if fnmatch.fnmatch( name, pattern ):
+            return True
+    return False
+
+##============================================================================
+
+##
+# Returns the ( path, recursive ) pairs to watch for a project: the
+# directory of every Shuntfile (not recursively, the Shuntfiles
+# themselves), every local template path (recursively, which covers
+# templates, included templates and resources found through them) and
+# any resources outside of those
+def watch_targets( shuntfile_path ):
+    targets = {}
+    nodes = scheduler.build_subproject_tree( shuntfile_path )
+    for node in nodes:
+        directory = pathlib.Path( node.shuntfile_path ).resolve().parent.as_posix()
+        targets.setdefault( directory, False )
+        template_paths = [ p for p in project_paths.find_all_template_paths( node.shuntfile_path )
+                           if isinstance( p, str ) ]
+        for p in template_paths:
+            targets[ pathlib.Path( p ).resolve().as_posix() ] = True
+        for res in shuntfile.shuntfile_get( node.sf, ['project','resources'], [] ):
+            source = res if isinstance( res, str ) else res.get( 'source', None )
+            if source is None or not pathlib.Path( source ).is_absolute():
+                continue
+            source = pathlib.Path( source ).resolve()
+            if source.is_dir():
+                targets[ source.as_posix() ] = True
+            else:
+                targets.setdefault( source.parent.as_posix(), False )
+    return sorted( targets.items() )
+
+##
+# Returns the materialization paths of a project (with any name, say
+# an explicit materialize_path), whose changes are shunt's own
+def output_paths( shuntfile_path ):
+    return sorted( set( node.materialize_path
+                        for node in scheduler.build_subproject_tree( shuntfile_path ) ) )
+
+##
+# Returns true iff a path is, or is inside, one of the output paths
+def is_output( path, outputs ):
+    return any( path == p or path.startswith( p + "/" ) for p in outputs )
+
+##============================================================================
+
+##
+# Yields every directory to watch for the targets (recursive targets
+# are expanded, skipping ignored directories)
+def _target_directories( targets ):
+    for path, recursive in targets:
+        if not os.path.isdir( path ):
+            continue
+        yield path
+        if not recursive:
+            continue
+        stack = [ path ]
+        while len( stack ) > 0:
+            try:
+                entries = list( os.scandir( stack.pop() ) )
+            except OSError:
+                continue
+            for entry in entries:
+                if ( entry.is_dir( follow_symlinks = False )
+                     and not is_ignored_name( entry.name, is_dir = True ) ):
+                    yield entry.path
+                    stack.append( entry.path )
+
+##============================================================================
+
+##
+# Watches directories by scanning them for changed modification times
+# and sizes. Works everywhere, reacts within poll_interval
+class PollingWatcher( object ):
+
+    def __init__( self, poll_interval = DEFAULT_POLL_INTERVAL ):
+        self.poll_interval = poll_interval
+        self.directories = []
+        self.snapshot = {}
+
+    ##
+    # Watch exactly the given targets from now on
+    def update( self, targets ):
+        self.directories = list( _target_directories( targets ) )
+        self.snapshot = self._scan()
+
+    def _scan( self ):
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                entries = list( os.scandir( directory ) )
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if is_ignored_name( entry.name, is_dir = entry.is_dir() ):
+                        continue
+                    st = entry.stat( follow_symlinks = True )
+                except OSError:
+                    continue
+                snapshot[ entry.path ] = ( st.st_mtime_ns, st.st_size )
+        return snapshot
+
+    ##
+    # Returns the set of changed paths, waiting at most timeout seconds
+    # (None waits for as long as it takes)
+    def wait( self, timeout = None ):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self._scan()
+            changed = set( p for p in current.keys() | self.snapshot.keys()
+                           if current.get( p ) != self.snapshot.get( p ) )
+            self.snapshot = current
+            if len( changed ) > 0:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            pause = self.poll_interval
+            if deadline is not None:
+                pause = min( pause, max( 0.0, deadline - time.monotonic() ) )
+            time.sleep( pause )
+
+    def close( self ):
+        pass
+
+##============================================================================
+
+##
+# inotify constants (see inotify(7))
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_WATCH_MASK = ( _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM
+                   | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+                   | _IN_MOVE_SELF )
+_IN_EVENT_HEADER = struct.Struct( 'iIII' )
+
+##
+# Watches directories with linux inotify (through ctypes, so there
+# is nothing to install). Raises OSError if inotify is not available
+class InotifyWatcher( object ):
+
+    def __init__( self ):
+        libc_name = ctypes.util.find_library( 'c' ) or 'libc.so.6'
+        self.libc = ctypes.CDLL( libc_name, use_errno = True )
+        if not hasattr( self.libc, 'inotify_init1' ):
+            raise OSError( "inotify is not available" )
+        self.fd = self.libc.inotify_init1( _IN_NONBLOCK | _IN_CLOEXEC )
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError( errno, "inotify_init1 failed: {0}".format( os.strerror( errno ) ) )
+        self.watches = {}
+
+    ##
+    # Watch exactly the given targets from now on
+    def update( self, targets ):
+        wanted = set( _target_directories( targets ) )
+        for wd, path in list( self.watches.items() ):
+            if path not in wanted:
+                self.libc.inotify_rm_watch( self.fd, wd )
+                del self.watches[ wd ]
+        for path in wanted:
+            wd = self.libc.inotify_add_watch( self.fd, path.encode( 'utf-8' ), _IN_WATCH_MASK )
+            if wd < 0:
+                errno = ctypes.get_errno()
+                logger.warning( "Unable to watch '{0}': {1}".format( path, os.strerror( errno ) ) )
+                continue
+            self.watches[ wd ] = path
+
+    ##
+    # Returns the set of changed paths, waiting at most timeout seconds
+    # (None waits for as long as it takes)
+    def wait( self, timeout = None ):
+        changed = set()
+        while len( changed ) == 0:
+            ready, _, _ = select.select( [ self.fd ], [], [], timeout )
+            if not ready:
+                return changed
+            try:
+                data = os.read( self.fd, 64 * 1024 )
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset + _IN_EVENT_HEADER.size <= len( data ):
+                wd, mask, _, length = _IN_EVENT_HEADER.unpack_from( data, offset )
+                offset += _IN_EVENT_HEADER.size
+                name = data[ offset : offset + length ].split( b'\0', 1 )[0].decode( 'utf-8', 'replace' )
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    changed.update( self.watches.values() )
+                    continue
+                if mask & _IN_IGNORED:
+                    self.watches.pop( wd, None )
+                    continue
+                directory = self.watches.get( wd, None )
+                if directory is None or ( name and is_ignored_name( name, bool( mask & _IN_ISDIR ) ) ):
+                    continue
+                changed.add( os.path.join( directory, name ) if name else directory )
+        return changed
+
+    def close( self ):
+        if self.fd >= 0:
+            os.close( self.fd )
+            self.fd = -1
+
+##============================================================================
+
+##
+# Returns an inotify watcher where possible, a polling one otherwise
+# (or if force_polling)
+def make_watcher( force_polling = False, poll_interval = DEFAULT_POLL_INTERVAL ):
+    if not force_polling:
+        try:
+            return InotifyWatcher()
+        except ( OSError, AttributeError ) as e:
+            logger.info( "inotify unavailable ({0}), polling for changes instead".format( e ) )
+    return PollingWatcher( poll_interval )
+
+##============================================================================
+
+##
+# Waits for a burst of changes and returns all of them: once something
+# changed, changes keep being collected until none came for debounce
+# seconds (or MAX_DEBOUNCE_WAIT passed)
+def wait_for_changes( watcher, debounce = DEFAULT_DEBOUNCE ):
+    changed = watcher.wait()
+    start = time.monotonic()
+    while time.monotonic() - start < MAX_DEBOUNCE_WAIT:
+        more = watcher.wait( timeout = debounce )
+        if len( more ) == 0:
+            break
+        changed.update( more )
+    return changed
+
+##============================================================================
+
+##
+# Returns what the given changes (absolute paths) affect, as the map
+# resolved Shuntfile path => { 'views' : set of view names,
+# 'resources' : set of resource targets } taken from the dependency
+# graphs of the project (see shunt.dependencies). Shuntfiles with
+# nothing affected are left out.
+#
+# Returns None, meaning everything must be looked at, if a Shuntfile,
+# an ignore file or a template folder changed (the tree, the views or
+# the template search paths may be different) or if a Shuntfile of the
+# tree has no dependency graph entry yet
+def affected_selection( shuntfile_path, changed ):
+    nodes = scheduler.build_subproject_tree( shuntfile_path )
+    keys = set( pathlib.Path( node.shuntfile_path ).resolve().as_posix()
+                for node in nodes )
+    structural = ( shuntfile.SHUNT_FILENAME,
+                   project_paths.IGNORE_FILENAME,
+                   project_paths.TEMPLATE_FOLDER_NAME )
+    for path in changed:
+        if path in keys or os.path.basename( path ) in structural:
+            logger.info( "'{0}' changed, re-materializing everything".format( path ) )
+            return None
+    selection = {}
+    known = set()
+    for graph in dependencies.project_graphs( nodes ):
+        known.update( graph.data[ 'shuntfiles' ] )
+        for sf_path, views in graph.affected_views( changed ).items():
+            if sf_path in keys:
+                selection.setdefault( sf_path, { 'views' : set(), 'resources' : set() } )
+                selection[ sf_path ][ 'views' ].update( views )
+        for sf_path, target in graph.affected_resources( changed ):
+            if sf_path in keys:
+                selection.setdefault( sf_path, { 'views' : set(), 'resources' : set() } )
+                selection[ sf_path ][ 'resources' ].add( target )
+    if not keys <= known:
+        logger.info( "No dependency graph for {0}, re-materializing everything".format(
+            sorted( keys - known ) ) )
+        return None
+    for sf_path, affected in sorted( selection.items() ):
+        logger.info( "Affects views {0} and resources {1} of '{2}'".format(
+            sorted( affected[ 'views' ] ), sorted( affected[ 'resources' ] ), sf_path ) )
+    return selection
+
+##============================================================================
+
+##
+# Materialize a project, then keep re-materializing it whenever its
+# Shuntfiles, templates or resources change, until interrupted (or
+# until max_runs re-materializations).
+#
+# materialize is called with a selection (see affected_selection) for
+# every run: None for the first run, after a failed run or when the
+# changes may affect anything, otherwise only the selected views and
+# resources need to be redone. It should be an incremental
+# materialization sharing warm caches between runs (see
+# shunt.materialize_views and its only argument).
+# A failing run is logged and watching goes on
+def watch( shuntfile_path,
+           materialize,
+           debounce = DEFAULT_DEBOUNCE,
+           force_polling = False,
+           poll_interval = DEFAULT_POLL_INTERVAL,
+           max_runs = None ):
+
+    watcher = make_watcher( force_polling, poll_interval )
+    runs = 0
+    selection = None
+    try:
+        while True:
+            start = time.perf_counter()
+            failed = False
+            try:
+                materialize( selection )
+                logger.info( "Materialized in {0:.3f}s".format( time.perf_counter() - start ) )
+            except Exception as e:
+                failed = True
+                logger.error( "Materialization failed, waiting for changes: {0}".format( e ) )
+            if max_runs is not None and runs >= max_runs:
+                return
+            try:
+                targets = watch_targets( shuntfile_path )
+                outputs = output_paths( shuntfile_path )
+            except Exception as e:
+                logger.error( "Unable to work out what to watch: {0}".format( e ) )
+                targets = [ ( pathlib.Path( shuntfile_path ).resolve().parent.as_posix(), True ) ]
+                outputs = []
+            watcher.update( targets )
+            logger.info( "Watching {0} path(s) for changes ({1})".format(
+                len( targets ), type( watcher ).__name__ ) )
+            changed = set()
+            while len( changed ) == 0:
+                changed = set( p for p in wait_for_changes( watcher, debounce )
+                               if not is_output( p, outputs ) )
+            logger.info( "Changed: {0}".format( sorted( changed ) ) )
+
+            # a failed run may have left anything half done, so the
+            # next one looks at everything
+            selection = None
+            if not failed:
+                try:
+                    selection = affected_selection( shuntfile_path, changed )
+                except Exception as e:
+                    logger.info( "Unable to work out what the changes affect, re-materializing everything: {0}".format( e ) )
+            runs += 1
+    finally:
+        watcher.close()
+
+##============================================================================
+##============================================================================
+##============================================================================
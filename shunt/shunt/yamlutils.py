@@ -0,0 +1,164 @@
+import shunt.logutils as logutils
+logger = logutils.getLogger( __name__ )
+
+import pathlib
+import hashlib
+import os
+import pickle
+import threading
+
+import yaml
+
+##============================================================================
+
+##
+# The loader used for all YAML (Shuntfiles, hmaps).
+# This is libyaml's C loader when PyYAML was built with it, otherwise
+# the pure-python one. Either way it is a *safe* loader: YAML files
+# are plain data and may not construct arbitrary python objects
+SafeLoader = getattr( yaml, 'CSafeLoader', yaml.SafeLoader )
+
+##
+# The on-disk parse cache directory (None for no parse cache).
+# Defaults to $SHUNT_YAML_CACHE if set
+PARSE_CACHE_ENV_VAR = "SHUNT_YAML_CACHE"
+_PARSE_CACHE_PATH = os.environ.get( PARSE_CACHE_ENV_VAR ) or None
+
+##============================================================================
+
+##
+# Sets (or with None, disables) the on-disk parse cache directory
+def set_parse_cache_path( path ):
+    global _PARSE_CACHE_PATH
+    _PARSE_CACHE_PATH = path
+
+##============================================================================
+
+##
+# Parse a YAML string (or bytes) with the safe loader
+def load_yaml_string( text, loader = None ):
+    if loader is None:
+        loader = SafeLoader
+    return yaml.load( text, Loader = loader )
+
+##============================================================================
+
+##
+# Parse a YAML file with the safe loader, keeping the composed node
+# tree (whose nodes carry start and end marks into the file).
+# Returns ( data, root node ), with a None node for empty files.
+# This never uses the parse cache since the nodes are not cached
+def compose_yaml_file( path, loader = None ):
+    if loader is None:
+        loader = SafeLoader
+    with open( path, 'rb' ) as f:
+        content = f.read()
+    return _compose_yaml_string( content, loader )
+
+def _compose_yaml_string( content, loader ):
+    instance = loader( content )
+    try:
+        node = instance.get_single_node()
+        data = None
+        if node is not None:
+            data = instance.construct_document( node )
+        return data, node
+    finally:
+        instance.dispose()
+
+##============================================================================
+
+##
+# Returns the parse cache key for some YAML content.
+# The loader and PyYAML version are part of the key since they decide
+# what the content parses to, as is the tag naming what else is
+# cached with the parse (if anything)
+def parse_cache_key( content, loader, tag = None ):
+    h = hashlib.sha256()
+    h.update( "{0}:{1}:{2}\0".format( yaml.__version__,
+                                      loader.__module__,
+                                      loader.__name__ ).encode( 'utf-8' ) )
+    if tag is not None:
+        h.update( "{0}\0".format( tag ).encode( 'utf-8' ) )
+    h.update( content )
+    return h.hexdigest()
+
+##============================================================================
+
+##
+# Load a YAML file.
+#
+# If a parse cache directory is given (or set with
+# set_parse_cache_path) the parsed structure is pickled there, keyed by
+# a hash of the file content, and unchanged files are later unpickled
+# instead of parsed. The cache directory must only be writable by
+# trusted users since it is unpickled.
+def load_yaml_file( path, cache_path = None, loader = None ):
+    if loader is None:
+        loader = SafeLoader
+    with open( path, 'rb' ) as f:
+        content = f.read()
+    return _cached_parse( content,
+                          loader,
+                          None,
+                          cache_path,
+                          lambda: load_yaml_string( content, loader = loader ) )
+
+##
+# Load a YAML file through its composed node tree (see
+# compose_yaml_file), returning build( data, root node ).
+#
+# The nodes themselves are never cached, but what build returns is,
+# like load_yaml_file's parses, under a key including the tag (which
+# must name build and change whenever what it returns does). build
+# must return plain picklable values
+def load_composed_yaml_file( path, build, tag, cache_path = None, loader = None ):
+    if loader is None:
+        loader = SafeLoader
+    with open( path, 'rb' ) as f:
+        content = f.read()
+    return _cached_parse( content,
+                          loader,
+                          tag,
+                          cache_path,
+                          lambda: build( *_compose_yaml_string( content, loader ) ) )
+
+##
+# Returns parse() for some YAML content, through the parse cache if
+# there is one
+def _cached_parse( content, loader, tag, cache_path, parse ):
+    if cache_path is None:
+        cache_path = _PARSE_CACHE_PATH
+    if cache_path is None:
+        return parse()
+
+    # try the cache
+    key = parse_cache_key( content, loader, tag )
+    pickle_path = pathlib.Path( cache_path ) / ( key + ".pickle" )
+    try:
+        with open( pickle_path.as_posix(), 'rb' ) as f:
+            return pickle.load( f )
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning( "Ignoring unreadable YAML parse cache entry '{0}': {1}".format(
+            pickle_path, e ) )
+
+    # parse and remember
+    data = parse()
+    try:
+        pickle_path.parent.mkdir( parents = True, exist_ok = True )
+        tmp_path = "{0}.{1}.{2}.tmp".format( pickle_path.as_posix(),
+                                             os.getpid(),
+                                             threading.get_ident() )
+        with open( tmp_path, 'wb' ) as f:
+            pickle.dump( data, f, protocol = pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp_path, pickle_path.as_posix() )
+    except OSError as e:
+        logger.warning( "Unable to write YAML parse cache entry '{0}': {1}".format(
+            pickle_path, e ) )
+    return data
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,11 @@
+##
+# The hmap modules import each other by their plain names (from hmap
+# import ..., import parse) so their folder is put on the path, ahead
+# of the project folder which holds the shunt package itself
+import pathlib
+import sys
+
+ROOT = pathlib.Path( __file__ ).resolve().parent.parent
+for path in ( ROOT, ROOT / "hmap" ):
+    if path.as_posix() not in sys.path:
+        sys.path.insert( 0, path.as_posix() )
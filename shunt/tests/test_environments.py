@@ -0,0 +1,72 @@
+import shunt.dependencies as dependencies
+import shunt.environments as environments
+
+import threading
+
+import jinja2
+import pytest
+
+##============================================================================
+
+@pytest.fixture
+def template_path( tmp_path ):
+    ( tmp_path / 'view' ).write_text(
+        "{% extends 'base' %}{% block b %}{% include ['missing', 'inc'] %}{% endblock %}" )
+    ( tmp_path / 'base' ).write_text( "[{% block b %}{% endblock %}]" )
+    ( tmp_path / 'inc' ).write_text( "inc" )
+    return tmp_path.resolve().as_posix()
+
+##============================================================================
+
+##
+# The templates of a render are recorded whether the environment had
+# to load them or still had them cached
+def test_records_loads_with_and_without_the_cache( template_path ):
+    pool = environments.EnvironmentPool()
+    env = pool.get( [ template_path ] )
+    expected = {
+        'view' : template_path + '/view',
+        'base' : template_path + '/base',
+        'missing' : None,
+        'inc' : template_path + '/inc',
+    }
+    for _ in range( 2 ):
+        with dependencies.record_template_loads() as loaded:
+            assert env.get_template( 'view' ).render() == "[inc]"
+        assert loaded == expected
+    # a missing template is looked for again every time
+    stats = pool.cache_stats()
+    assert stats[ 'template_cache_misses' ] == 5
+    assert stats[ 'template_cache_hits' ] == 3
+    assert stats[ 'environment_misses' ] == 1
+
+def test_missing_template_is_recorded( template_path ):
+    env = environments.EnvironmentPool().get( [ template_path ] )
+    with dependencies.record_template_loads() as loaded:
+        with pytest.raises( jinja2.TemplateNotFound ):
+            env.get_template( 'nope' )
+    assert loaded == { 'nope' : None }
+
+##
+# Counts from several threads (as subprojects materialized
+# concurrently) are not lost
+def test_stats_from_threads( template_path ):
+    pool = environments.EnvironmentPool()
+
+    def _work():
+        for _ in range( 1000 ):
+            pool.count( 'template_cache_hits' )
+            pool.add_stats( { 'template_cache_misses' : 1 } )
+
+    threads = [ threading.Thread( target = _work ) for _ in range( 4 ) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.cache_stats()
+    assert stats[ 'template_cache_hits' ] == 4000
+    assert stats[ 'template_cache_misses' ] == 4000
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,118 @@
+import shunt.fetch as fetch
+
+import os
+import pathlib
+import subprocess
+
+import pytest
+
+##============================================================================
+
+##
+# Run git quietly in a directory
+def _git( directory, *args ):
+    subprocess.run( [ 'git' ] + list( args ),
+                    cwd = directory,
+                    check = True,
+                    stdout = subprocess.DEVNULL,
+                    stderr = subprocess.DEVNULL )
+
+##
+# Commit a template file to the work repository and push it to the
+# bare one
+def _push( work, name, content ):
+    ( work / name ).write_text( content )
+    _git( work, 'add', name )
+    _git( work, 'commit', '-q', '-m', "Update {0}".format( name ) )
+    _git( work, 'push', '-q', 'origin', 'dev' )
+
+##
+# A bare repository (the remote) with a 'dev' branch holding a
+# template, and a work repository to push changes from.
+# Returns ( work repository, git path object )
+@pytest.fixture
+def remote( tmp_path, monkeypatch ):
+    for var in ( 'GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME' ):
+        monkeypatch.setenv( var, "shunt tests" )
+    for var in ( 'GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL' ):
+        monkeypatch.setenv( var, "shunt-tests@localhost" )
+    bare = tmp_path / "remote.git"
+    work = tmp_path / "work"
+    _git( tmp_path, 'init', '-q', '--bare', bare.as_posix() )
+    _git( tmp_path, 'init', '-q', work.as_posix() )
+    _git( work, 'checkout', '-q', '-b', 'dev' )
+    _git( work, 'remote', 'add', 'origin', bare.as_posix() )
+    _push( work, "view.tf", "one" )
+    path = {
+        'source' : 'git',
+        'destination' : 'templates',
+        'args' : [ '-b', 'dev', 'file://' + bare.as_posix(), 'templates' ],
+    }
+    return work, path
+
+##============================================================================
+
+def test_new_clone( tmp_path, remote ):
+    _, path = remote
+    cache = fetch.FetchCache( tmp_path / "cache" )
+    local = cache.fetch( path )
+    assert ( pathlib.Path( local ) / "view.tf" ).read_text() == "one"
+    assert local.startswith( cache.cache_path )
+
+    # no scratch directories are left behind
+    assert sorted( p.name for p in pathlib.Path( cache.cache_path ).iterdir() ) == sorted(
+        [ fetch.fetch_key( path ), fetch.fetch_key( path ) + ".json" ] )
+
+def test_ttl_hit_does_not_update( tmp_path, remote ):
+    work, path = remote
+    cache = fetch.FetchCache( tmp_path / "cache", ttl = 3600 )
+    local = cache.fetch( path )
+    _push( work, "view.tf", "two" )
+    assert cache.fetch( path ) == local
+    assert ( pathlib.Path( local ) / "view.tf" ).read_text() == "one"
+
+def test_update_after_push( tmp_path, remote ):
+    work, path = remote
+    cache = fetch.FetchCache( tmp_path / "cache", ttl = 0 )
+    local = cache.fetch( path )
+    _push( work, "view.tf", "two" )
+    _push( work, "other.tf", "new" )
+    assert cache.fetch( path ) == local
+    assert ( pathlib.Path( local ) / "view.tf" ).read_text() == "two"
+    assert ( pathlib.Path( local ) / "other.tf" ).read_text() == "new"
+
+def test_forced_update( tmp_path, remote ):
+    work, path = remote
+    cache = fetch.FetchCache( tmp_path / "cache", ttl = 3600 )
+    local = cache.fetch( path )
+    _push( work, "view.tf", "two" )
+    cache.fetch( path, force = True )
+    assert ( pathlib.Path( local ) / "view.tf" ).read_text() == "two"
+
+def test_offline_uses_the_cache( tmp_path, remote ):
+    work, path = remote
+    local = fetch.FetchCache( tmp_path / "cache" ).fetch( path )
+    _push( work, "view.tf", "two" )
+    offline = fetch.FetchCache( tmp_path / "cache", ttl = 0, offline = True )
+    assert offline.fetch( path ) == local
+    assert ( pathlib.Path( local ) / "view.tf" ).read_text() == "one"
+
+def test_offline_without_a_cache_entry( tmp_path, remote ):
+    _, path = remote
+    offline = fetch.FetchCache( tmp_path / "cache", offline = True )
+    with pytest.raises( RuntimeError, match = "offline" ):
+        offline.fetch( path )
+    assert not ( tmp_path / "cache" / fetch.fetch_key( path ) ).exists()
+
+def test_fetch_all_keeps_order( tmp_path, remote ):
+    _, path = remote
+    cache = fetch.FetchCache( tmp_path / "cache" )
+    paths = cache.fetch_all( [ "local/a", path, "local/b" ] )
+    assert paths[0] == "local/a" and paths[2] == "local/b"
+    assert os.path.isfile( os.path.join( paths[1], "view.tf" ) )
+
+def test_invalid_paths():
+    with pytest.raises( ValueError ):
+        fetch.validate_remote_path( { 'source' : 'ftp', 'destination' : 'x' } )
+    with pytest.raises( ValueError ):
+        fetch.validate_remote_path( { 'source' : 'git' } )
@@ -0,0 +1,20 @@
+from hmap import is_fully_resolved
+
+import pytest
+
+##============================================================================
+
+@pytest.mark.parametrize( "value, expected", [
+    ( 'plain', True ),
+    ( 42, True ),
+    ( { 'a' : [ 1, { 'b' : 'c' } ] }, True ),
+    ( '{{ x }}', False ),
+    ( { 'a' : [ 1, { 'b' : 'x {{ y }}' } ] }, False ),
+    ( { '{{ k }}' : 'v' }, False ),
+] )
+def test_is_fully_resolved( value, expected ):
+    assert is_fully_resolved( value ) is expected
+
+##============================================================================
+##============================================================================
+##============================================================================
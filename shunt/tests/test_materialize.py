@@ -0,0 +1,75 @@
+import shunt.shunt as shunt
+import shunt.shuntfile as shuntfile
+
+import pathlib
+
+import pytest
+
+##============================================================================
+
+##
+# A project with two subprojects: 'own' materializes into its own
+# path, 'shared' into the materialization path of the project
+@pytest.fixture
+def project( tmp_path ):
+    root = tmp_path.resolve()
+    for name, view in [ ( '.', 'a.tf' ), ( 'own', 'b.tf' ), ( 'shared', 'c.tf' ) ]:
+        ( root / name / 'shunts' ).mkdir( parents = True, exist_ok = True )
+        ( root / name / 'shunts' / view ).write_text( view )
+    ( root / 'own' / 'Shuntfile' ).write_text(
+        "project:\n"
+        "  views: [ b.tf ]\n"
+        "  materialize_path: {0}\n".format( root / 'own_out' ) )
+    ( root / 'shared' / 'Shuntfile' ).write_text(
+        "project:\n"
+        "  views: [ c.tf ]\n" )
+    _write_root( root, [ 'own', 'shared' ] )
+    return root
+
+def _write_root( root, subprojects ):
+    ( root / 'Shuntfile' ).write_text(
+        "project:\n"
+        "  views: [ a.tf ]\n"
+        "  subprojects: [ {0} ]\n".format( ", ".join( subprojects ) ) )
+    shuntfile.clear_shuntfile_cache()
+
+def _materialize( root ):
+    shunt.materialize_views( ( root / 'Shuntfile' ).as_posix(), incremental = True )
+
+##============================================================================
+
+def test_subprojects_leaving_the_tree_are_cleaned_up( project ):
+    out = project / 'materialized_views'
+    _materialize( project )
+    assert ( out / 'a.tf' ).exists()
+    assert ( out / 'c.tf' ).exists()
+    assert ( project / 'own_out' / 'b.tf' ).exists()
+
+    _write_root( project, [] )
+    _materialize( project )
+    assert ( out / 'a.tf' ).exists()
+    assert not ( out / 'c.tf' ).exists()
+    assert not ( project / 'own_out' ).exists()
+    assert not ( project / 'own_out.shunt-manifest.json' ).exists()
+    assert not ( project / 'own_out.shunt-deps.json' ).exists()
+
+    # and come back when they are in the tree again
+    _write_root( project, [ 'own', 'shared' ] )
+    _materialize( project )
+    assert ( out / 'c.tf' ).exists()
+    assert ( project / 'own_out' / 'b.tf' ).exists()
+
+def test_moved_materialize_path_is_cleaned_up( project ):
+    _materialize( project )
+    ( project / 'own' / 'Shuntfile' ).write_text(
+        "project:\n"
+        "  views: [ b.tf ]\n"
+        "  materialize_path: {0}\n".format( project / 'moved_out' ) )
+    _materialize( project )
+    assert ( project / 'moved_out' / 'b.tf' ).exists()
+    assert not ( project / 'own_out' ).exists()
+    assert not ( project / 'own_out.shunt-manifest.json' ).exists()
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,115 @@
+import parse
+import persistent
+
+import pytest
+
+##============================================================================
+
+@pytest.mark.parametrize( "value", [
+    None,
+    'a string',
+    42,
+    [ 1, 2, { 'a' : 3 } ],
+] )
+def test_parse_state_keeps_non_mapping_documents( value ):
+    state = parse.ParseState( value )
+    assert state.hmap is value
+
+def test_parse_state_adopts_mappings():
+    data = { 'a' : { 'b' : 1 } }
+    state = parse.ParseState( data )
+    assert state.hmap is data
+    assert isinstance( state.tree, persistent.PersistentHmap )
+
+def test_with_values_shares_untouched_subtrees():
+    data = { 'a' : { 'b' : 1 }, 'c' : { 'd' : 2 } }
+    state = parse.ParseState( data )
+    child = state.with_value( [ 'a', 'b' ], 10 )
+    assert child.hmap == { 'a' : { 'b' : 10 }, 'c' : { 'd' : 2 } }
+    assert child.hmap[ 'c' ] is data[ 'c' ]
+    assert data[ 'a' ][ 'b' ] == 1
+    assert list( child.diff( state ) ) == [ ( ( 'a', 'b' ), 1, 10 ) ]
+
+def test_with_values_on_lists():
+    state = parse.ParseState( [ 1, [ 2, 3 ] ] )
+    assert state.with_value( [ 1, 0 ], 'x' ).hmap == [ 1, [ 'x', 3 ] ]
+
+##============================================================================
+
+@pytest.mark.parametrize( "text, expected", [
+    ( "", None ),
+    ( "- 1\n- 2\n", [ 1, 2 ] ),
+    ( "just a scalar\n", 'just a scalar' ),
+    ( "a:\n  b: 1\n", { 'a' : { 'b' : 1 } } ),
+] )
+@pytest.mark.parametrize( "line_info", [ False, True ] )
+def test_parse_yaml_documents( tmp_path, text, expected, line_info ):
+    path = tmp_path / "doc.yaml"
+    path.write_text( text )
+    state = parse.parse_yaml( path.as_posix(), line_info = line_info )
+    assert state.hmap == expected
+
+##============================================================================
+
+LINE_INFO_DOCUMENT = """\
+a:
+  b: [1, 2, {c: 3}]
+  1: one
+  "1": strone
+  true: yes
+x:
+  - [1, 2]
+  - [3]
+  - {a: {b: deep}}
+dup: first
+dup: second
+"""
+
+##
+# Returns the path => ( start line, stop line ) of every node of a
+# composed document, walked naively. Paths are tuples of ( type, key )
+# so that 1 and True stay apart
+def _reference_lines( root ):
+    import yaml
+    constructor = yaml.constructor.SafeConstructor()
+    lines = {}
+    stack = [ ( (), root ) ]
+    while len( stack ) > 0:
+        path, node = stack.pop( 0 )
+        lines[ path ] = ( node.start_mark.line + 1, node.end_mark.line + 1 )
+        if isinstance( node, yaml.MappingNode ):
+            for key_node, value_node in node.value:
+                key = constructor.construct_object( key_node, deep = True )
+                stack.append( ( path + ( ( type( key ), key ), ), value_node ) )
+        elif isinstance( node, yaml.SequenceNode ):
+            for i, value_node in enumerate( node.value ):
+                stack.append( ( path + ( ( int, i ), ), value_node ) )
+    return lines
+
+def test_line_index_finds_every_node( tmp_path ):
+    import shunt.yamlutils as yamlutils
+    path = tmp_path / "doc.yaml"
+    path.write_text( LINE_INFO_DOCUMENT )
+    _, root = yamlutils.compose_yaml_file( path.as_posix() )
+    index = parse.LineIndex.from_node( root )
+    reference = _reference_lines( root )
+    assert len( index ) == len( reference )
+    for node_path, ( start, stop ) in reference.items():
+        info = index.lookup( [ key for _, key in node_path ] )
+        assert ( info.start_line, info.stop_line ) == ( start, stop ), node_path
+
+    # restored from its cached state too
+    restored = parse.LineIndex.from_state( index.state() )
+    assert restored.lookup( [ 'x', 2, 'a', 'b' ] ).start_line == 9
+
+def test_line_index_keys_are_typed( tmp_path ):
+    path = tmp_path / "doc.yaml"
+    path.write_text( LINE_INFO_DOCUMENT )
+    state = parse.parse_yaml( path.as_posix(), line_info = True )
+    assert state.get_line_info_for_path( [ 'a', 1 ] ).start_line == 3
+    assert state.get_line_info_for_path( [ 'a', '1' ] ).start_line == 4
+    assert state.get_line_info_for_path( [ 'a', True ] ).start_line == 5
+    assert state.get_line_info_for_path( [ 'dup' ] ).start_line == 11
+    assert state.get_line_info_for_path( [ 'a', 2 ] ) is None
+    assert state.get_line_info_for_path( [ 'x', 0, 5 ] ) is None
+    assert state.get_line_info_for_path( [ 'nope', 'deeper' ] ) is None
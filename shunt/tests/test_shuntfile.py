@@ -0,0 +1,40 @@
+import shunt.shuntfile as shuntfile
+
+import os
+
+import pytest
+
+##============================================================================
+
+@pytest.fixture( autouse = True )
+def _clear_cache():
+    shuntfile.clear_shuntfile_cache()
+    yield
+    shuntfile.clear_shuntfile_cache()
+
+##============================================================================
+
+##
+# The cached Shuntfile is shared by every caller, so its path must not
+# depend on the current directory of the first one
+def test_cached_shuntfile_has_the_resolved_path( tmp_path, monkeypatch ):
+    ( tmp_path / 'proj' ).mkdir()
+    ( tmp_path / 'other' ).mkdir()
+    ( tmp_path / 'proj' / 'Shuntfile' ).write_text( "project:\n  views: [ a ]\n" )
+    expected = ( tmp_path / 'proj' / 'Shuntfile' ).resolve().as_posix()
+
+    monkeypatch.chdir( tmp_path / 'proj' )
+    sf = shuntfile.load_shuntfile( 'Shuntfile' )
+    assert sf.path == expected
+
+    monkeypatch.chdir( tmp_path / 'other' )
+    again = shuntfile.load_shuntfile( os.path.join( '..', 'proj', 'Shuntfile' ) )
+    assert again is sf
+    assert again.path == expected
+    assert shuntfile.shuntfile_get( again, ['project','views'], None ) == [ 'a' ]
+    assert shuntfile.SHUNTFILE_STATS[ 'parses' ] == 1
+    assert shuntfile.SHUNTFILE_STATS[ 'cache_hits' ] == 1
+
+##============================================================================
+##============================================================================
+##============================================================================
@@ -0,0 +1,37 @@
+import shunt.template_index as template_index
+
+import pytest
+
+##============================================================================
+
+@pytest.fixture( autouse = True )
+def _invalidate():
+    template_index.invalidate()
+    yield
+    template_index.invalidate()
+
+##============================================================================
+
+##
+# Ignore patterns (the default ones and those of a .shuntignore) only
+# keep directories out of the index, files matching them are templates
+# like any other
+def test_ignore_patterns_apply_to_directories_only( tmp_path ):
+    root = tmp_path.resolve()
+    ( root / 'materialized_views' ).mkdir()
+    ( root / 'materialized_views' / 'out.tf' ).write_text( "out" )
+    ( root / 'build.bak' ).mkdir()
+    ( root / 'build.bak' / 'old.tf' ).write_text( "old" )
+    ( root / 'materialized_views.tf' ).write_text( "view" )
+    ( root / 'notes.bak' ).write_text( "notes" )
+    ( root / '.shuntignore' ).write_text( "*.bak\n" )
+
+    index = template_index.get_template_index( [ root.as_posix() ] )
+    assert index.find_file( 'materialized_views.tf' ) == 0
+    assert index.find_file( 'notes.bak' ) == 0
+    assert index.find_file( 'materialized_views/out.tf' ) is None
+    assert index.find_file( 'build.bak/old.tf' ) is None
+
+##============================================================================
+##============================================================================
+##============================================================================
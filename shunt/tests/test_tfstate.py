@@ -0,0 +1,146 @@
+import shunt.tfstate as tfstate
+
+import json
+import os
+import stat
+import subprocess
+
+import pytest
+
+##============================================================================
+
+##
+# v4 state with a managed resource in the root module and one in a
+# child module, a data source, and a destroyed resource
+STATE_V4_MANAGED = {
+    'version' : 4,
+    'resources' : [
+        { 'mode' : 'managed', 'type' : 'aws_instance', 'name' : 'web',
+          'instances' : [ { 'attributes' : {} } ] },
+        { 'module' : 'module.net', 'mode' : 'managed', 'type' : 'aws_vpc', 'name' : 'main',
+          'instances' : [ { 'attributes' : {} } ] },
+        { 'mode' : 'data', 'type' : 'aws_ami', 'name' : 'ubuntu',
+          'instances' : [ { 'attributes' : {} } ] },
+        { 'mode' : 'managed', 'type' : 'aws_eip', 'name' : 'gone',
+          'instances' : [] },
+    ],
+}
+
+STATE_V4_UNMANAGED = {
+    'version' : 4,
+    'resources' : [
+        { 'mode' : 'data', 'type' : 'aws_ami', 'name' : 'ubuntu',
+          'instances' : [ { 'attributes' : {} } ] },
+        { 'mode' : 'managed', 'type' : 'aws_eip', 'name' : 'gone',
+          'instances' : [] },
+    ],
+}
+
+STATE_V3_MANAGED = {
+    'version' : 3,
+    'modules' : [
+        { 'path' : [ 'root' ], 'resources' : { 'data.aws_ami.ubuntu' : {} } },
+        { 'path' : [ 'root', 'net' ], 'resources' : { 'aws_vpc.main' : {} } },
+    ],
+}
+
+##============================================================================
+
+##
+# A PATH without terraform on it for every test, so nothing here can
+# depend on terraform being installed
+@pytest.fixture( autouse = True )
+def no_terraform( tmp_path, monkeypatch ):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv( 'PATH', bin_dir.as_posix() )
+    tfstate._CACHE.clear()
+    return bin_dir
+
+##
+# Write a JSON (or, given a string, raw) state file below a directory
+def _write( directory, relative_path, state ):
+    path = directory / relative_path
+    path.parent.mkdir( parents = True, exist_ok = True )
+    path.write_text( state if isinstance( state, str ) else json.dumps( state ) )
+    return path
+
+##============================================================================
+
+def test_managed_resources_v4():
+    assert tfstate.managed_resources( STATE_V4_MANAGED ) == [
+        'aws_instance.web', 'module.net.aws_vpc.main' ]
+
+def test_managed_resources_v3():
+    assert tfstate.managed_resources( STATE_V3_MANAGED ) == [ 'module.net.aws_vpc.main' ]
+
+def test_managed_resources_unknown_version():
+    with pytest.raises( ValueError ):
+        tfstate.managed_resources( { 'version' : 99 } )
+
+##============================================================================
+
+def test_no_state_is_safe( tmp_path ):
+    tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+@pytest.mark.parametrize( "state", [ STATE_V4_UNMANAGED, "" ] )
+def test_unmanaged_state_is_safe( tmp_path, state ):
+    _write( tmp_path, "terraform.tfstate", state )
+    tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+def test_managed_state_is_not_safe( tmp_path ):
+    _write( tmp_path, "terraform.tfstate", STATE_V4_MANAGED )
+    with pytest.raises( RuntimeError, match = "aws_instance.web" ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+def test_managed_workspace_state_is_not_safe( tmp_path ):
+    _write( tmp_path, "terraform.tfstate", STATE_V4_UNMANAGED )
+    _write( tmp_path, "terraform.tfstate.d/staging/terraform.tfstate", STATE_V3_MANAGED )
+    with pytest.raises( RuntimeError, match = "module.net.aws_vpc.main" ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+def test_local_backend_state_path( tmp_path ):
+    _write( tmp_path, ".terraform/terraform.tfstate",
+            { 'backend' : { 'type' : 'local', 'config' : { 'path' : 'state/custom.tfstate' } } } )
+    _write( tmp_path, "state/custom.tfstate", STATE_V4_MANAGED )
+    with pytest.raises( RuntimeError, match = "aws_instance.web" ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+@pytest.mark.parametrize( "state", [ "{bad", json.dumps( { 'version' : 99 } ) ] )
+def test_unreadable_local_state_is_an_error( tmp_path, state ):
+    _write( tmp_path, "terraform.tfstate", state )
+    with pytest.raises( RuntimeError, match = "Unreadable terraform state file" ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+def test_state_changes_are_seen_through_the_cache( tmp_path ):
+    _write( tmp_path, "terraform.tfstate", STATE_V4_UNMANAGED )
+    tfstate.check_safe_to_empty( tmp_path.as_posix() )
+    path = _write( tmp_path, "terraform.tfstate", STATE_V4_MANAGED )
+    os.utime( path, ns = ( 1, 1 ) )
+    with pytest.raises( RuntimeError ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+##============================================================================
+
+##
+# Put a fake terraform on the PATH exiting with the given code
+def _fake_terraform( bin_dir, code ):
+    path = bin_dir / "terraform"
+    path.write_text( "#!/bin/sh\nexit {0}\n".format( code ) )
+    path.chmod( path.stat().st_mode | stat.S_IEXEC )
+
+def test_remote_backend_needs_terraform( tmp_path, no_terraform ):
+    _write( tmp_path, ".terraform/terraform.tfstate",
+            { 'backend' : { 'type' : 's3', 'config' : { 'bucket' : 'b' } } } )
+    with pytest.raises( FileNotFoundError ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+    _fake_terraform( no_terraform, 0 )
+    tfstate.check_safe_to_empty( tmp_path.as_posix() )
+    _fake_terraform( no_terraform, 1 )
+    with pytest.raises( subprocess.CalledProcessError ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
+
+def test_unreadable_backend_configuration_is_an_error( tmp_path ):
+    _write( tmp_path, ".terraform/terraform.tfstate", "{bad" )
+    with pytest.raises( RuntimeError, match = "Unreadable terraform backend" ):
+        tfstate.check_safe_to_empty( tmp_path.as_posix() )
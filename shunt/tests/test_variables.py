@@ -0,0 +1,80 @@
+import hmap
+import variables
+
+import pytest
+
+##============================================================================
+
+##
+# Returns a template context with the given context variables
+def _context( **context ):
+    return hmap.TemplateContext( context = context )
+
+HMAP = {
+    'vars' : {
+        'a' : 'A',
+        'b' : '{{ a }}-{{ ctx }}',
+    },
+    'leaf' : '{{ b }}!',
+    'direct' : '{{ ctx }}',
+    'plain' : 'no template',
+    'nested' : { 'list' : [ '{{ a }}', 'x' ] },
+}
+
+##============================================================================
+
+def test_resolves_variables_in_topological_order():
+    graph = variables.VariableGraph( HMAP, _context( ctx = 'one' ) )
+    assert graph.order.index( 'a' ) < graph.order.index( 'b' )
+    assert graph.resolved == {
+        'vars' : { 'a' : 'A', 'b' : 'A-one' },
+        'leaf' : 'A-one!',
+        'direct' : 'one',
+        'plain' : 'no template',
+        'nested' : { 'list' : [ 'A', 'x' ] },
+    }
+
+def test_resolve_does_not_change_the_hmap():
+    graph = variables.VariableGraph( HMAP, _context( ctx = 'one' ) )
+    assert HMAP[ 'leaf' ] == '{{ b }}!'
+    assert graph.hmap is HMAP
+
+def test_cycles_are_errors():
+    with pytest.raises( RuntimeError, match = "cycle" ):
+        variables.VariableGraph( { 'vars' : { 'a' : '{{ b }}', 'b' : '{{ c }}', 'c' : '{{ a }}' } },
+                                 _context() )
+
+def test_update_introducing_a_cycle_keeps_the_graph():
+    graph = variables.VariableGraph( HMAP, _context( ctx = 'one' ) )
+    with pytest.raises( RuntimeError, match = "cycle" ):
+        graph.update_variable( 'a', '{{ b }}' )
+    assert graph.resolve() == variables.VariableGraph( HMAP, _context( ctx = 'one' ) ).resolved
+
+##============================================================================
+
+@pytest.mark.parametrize( "name, raw, context", [
+    ( 'ctx', 'two', { 'ctx' : 'two' } ),
+    ( 'a', 'Z', None ),
+    ( 'a', '{{ ctx }}{{ ctx }}', None ),
+    ( 'b', 'static', None ),
+] )
+def test_update_matches_a_fresh_resolve( name, raw, context ):
+    graph = variables.VariableGraph( HMAP, _context( ctx = 'one' ) )
+    graph.update_variable( name, raw )
+
+    fresh_hmap = HMAP
+    if context is None:
+        fresh_hmap = dict( HMAP, vars = dict( HMAP[ 'vars' ], **{ name : raw } ) )
+        context = { 'ctx' : 'one' }
+    fresh = variables.VariableGraph( fresh_hmap, _context( **context ) )
+    assert graph.resolved == fresh.resolved
+
+    # and a full resolve agrees too
+    assert graph.resolve() == fresh.resolved
+
+def test_update_only_rerenders_dependents():
+    graph = variables.VariableGraph( HMAP, _context( ctx = 'one' ) )
+    paths = graph.update_variable( 'ctx', 'two' )
+    assert paths == [ ( 'direct', ), ( 'leaf', ), ( 'vars', 'b' ) ]
+    before = variables.VariableGraph( HMAP, _context( ctx = 'one' ) ).resolved
+    assert graph.resolved[ 'nested' ] == before[ 'nested' ]
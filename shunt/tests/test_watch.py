@@ -0,0 +1,97 @@
+import shunt.shunt as shunt
+import shunt.watch as watch
+
+import pathlib
+
+import pytest
+
+##============================================================================
+
+##
+# A project with a view including a template from a sub directory, a
+# plain view and a resource directory
+@pytest.fixture
+def project( tmp_path ):
+    root = tmp_path.resolve()
+    shunts = root / 'shunts'
+    ( shunts / 'inc' ).mkdir( parents = True )
+    ( shunts / 'res' ).mkdir()
+    ( root / 'Shuntfile' ).write_text(
+        "project:\n"
+        "  views:\n"
+        "    - a.tf\n"
+        "    - b.tf\n"
+        "  resources:\n"
+        "    - res\n" )
+    ( shunts / 'a.tf' ).write_text( "A {% include 'inc/x' %}" )
+    ( shunts / 'b.tf' ).write_text( "B" )
+    ( shunts / 'inc' / 'x' ).write_text( "x" )
+    ( shunts / 'res' / 'f' ).write_text( "f" )
+    sf_path = ( root / 'Shuntfile' ).as_posix()
+    shunt.materialize_views( sf_path, incremental = True )
+    return root
+
+##============================================================================
+
+def test_affected_selection_of_templates_and_resources( project ):
+    sf_path = ( project / 'Shuntfile' ).as_posix()
+    output = ( project / 'materialized_views' ).as_posix()
+    selection = watch.affected_selection(
+        sf_path, { ( project / 'shunts' / 'inc' / 'x' ).as_posix() } )
+    assert selection == { sf_path : { 'views' : { 'a.tf' }, 'resources' : set() } }
+    selection = watch.affected_selection(
+        sf_path, { ( project / 'shunts' / 'res' / 'f' ).as_posix() } )
+    assert selection == { sf_path : { 'views' : set(), 'resources' : { output + '/res' } } }
+    assert watch.affected_selection(
+        sf_path, { ( project / 'shunts' / 'unused' ).as_posix() } ) == {}
+
+##
+# A directory renamed or removed as a whole affects the views of the
+# templates below it
+def test_affected_selection_of_a_directory( project ):
+    sf_path = ( project / 'Shuntfile' ).as_posix()
+    selection = watch.affected_selection(
+        sf_path, { ( project / 'shunts' / 'inc' ).as_posix() } )
+    assert selection[ sf_path ][ 'views' ] == { 'a.tf' }
+
+def test_affected_selection_of_structural_changes( project ):
+    sf_path = ( project / 'Shuntfile' ).as_posix()
+    assert watch.affected_selection( sf_path, { sf_path } ) is None
+    assert watch.affected_selection(
+        sf_path, { ( project / 'shunts' / '.shuntignore' ).as_posix() } ) is None
+    ( project / 'materialized_views.shunt-deps.json' ).unlink()
+    assert watch.affected_selection(
+        sf_path, { ( project / 'shunts' / 'b.tf' ).as_posix() } ) is None
+
+##============================================================================
+
+def test_materialize_only_the_selection( project ):
+    sf_path = ( project / 'Shuntfile' ).as_posix()
+    output = project / 'materialized_views'
+    ( project / 'shunts' / 'a.tf' ).write_text( "A2" )
+    ( project / 'shunts' / 'b.tf' ).write_text( "B2" )
+    shunt.materialize_views( sf_path,
+                             incremental = True,
+                             only = { sf_path : { 'views' : { 'a.tf' },
+                                                  'resources' : set() } } )
+    assert ( output / 'a.tf' ).read_text() == "A2"
+    assert ( output / 'b.tf' ).read_text() == "B"
+
+    # what was left out is still looked at by a full run
+    shunt.materialize_views( sf_path, incremental = True )
+    assert ( output / 'b.tf' ).read_text() == "B2"
+
+def test_materialize_only_skips_other_shuntfiles( project ):
+    sf_path = ( project / 'Shuntfile' ).as_posix()
+    output = project / 'materialized_views'
+    ( project / 'shunts' / 'a.tf' ).write_text( "A2" )
+    shunt.materialize_views( sf_path, incremental = True, only = {} )
+    assert ( output / 'a.tf' ).read_text() == "A x"
+
+def test_materialize_only_requires_incremental( project ):
+    with pytest.raises( ValueError ):
+        shunt.materialize_views( ( project / 'Shuntfile' ).as_posix(), only = {} )
+
+##============================================================================
+##============================================================================
+##============================================================================